@@ -0,0 +1,234 @@
+"""
+grbl-gui - Graphical User Interface for the "grbl" CNC controller
+Copyright (C) 2015 Michael Franzl
+
+This file is part of grbl-gui.
+
+grbl-gui is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+grbl-gui is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with pyglpainter. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# The log console. Lines are collected in a list model and handed to the
+# view in one batch per timer tick. The view only lays out and paints the
+# visible rows, so the history can be long, and only new rows are
+# inserted instead of rendering all of them again.
+
+import html
+import re
+
+from PyQt6 import QtGui
+from PyQt6.QtCore import Qt, QAbstractListModel, QModelIndex, QSortFilterProxyModel
+from PyQt6.QtGui import QKeySequence, QShortcut
+from PyQt6.QtWidgets import QAbstractItemView, QApplication, QCheckBox, QHBoxLayout, QListView, QVBoxLayout, QWidget
+
+
+# the kinds of lines, with the label of their filter checkbox
+KINDS = (
+    ("processed", "✓"),
+    ("write", "▶"),
+    ("read", "◀"),
+    ("log", "✎"),
+    ("error", "✗"),
+    ("info", "…"),
+    )
+
+_re_tag = re.compile(r"<[^>]*>")
+_re_br = re.compile(r"<br\s*/?>", re.IGNORECASE)
+
+
+class LogModel(QAbstractListModel):
+    """
+    The lines of the log as tuples (kind, text, color, bold). At most
+    `maxlen` lines are kept, the oldest are dropped.
+    """
+
+    def __init__(self, maxlen=100000, parent=None):
+        super().__init__(parent)
+        self.maxlen = maxlen
+
+        # the rows are self._rows[self._first:], so that dropping the
+        # oldest rows doesn't move all the others each time
+        self._rows = []
+        self._first = 0
+        self._pending = []
+
+        self._brushes = {}
+        self._bold = QtGui.QFont()
+        self._bold.setBold(True)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._rows) - self._first
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        kind, text, color, bold = self._rows[self._first + index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return text
+        if role == Qt.ItemDataRole.ForegroundRole:
+            brush = self._brushes.get(color)
+            if brush is None:
+                brush = self._brushes[color] = QtGui.QBrush(QtGui.QColor(color))
+            return brush
+        if role == Qt.ItemDataRole.FontRole and bold:
+            return self._bold
+        return None
+
+    def kind(self, row):
+        return self._rows[self._first + row][0]
+
+    def append(self, kind, text, color="black", bold=False):
+        """
+        Adds a line. It is shown after the next `flush()`.
+        """
+        self._pending.append((kind, text, color, bold))
+
+    def flush(self):
+        """
+        Inserts the lines added since the last call into the model.
+        Returns whether there were any.
+        """
+        pending = self._pending
+        if len(pending) == 0:
+            return False
+        self._pending = []
+        pending = pending[-self.maxlen:]
+
+        # drop the oldest lines in batches of a tenth of maxlen, because
+        # every removal makes the view update all of its rows
+        overflow = self.rowCount() + len(pending) - self.maxlen
+        if overflow > 0:
+            overflow = min(self.rowCount(), max(overflow, self.maxlen // 10))
+            self.beginRemoveRows(QModelIndex(), 0, overflow - 1)
+            self._first += overflow
+            if self._first > self.maxlen:
+                del self._rows[:self._first]
+                self._first = 0
+            self.endRemoveRows()
+
+        first = self.rowCount()
+        self.beginInsertRows(QModelIndex(), first, first + len(pending) - 1)
+        self._rows.extend(pending)
+        self.endInsertRows()
+        return True
+
+    def clear(self):
+        self.beginResetModel()
+        self._rows = []
+        self._first = 0
+        self._pending = []
+        self.endResetModel()
+
+
+class LogFilterModel(QSortFilterProxyModel):
+    """
+    Hides the lines of the kinds in `hidden`
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.hidden = set()
+
+    def set_hidden(self, kind, hidden):
+        if hidden:
+            self.hidden.add(kind)
+        else:
+            self.hidden.discard(kind)
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        return not self.hidden or self.sourceModel().kind(source_row) not in self.hidden
+
+
+class LogConsole(QWidget):
+    """
+    A list view of a LogModel with a checkbox per kind of line to show
+    or hide them. New lines scroll into view unless the user scrolled
+    up. Ctrl+C copies the selected lines.
+    """
+
+    def __init__(self, parent=None, maxlen=100000):
+        super().__init__(parent)
+
+        self.model = LogModel(maxlen, self)
+        self.filter = LogFilterModel(self)
+        self.filter.setSourceModel(self.model)
+
+        self.view = QListView(self)
+        self.view.setModel(self.filter)
+        # all rows have the same height, so the view doesn't need to
+        # measure each of them
+        self.view.setUniformItemSizes(True)
+        self.view.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.view.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.view.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOn)
+
+        font = QtGui.QFont()
+        font.setFamily("DejaVu Sans Mono")
+        font.setPointSize(7)
+        self.view.setFont(font)
+
+        filters = QHBoxLayout()
+        filters.setSpacing(2)
+        self.checkboxes = {}
+        for kind, label in KINDS:
+            checkbox = QCheckBox(label, self)
+            checkbox.setToolTip("Show {} lines".format(kind))
+            checkbox.setChecked(True)
+            checkbox.toggled.connect(lambda checked, kind=kind: self.filter.set_hidden(kind, not checked))
+            filters.addWidget(checkbox)
+            self.checkboxes[kind] = checkbox
+        filters.addStretch()
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.setSpacing(0)
+        layout.addLayout(filters)
+        layout.addWidget(self.view)
+
+        self._shortcut = QShortcut(QKeySequence(QKeySequence.StandardKey.Copy), self.view)
+        self._shortcut.setContext(Qt.ShortcutContext.WidgetShortcut)
+        self._shortcut.activated.connect(self.copy_selection)
+
+    def append(self, kind, msg, color="black"):
+        """
+        Adds a line of `kind`, see KINDS. Markup in `msg` is removed,
+        and <b> makes the whole line bold. A `msg` of several lines,
+        e.g. a report, or with <br> becomes several lines of the log.
+        """
+        bold = "<b>" in msg
+        if "<" in msg:
+            msg = _re_br.sub("\n", msg)
+            msg = _re_tag.sub("", msg)
+        if "&" in msg:
+            msg = html.unescape(msg)
+        if "\n" in msg:
+            for line in msg.split("\n"):
+                self.model.append(kind, line, color, bold)
+        else:
+            self.model.append(kind, msg, color, bold)
+
+    def flush(self):
+        """
+        Shows the lines added since the last call, meant to be called
+        from a timer
+        """
+        bar = self.view.verticalScrollBar()
+        at_end = bar.value() >= bar.maximum()
+        if self.model.flush() and at_end:
+            self.view.scrollToBottom()
+
+    def copy_selection(self):
+        rows = sorted(index.row() for index in self.view.selectionModel().selectedIndexes())
+        lines = [self.filter.index(row, 0).data() for row in rows]
+        QApplication.clipboard().setText("\n".join(lines))
@@ -31,6 +31,9 @@ class SimulatorWidget(PainterWidget):
     def __init__(self, parent=None, refresh_rate=20):
         super().__init__(parent, refresh_rate)
 
+        # number of vertices the probe point item has room for
+        self._probepoints_capacity = 0
+
         self.cs_offsets = {
             "G54": (0, 0, 0),
             "G55": (0, 0, 0),
@@ -65,6 +68,56 @@ class SimulatorWidget(PainterWidget):
     def remove_heightmap(self):
         self.item_remove("myheightmap")
 
+    def draw_probepoints(self, origins, size=1, color=(0.6, 0.6, 0.6, 1)):
+        """
+        Appends a marker, a small 3D cross, for each of the probe point
+        `origins` to one single item. Its vertex buffer is allocated for
+        many points at once and only grows when full, so that drawing
+        costs the same no matter how many points were probed.
+        """
+        self.makeCurrent()
+
+        vertices = []
+        for origin in origins:
+            for axis in range(3):
+                start = list(origin)
+                end = list(origin)
+                start[axis] -= size
+                end[axis] += size
+                vertices.append([tuple(start), color])
+                vertices.append([tuple(end), color])
+
+        items = self.programs["simple3d"].items
+        i = items.get("probepoints")
+        if i is None or i.vertexcount + len(vertices) > self._probepoints_capacity:
+            if i is None:
+                old = []
+                self._probepoints_capacity = 6 * 1000
+            else:
+                old = [[tuple(p), tuple(c)] for p, c in i.vdata_pos_col[:i.vertexcount]]
+                self.item_remove("probepoints")
+            while len(old) + len(vertices) > self._probepoints_capacity:
+                self._probepoints_capacity *= 2
+
+            i = self.item_create(
+                "Item",
+                "probepoints",
+                "simple3d",
+                GL_LINES,
+                1,
+                (0, 0, 0),
+                1,
+                False,
+                self._probepoints_capacity)
+            i.append_vertices(old)
+
+        i.append_vertices(vertices)
+        i.upload()
+        self.dirty = True
+
+    def remove_probepoints(self):
+        self.item_remove("probepoints")
+
     def initializeGL(self):
         super().initializeGL()
 
@@ -23,36 +23,47 @@ import os
 import math
 import numpy as np
 import logging
-import collections
 import time
 import re
+import itertools
+import concurrent.futures
 
-import random
 
 from classes.commandlineedit import CommandLineEdit
+from classes.logconsole import LogConsole
 from classes.simulatordialog import SimulatorDialog
 from grbl_streamer import GrblStreamer
 from gcode_machine import GcodeMachine
 
 from PyQt6 import QtGui
-from PyQt6.QtCore import Qt, QTimer, QSettings
+from PyQt6.QtCore import Qt, QTimer, QSettings, pyqtSignal
 from PyQt6.QtGui import QKeySequence, QAction, QShortcut
-from PyQt6.QtWidgets import QApplication, QLabel, QMainWindow, QFileDialog, QListWidgetItem, QMenuBar, QTableWidgetItem
+from PyQt6.QtWidgets import QApplication, QMainWindow, QFileDialog, QListWidgetItem, QMenuBar, QTableWidgetItem
 
 from lib.qt.grbl_gui.ui_mainwindow import Ui_MainWindow
 from lib import gcodetools
+from lib import gcodeindex
+from lib import gcodepipeline
 from lib import utility
 from lib import pixel2laser
-
-from scipy.interpolate import griddata
+from lib.probesurface import ProbeSurface
+from lib import probeplanner
+from lib import probedata
+from lib.eventbus import EventBus
 
 
 class MainWindow(QMainWindow, Ui_MainWindow):
+    # (generation, vertex data or None, origin) from the heightmap worker
+    heightmap_ready = pyqtSignal(int, object, object)
+    # emitted by the EventBus for alarms, errors and standstill, which
+    # must not wait for the timer
+    grbl_event_urgent = pyqtSignal()
+
     def __init__(self, path, baud):
         super(MainWindow, self).__init__()
         self.logger = logging.getLogger('cnctoolbox.window')
 
-        _logbuffer_size = 200
+        _logbuffer_size = 100000
 
         self.devicepath = path
         self.devicebaud = baud
@@ -77,25 +88,16 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.mpos = (0, 0, 0)
 
         # LOGGING SETUP BEGIN ------
-        # setup ring buffer for logging
-        self.changed_loginput = False
         self.logoutput_items = []
         self.logoutput_current_index = -1
-        self.logbuffer = collections.deque(maxlen=_logbuffer_size)
-
-        for _ in range(1, _logbuffer_size):
-            self.logbuffer.append("")
 
-        self.label_loginput = QLabel()
-        self.label_loginput.setTextFormat(Qt.TextFormat.RichText)
-        self.label_loginput.setTextInteractionFlags(Qt.TextInteractionFlag.TextSelectableByMouse)
-        self.scrollArea_loginput.setWidget(self.label_loginput)
-        self.label_loginput.setAlignment(Qt.AlignmentFlag.AlignBottom |
-                                         Qt.AlignmentFlag.AlignLeft)
-        font = QtGui.QFont()
-        font.setFamily("DejaVu Sans Mono")
-        font.setPointSize(7)
-        self.label_loginput.setFont(font)
+        # the log console takes the place of the scroll area of the .ui
+        self.logconsole = LogConsole(self.centralWidget, _logbuffer_size)
+        self.logconsole.setSizePolicy(self.scrollArea_loginput.sizePolicy())
+        self.logconsole.setMinimumSize(self.scrollArea_loginput.minimumSize())
+        self.gridLayout.replaceWidget(self.scrollArea_loginput, self.logconsole)
+        self.scrollArea_loginput.deleteLater()
+        self.scrollArea_loginput = None
 
         font = QtGui.QFont()
         font.setFamily("DejaVu Sans Mono")
@@ -169,7 +171,11 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.sim_dialog.show()
 
         # GRBL SETUP BEGIN -----
-        self.grbl = GrblStreamer(self.on_grbl_event)
+        # GrblStreamer calls back from its serial thread, the events are
+        # handled on the timer in the GUI thread
+        self.eventbus = EventBus(self.on_grbl_event, wakeup=self.grbl_event_urgent.emit)
+        self.grbl_event_urgent.connect(self.eventbus.dispatch, Qt.ConnectionType.QueuedConnection)
+        self.grbl = GrblStreamer(self.eventbus.post)
         self.grbl.setup_logging()
         self.grbl.poll_interval = 0.15
 
@@ -253,13 +259,24 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.heightmap_llc = None
         self.heightmap_urc = None
         self.heightmap_ipolgrid = None
+        self.heightmap_resolution = 1
+        # the heightmap is interpolated in a worker thread, see draw_heightmap()
+        self._heightmap_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._heightmap_generation = 0
+        self._heightmap_busy = False
+        self._heightmap_pending = False
+        self.heightmap_ready.connect(self._on_heightmap_ready, Qt.ConnectionType.QueuedConnection)
         self.probe_z_first = None
         self.probe_z_at_probestart = None
         self.probe_z_expected_deviation = None
         self.probe_feed = None
         self.probe_points = None
         self.probe_values = None
+        self.probe_surface = None
+        self.probe_planner = None
+        self.probe_name = "default"
         self.probe_points_count = None
+        self.probe_points_drawn = 0
 
         self._add_to_logoutput("=calc_eta()")
         self._add_to_logoutput("=bbox()")
@@ -268,6 +285,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self._add_to_logoutput("=probe_done()")
         self._add_to_logoutput("=probe_load()")
         self._add_to_logoutput("=goto_marker()")
+        self._add_to_logoutput("=event_stats()")
         self._add_to_logoutput("G38.2 Z-10 F50")
         self._add_to_logoutput("G0 X0 Y0")
 
@@ -320,12 +338,26 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         self.current_script_filepath = None
 
+        # the G-code file which is the only content of the buffer, if any
+        self.current_gcode_filepath = None
+        self.current_gcode_buffer_size = None
+
+        # lines still to be written into the buffer, see write_stream()
+        self._write_stream_lines = None
+        # the pipeline they come from, to report its timing when done
+        self._write_stream_pipeline = None
+
+        # a gcodepipeline.Pipeline which transforms opened G-code files
+        # while they are written into the buffer
+        self.pipeline = None
+
     def closeEvent(self, event):
         """
         Overloaded Qt function
         """
         print("Exiting normally...")
         self.grbl.disconnect()
+        self._heightmap_executor.shutdown(wait=False, cancel_futures=True)
         self.sim_dialog.close()
         event.accept()
 
@@ -336,6 +368,9 @@ class MainWindow(QMainWindow, Ui_MainWindow):
     def new_job(self):
         self.job_run_timestamp = time.time()
         self.grbl.job_new()
+        self.current_gcode_filepath = None
+        self._write_stream_lines = None
+        self._write_stream_pipeline = None
         self.spinBox_start_line.setValue(0)
         self.sim_dialog.simulator_widget.cleanup_stage()
 
@@ -367,110 +402,119 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         idx = self.targets.index(targetname)
         self.comboBox_target.setCurrentIndex(idx)
 
-    def draw_probepoint(self, xy, z):
+    def draw_probepoints(self):
+        """
+        Draws the probe points which are not drawn yet
+        """
+        # the grbl thread may have added a point but not yet its value
+        count = min(len(self.probe_points), len(self.probe_values))
+        if count <= self.probe_points_drawn:
+            return
+
         current_cs_offset = self.state_hash[self.cs_names[self.current_cs]]
-        z = z - self.probe_z_first
 
-        print("DRAWING PROBE POINT")
+        probepoint_origins = np.column_stack((
+            np.asarray(self.probe_points[self.probe_points_drawn:count], dtype=float).reshape(-1, 2),
+            np.asarray(self.probe_values[self.probe_points_drawn:count], dtype=float) - self.probe_z_first))
+        probepoint_origins += current_cs_offset
 
-        probepoint_origin = (xy[0], xy[1], z)
-        probepoint_origin = np.add(probepoint_origin, current_cs_offset)
-        self.sim_dialog.simulator_widget.item_create(
-                "Star",
-                "probepoint_{}".format(len(self.probe_values)),
-                "simple3d",
-                probepoint_origin,
-                1,
-                4,
-                (0.6, 0.6, 0.6, 1))
+        self.sim_dialog.simulator_widget.draw_probepoints(probepoint_origins)
+        self.probe_points_drawn = count
 
-    def probe_load(self):
-        with open("probedata.txt", 'r') as f:
-            lines = f.read().split("\n")
+    def probe_load(self, name="default", resolution=None):
+        """
+        Loads a probe set saved by probe_done()
 
-        self.sim_dialog.simulator_widget.item_remove("probepoint_.+")
+        @param name
+        The name of the probe set, see lib/probedata.py. Can also be the
+        path of a probedata.txt written by earlier versions.
 
-        self.probe_points_count = 0
-        self.probe_points = []
-        self.probe_values = []
-        max_x = -999999
-        min_x = 999999
-        max_y = -999999
-        min_y = 999999
-        i = 0
-        for line in lines:
-            if (line.strip() == ""): continue
-            m = re.match('(........) (........) (........)', line)
-            x = float(m.group(1))
-            y = float(m.group(2))
-            z = float(m.group(3))
-            self.probe_points.append([x, y])
-            self.probe_values.append(z)
-            self.probe_points_count += 1
-            if (x > max_x):
-                max_x = x
-            if (x < min_x):
-                min_x = x
-            if (y > max_y):
-                max_y = y
-            if (y < min_y):
-                min_y = y
-            if (i == 0):
-                self.probe_z_first = z
-
-            self.draw_probepoint(self.probe_points[-1], self.probe_values[-1])
-            i += 1
-
-        if (len(self.probe_values) == 0):
-            self.log("probedata.txt was empty!", "red")
+        @param resolution
+        Distance in mm between heightmap vertices, see probe_start()
+        """
+        data = probedata.load(name)
+        if data is None:
+            self.log("<b>Could not load probe data {}</b>".format(name), "red")
             return
 
-        print("LLC", self.heightmap_llc)
-        print("URC", self.heightmap_urc)
-        print("DIM", self.heightmap_dim)
-        print("POINTS", self.probe_points)
-        print("VALUES", self.probe_values)
+        if len(data["values"]) == 0:
+            self.log("<b>Probe data {} has no probe points</b>".format(name), "red")
+            return
+
+        if data["cs"] is not None and data["cs"] != self.cs_names[self.current_cs]:
+            self.log("<b>Probe data {} was probed in {}, not in the current {}</b>".format(
+                name, data["cs"], self.cs_names[self.current_cs]), "orange")
+
+        self.sim_dialog.simulator_widget.remove_probepoints()
+        self.probe_points_drawn = 0
 
-        self._init_heightmap(max_x, max_y)
+        self.probe_points = data["points"].tolist()
+        self.probe_values = data["values"].tolist()
+        self.probe_points_count = len(self.probe_values)
+        self.probe_z_first = data["probe_z_first"]
+
+        print("LOADED {} PROBE POINTS".format(self.probe_points_count))
+
+        self.draw_probepoints()
+
+        self.probe_surface = ProbeSurface(self.probe_points, self.probe_values)
+        max_x, max_y = data["points"].max(axis=0)
+        self._init_heightmap(max_x, max_y, resolution)
 
         self.state_heightmap_dirty = True
 
-    def probe_done(self):
-        with open("probedata.txt", 'w') as f:
-            for i in range(0, len(self.probe_points)):
-                f.write("{:8.03f} {:8.03f} {:8.03f}\n".format(
-                    self.probe_points[i][0],
-                    self.probe_points[i][1],
-                    self.probe_values[i]))
+    def probe_done(self, name=None):
+        """
+        Ends probing and saves the probe set
+
+        @param name
+        The name of the probe set, by default the one given to
+        probe_start()
+        """
+        if name is None:
+            name = self.probe_name
+
+        fname = probedata.save(
+            name,
+            self.probe_points,
+            self.probe_values,
+            self.cs_names[self.current_cs],
+            self.probe_z_first)
 
         self.probe_points_count = None
 
-        self.log("<b>Probe data available in<br>self.probe_points and self.probe_values<br>and in probedata.txt.</b>", "orange")
+        self.log("<b>Probe data available in<br>self.probe_points and self.probe_values,<br>self.probe_surface<br>and in {}.</b>".format(fname), "orange")
 
-    def _init_heightmap(self, dimx, dimy):
+    def _init_heightmap(self, dimx, dimy, resolution=None):
         self.sim_dialog.simulator_widget.remove_heightmap()
 
-        dimx = round(dimx) + 1
-        dimy = round(dimy) + 1
+        # a heightmap still being interpolated has the old dimensions
+        self._heightmap_generation += 1
 
-        self.heightmap_dim = (dimx, dimy)
-        self.heightmap_llc = (0, 0)
-        self.heightmap_urc = (dimx, dimy)
+        if resolution is not None:
+            self.heightmap_resolution = resolution
 
-        self.heightmap_gldata = np.zeros(dimx * dimy, [("position", np.float32, 3), ("color", np.float32, 4)])
+        # vertices no more than heightmap_resolution apart, exactly on the edges
+        count_x = math.ceil(dimx / self.heightmap_resolution) + 1
+        count_y = math.ceil(dimy / self.heightmap_resolution) + 1
 
-        start_x = self.heightmap_llc[0]
-        end_x = self.heightmap_urc[0]
-        steps_x = (1 + dimx) * 1j
-
-        start_y = self.heightmap_llc[1]
-        end_y = self.heightmap_urc[1]
-        steps_y = (1 + dimy) * 1j
+        self.heightmap_dim = (count_x, count_y)
+        self.heightmap_llc = (0, 0)
+        self.heightmap_urc = (dimx, dimy)
 
-        grid = np.mgrid[start_x:end_x:steps_x, start_y:end_y:steps_y]
+        # vertex idx = y * count_x + x, like the grid is raveled
+        grid = np.meshgrid(
+            np.linspace(self.heightmap_llc[0], self.heightmap_urc[0], count_x),
+            np.linspace(self.heightmap_llc[1], self.heightmap_urc[1], count_y))
         self.heightmap_ipolgrid = (grid[0], grid[1]) # format required by interpolation
 
-    def probe_start(self, dimx, dimy, z_feed=50, z_expected_deviation=10):
+        # only Z changes when drawing
+        self.heightmap_gldata = np.zeros(count_x * count_y, [("position", np.float32, 3), ("color", np.float32, 4)])
+        self.heightmap_gldata["position"][:, 0] = grid[0].ravel()
+        self.heightmap_gldata["position"][:, 1] = grid[1].ravel()
+        self.heightmap_gldata["color"] = 1
+
+    def probe_start(self, dimx, dimy, z_feed=50, z_expected_deviation=10, mode="adaptive", tolerance=0.05, spacing=25, max_points=None, resolution=None, name="default"):
         """
         Probes area.
 
@@ -492,6 +536,32 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         @param z_expected_deviation
         Approximate difference in mm between the lowest Z and highest Z
         of the warped workpiece surface
+
+        @param mode
+        "adaptive": after the corners, probe where the interpolated
+        surface is least certain, until its estimated residual is below
+        `tolerance` everywhere and no point is further than `spacing`
+        from a probe point.
+        "grid": probe a grid with `spacing`, row by row in alternating
+        direction.
+        Probing ends by itself, or earlier with self.probe_done().
+
+        @param tolerance
+        In mm, see `mode`
+
+        @param spacing
+        In mm, see `mode`
+
+        @param max_points
+        Stop after this many probe points in any case
+
+        @param resolution
+        Distance in mm between the vertices of the drawn heightmap,
+        1 by default. Finer for small parts, coarser for big beds.
+
+        @param name
+        The name under which probe_done() saves the probe set, see
+        probe_load()
         """
 
         if round(self.wpos[0]) != 0 or round(self.wpos[1]) != 0:
@@ -502,20 +572,29 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.log("<b>For safety reasons, z_expected_deviation shouldn't be smaller than 5 or larger than 10 mm.</b>", "red")
             return
 
-        self._init_heightmap(dimx, dimy)
+        self._init_heightmap(dimx, dimy, resolution)
 
         self.probe_points = []
         self.probe_values = []
+        self.probe_surface = ProbeSurface()
+        self.sim_dialog.simulator_widget.remove_probepoints()
+        self.probe_points_drawn = 0
         self.probe_points_count = 0
+        self.probe_name = name
         self.probe_z_expected_deviation = z_expected_deviation
         self.probe_feed = z_feed
 
-        self.probe_points_planned = [  # all corners of area are pre-planned
-            (0, 0),
-            (dimx, 0),
-            (dimx, dimy),
-            (0, dimy)
-        ]
+        if mode == "grid":
+            self.probe_planner = None
+            self.probe_points_planned = probeplanner.serpentine_grid(dimx, dimy, spacing)[:max_points]
+        else:
+            self.probe_planner = probeplanner.AdaptivePlanner(dimx, dimy, tolerance, spacing, max_points=max_points)
+            self.probe_points_planned = [  # all corners of area are pre-planned
+                (0, 0),
+                (dimx, 0),
+                (dimx, dimy),
+                (0, dimy)
+            ]
 
         self.probe_z_at_probestart = self.wpos[2]
 
@@ -533,10 +612,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         new_x = pos[0]
         new_y = pos[1]
 
-        # fast lift by z_clear from last probe trigger point
-        lift_security_margin = 2
-        lift_z = self.probe_z_at_probestart + self.probe_z_expected_deviation + lift_security_margin
-        self.grbl.send_immediately("G0 Z{:0.3f}".format(lift_z))
+        self._probe_lift()
 
         # probe is now clear of any obstacles. do fast move to new probe coord.
         self.grbl.send_immediately("G0 X{} Y{}".format(new_x, new_y))
@@ -546,7 +622,11 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         self.grbl.send_immediately("G38.2 Z{:0.3f} F{}".format(probe_goto_z, self.probe_feed))
 
-
+    def _probe_lift(self):
+        # fast lift by z_clear from last probe trigger point
+        lift_security_margin = 2
+        lift_z = self.probe_z_at_probestart + self.probe_z_expected_deviation + lift_security_margin
+        self.grbl.send_immediately("G0 Z{:0.3f}".format(lift_z))
 
     def handle_probe_point(self, mpos):
         """
@@ -564,8 +644,9 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         probed_pos = np.subtract(mpos, current_cs_offset)
 
         # record probe points for interpolation
-        self.probe_points.append([round(probed_pos[0]), round(probed_pos[1])])
+        self.probe_points.append([round(probed_pos[0], 3), round(probed_pos[1], 3)])
         self.probe_values.append(round(probed_pos[2], 2))
+        self.probe_surface.add(self.probe_points[-1], self.probe_values[-1])
 
         if self.probe_points_count == 0:
             self.probe_z_first = round(probed_pos[2], 2)
@@ -576,45 +657,91 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         if self.probe_points_count < planned_points:
             # still planned points available
             nextpoint = self.probe_points_planned[self.probe_points_count]
+        elif self.probe_planner is not None:
+            nextpoint = self.probe_planner.next_point(self.probe_surface)
         else:
-            nx = random.randint(self.heightmap_llc[0], self.heightmap_urc[0])
-            ny = random.randint(self.heightmap_llc[1], self.heightmap_urc[1])
-            nextpoint = [nx, ny]
+            nextpoint = None
 
         self.state_heightmap_dirty = True
+
+        if nextpoint is None:
+            self._probe_lift()
+            if self.probe_planner is not None and self.probe_planner.max_residual is not None:
+                self.log("Probing done after {} points, estimated residual {:0.3f} mm".format(
+                    self.probe_points_count, self.probe_planner.max_residual), "orange")
+            self.probe_done()
+            return
+
         self.do_probe_point(nextpoint)
 
     def draw_heightmap(self):
+        """
+        Interpolates the heightmap in a worker thread, so that the UI stays
+        responsive, and draws it when done, see _on_heightmap_ready().
+        While the worker is busy, only the latest request is remembered,
+        and results which are stale by then are dropped.
+        """
         current_cs_offset = self.state_hash[self.cs_names[self.current_cs]]
 
         if len(self.probe_values) < 4:
             return  # at least 4, for suitable interpolation
 
-        # see http://docs.scipy.org/doc/scipy/reference/generated/scipy.interpolate.griddata.html
-        interpolated_z = griddata(
-            self.probe_points,
-            self.probe_values,
-            self.heightmap_ipolgrid,
-            method='cubic',
-            fill_value=-100)
-
-        # construct the vertex attributes in the format needed for pyglpainter
-        for y in range(0, self.heightmap_dim[1]):
-            for x in range(0, self.heightmap_dim[0]):
-                idx = y * self.heightmap_dim[0] + x
-                self.heightmap_gldata["position"][idx] = (x, y, interpolated_z[x][y])
-                self.heightmap_gldata["color"][idx] = (1, 1, 1, 1)
+        self._heightmap_generation += 1
+        if self._heightmap_busy:
+            self._heightmap_pending = True
+            return
 
         origin = (current_cs_offset[0] + self.heightmap_llc[0],
                   current_cs_offset[1] + self.heightmap_llc[1],
                   current_cs_offset[2] - self.probe_z_first
                   )
 
-        print("DRAWING HEIGHTMAP", origin, self.probe_points, self.probe_values)
-        self.sim_dialog.simulator_widget.draw_heightmap(
-                self.heightmap_gldata,
-                self.heightmap_dim,
-                origin)
+        # a snapshot, because probe points are still being added by the
+        # grbl thread, a point maybe without its value yet
+        points = self.probe_surface.points
+        values = self.probe_surface.values
+        count = min(len(points), len(values))
+
+        self._heightmap_busy = True
+        self._heightmap_executor.submit(
+            self._interpolate_heightmap,
+            self._heightmap_generation,
+            points[:count],
+            values[:count],
+            self.heightmap_ipolgrid,
+            self.heightmap_gldata,
+            origin)
+
+    def _interpolate_heightmap(self, generation, points, values, grid, gldata, origin):
+        # runs in the worker thread
+        try:
+            # the same as griddata(..., method='cubic')
+            interpolated_z = ProbeSurface(points, values)(grid, fill_value=-100)
+
+            # X, Y and color of the vertices were set up by _init_heightmap()
+            gldata = gldata.copy()
+            gldata["position"][:, 2] = interpolated_z.ravel()
+        except Exception as e:
+            self.logger.error("Heightmap interpolation failed: {}".format(e))
+            gldata = None
+
+        # queued, i.e. _on_heightmap_ready() runs in the GUI thread
+        self.heightmap_ready.emit(generation, gldata, origin)
+
+    def _on_heightmap_ready(self, generation, gldata, origin):
+        self._heightmap_busy = False
+
+        if gldata is not None and generation == self._heightmap_generation:
+            print("DRAWING HEIGHTMAP", origin, len(self.probe_points))
+            self.heightmap_gldata = gldata
+            self.sim_dialog.simulator_widget.draw_heightmap(
+                    self.heightmap_gldata,
+                    self.heightmap_dim,
+                    origin)
+
+        if self._heightmap_pending:
+            self._heightmap_pending = False
+            self.draw_heightmap()
 
     # CALLBACKS
 
@@ -672,25 +799,25 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         elif event == "on_processed_command":
             txt = "✓ Line {}: {}".format(data[0], data[1])
-            self._add_to_loginput(txt, "green")
+            self._add_to_loginput(txt, "green", "processed")
             self._current_grbl_line_number = int(data[0])
 
         elif event == "on_line_number_change":
             self._current_grbl_line_number = int(data[0])
 
         elif event == "on_error":
-            self._add_to_loginput("<b>◀ {}</b>".format(data[0]), "red")
+            self._add_to_loginput("<b>◀ {}</b>".format(data[0]), "red", "error")
             if data[2] > -1:
-                self._add_to_loginput("<b>✗ Error was in line {}: {}</b>".format(data[2], data[1]), "red")
+                self._add_to_loginput("<b>✗ Error was in line {}: {}</b>".format(data[2], data[1]), "red", "error")
 
         elif event == "on_alarm":
-            self._add_to_loginput("☹ " + data[0], "orange")
+            self._add_to_loginput("☹ " + data[0], "orange", "error")
 
         elif event == "on_read":
-            self._add_to_loginput("◀ {}".format(data[0]), "#000099")
+            self._add_to_loginput("◀ {}".format(data[0]), "#000099", "read")
 
         elif event == "on_write":
-            self._add_to_loginput("▶ {}".format(data[0]), "#990099")
+            self._add_to_loginput("▶ {}".format(data[0]), "#990099", "write")
 
         elif event == "on_log":
             colors = {
@@ -716,7 +843,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             else:
                 txt = message
 
-            self._add_to_loginput("✎ " + message, color)
+            self._add_to_loginput("✎ " + message, color, "log")
 
         elif event == "on_bufsize_change":
             # what = data[0]
@@ -862,6 +989,9 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         pos = self.sim_dialog.simulator_widget.get_buffer_marker_pos()
         self._add_to_logoutput("G1 G53 X{:0.3f} Y{:0.3f} Z{:0.3f}".format(pos[0], pos[1], pos[2]))
 
+    def event_stats(self):
+        self.log("<pre>{}</pre>".format(self.eventbus.report()))
+
     def on_second_tick(self):
         if not self.grbl.job_finished:
             self.label_runningtime.setText(self._secs_to_timestring(time.time() - self.job_run_timestamp))
@@ -871,8 +1001,33 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.label_eta.setText("---")
 
     def on_timer(self):
+        self.eventbus.dispatch()
+
         self.label_current_line_number.setText(str(self._current_grbl_line_number))
 
+        if self._write_stream_lines is not None:
+            # a few thousand lines per tick keep the UI responsive and still
+            # are far ahead of what the machine can process
+            try:
+                chunk = list(itertools.islice(self._write_stream_lines, 2000))
+            except (OSError, ValueError) as e:
+                # e.g. G-code which a transform of the stream doesn't
+                # support. The lines written so far are only part of the
+                # job, it must not be run.
+                self.grbl.job_halt()
+                self.new_job()
+                self.log("<b>Writing lines into the buffer failed, the buffer was cleared: {}</b>".format(e), "red")
+                self.statusBar.showMessage("Writing lines into the buffer failed!", 3000)
+            else:
+                if chunk:
+                    self.grbl.write(chunk)
+                else:
+                    self._write_stream_lines = None
+                    self.statusBar.showMessage("Writing lines into the buffer done!", 3000)
+                    if self._write_stream_pipeline is not None:
+                        self.log("<pre>{}</pre>".format(self._write_stream_pipeline.report()))
+                        self._write_stream_pipeline = None
+
         if self._put_buffer_marker_at_line_nr is not None:
             self.sim_dialog.simulator_widget.put_buffer_marker_at_line(self._put_buffer_marker_at_line_nr)
             self._put_buffer_marker_at_line_nr = None
@@ -892,7 +1047,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.state_stage_dirty = False
 
         if self.state_heightmap_dirty:
-            self.draw_probepoint(self.probe_points[-1], self.probe_values[-1])
+            self.draw_probepoints()
             self.draw_heightmap()
             self.state_heightmap_dirty = False
 
@@ -967,9 +1122,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
             self.changed_state = False
 
-        if self.changed_loginput:
-            self._render_logbuffer()
-            self.changed_loginput = False
+        self.logconsole.flush()
 
         if self._rx_buffer_fill_last != self._rx_buffer_fill:
             self.progressBar_buffer.setValue(self._rx_buffer_fill)
@@ -1112,7 +1265,21 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         fpath = filename_tuple[0]
         if fpath == "":
             return
-        self.grbl.load_file(fpath)
+
+        buffer_was_empty = self.grbl.buffer_size == 0
+        if self.pipeline:
+            # transformed line by line while being written into the buffer,
+            # without intermediate copies of the whole file
+            self.write_stream(self.pipeline(gcodetools.read_stream(fpath)))
+            self._write_stream_pipeline = self.pipeline
+            self.current_gcode_filepath = None
+        elif buffer_was_empty:
+            self.grbl.load_file(fpath)
+            self.current_gcode_filepath = fpath
+            self.current_gcode_buffer_size = self.grbl.buffer_size
+        else:
+            self.grbl.load_file(fpath)
+            self.current_gcode_filepath = None
         self._open_gcode_location = os.path.dirname(fpath)
         self.settings.setValue("open_gcode_location", self._open_gcode_location)
 
@@ -1465,18 +1632,52 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.label_jobtime.setText(self._secs_to_timestring(mins * 60))
 
     def bbox(self):
-        lines = gcodetools.bbox_draw(self.grbl.buffer).split("\n")
+        if (self.current_gcode_filepath is not None and
+                self.grbl.buffer_size == self.current_gcode_buffer_size):
+            # buffer holds nothing but the loaded file, the index knows its bbox
+            bb = gcodeindex.get(self.current_gcode_filepath)["bbox"]
+        else:
+            bb = gcodetools.bbox(self.grbl.buffer)
+
+        lines = gcodetools.bbox_draw(None, bb).split("\n")
         for line in lines:
             self.grbl.send_immediately(line)
 
-    def _render_logbuffer(self):
-        self.label_loginput.setText("<br />".join(self.logbuffer))
-        self.scrollArea_loginput.verticalScrollBar().setValue(self.scrollArea_loginput.verticalScrollBar().maximum())
+    def write_stream(self, lines):
+        """
+        Like self.grbl.write(), but for an iterable which yields lines while
+        they are being generated, e.g. pixel2laser.do_stream(). The lines are
+        written into the buffer in chunks on every timer tick, so that the
+        job can already be started while the rest is still being generated.
+
+        @param lines
+        An iterable of G-code lines
+        """
+        self._write_stream_lines = iter(lines)
+        self.statusBar.showMessage("Writing lines into the buffer...")
+
+    def bumpify(self, max_segment_length=None):
+        """
+        Adds the Z of the probed surface self.probe_surface to all moves
+        in the buffer. Instead of rewriting self.grbl.buffer in place, the
+        buffer is emptied and the bumpified lines are written back in
+        chunks by write_stream(), so the UI doesn't block on big jobs.
+
+        @param max_segment_length
+        Split longer moves into segments which follow the surface, see
+        gcodetools.bumpify_stream()
+        """
+        if self.probe_surface is None or len(self.probe_surface) < 3:
+            self.log("<b>Probe the surface first with self.probe_start()</b>", "red")
+            return
+
+        lines = list(self.grbl.buffer)
+        self.grbl.job_new()
+        self.current_gcode_filepath = None
+        self.write_stream(gcodetools.bumpify_stream(lines, self.wpos, self.probe_surface, max_segment_length=max_segment_length))
 
-    def _add_to_loginput(self, msg, color="black"):
-        html = "<span style='color: {}'>{}</span>".format(color, msg)
-        self.logbuffer.append(html)
-        self.changed_loginput = True
+    def _add_to_loginput(self, msg, color="black", kind="info"):
+        self.logconsole.append(kind, msg, color)
 
     def _add_to_logoutput(self, line):
         item = QListWidgetItem(line, self.listWidget_logoutput)
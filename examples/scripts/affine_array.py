@@ -0,0 +1,15 @@
+# Create a 10 x 10 array of the cat drawing, each copy scaled and rotated.
+
+# scale and rotation are combined into one transform, and the file is
+# parsed only once, so every copy is transformed in a single pass
+cat = gcodetools.GcodeProgram.read("examples/gcode/cat.ngc")
+cat.transform(gcodetools.Affine().scale_factor([0.2, 0.2, 0]).rotate2D([0, 0], 15)).to_origin()
+
+for i in range(0, 250, 25):
+    for j in range(0, 250, 25):
+        self.grbl.write(cat.copy().transform(gcodetools.Affine().translate([i, j, 0])).lines())
+
+# Affine.apply() works on lines of text too, and also transforms arcs
+# correctly under an inhomogeneous scale factor by splitting them:
+# circle = ["G0 X10 Y0", "G2 X10 Y0 I-10 J0"]
+# self.grbl.write(gcodetools.Affine().scale_factor([2, 1, 1]).apply(circle))
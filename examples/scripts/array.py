@@ -1,7 +1,10 @@
 # Read a simple square G-Code from a file and create an array of 10 x 10 of the same square
 
-sq = gcodetools.read("examples/gcode/square_offset.ngc")
+# the file is parsed only once, the copies are made by adding the offsets to the parsed numbers
+sq = gcodetools.GcodeProgram.read("examples/gcode/square_offset.ngc")
 
-for i in range(0, 200, 20):
-    for j in range(0, 200, 20):
-        self.grbl.write(gcodetools.translate(sq, [i, j, 0]))
+self.grbl.write(gcodetools.tile(sq, 10, 10, 20, 20))
+
+# the same, but every copy is the unchanged text after a G92 offset, in an
+# order which needs less rapid travel between the squares:
+# self.grbl.write(gcodetools.tile(sq, 10, 10, 20, 20, optimize_travel=True, preamble="G92"))
@@ -8,7 +8,12 @@ for i in range(0, 200, 20):
 probe_points = [[0, 0], [300, 0], [300, 300], [0, 300]]
 probe_values = [1, 200, 3, 100]
 
-# probe_points = self.probe_points
-# probe_values = self.probe_values
+# or the surface probed by self.probe_start(), which is not triangulated again:
+# self.grbl.buffer = gcodetools.bumpify(self.grbl.buffer, self.wpos, self.probe_surface)
 
-self.grbl.buffer = gcodetools.bumpify(self.grbl.buffer, self.wpos, probe_points, probe_values)
+# moves longer than 2 mm are split, so that they follow the surface in between
+self.grbl.buffer = gcodetools.bumpify(self.grbl.buffer, self.wpos, probe_points, probe_values, max_segment_length=2)
+
+# or, for big jobs, bumpify the buffer with self.probe_surface while
+# writing it back in chunks:
+# self.bumpify(max_segment_length=2)
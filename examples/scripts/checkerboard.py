@@ -1,11 +1,10 @@
 # Read arbitrary G-Code from a file and create a checkerboard array of 8 x 8
 
-cat = gcodetools.read("examples/gcode/cat.ngc")
+# the file is parsed only once, all copies are made from the parsed arrays
+cat = gcodetools.GcodeProgram.read("examples/gcode/cat.ngc")
 
-scaled_origin_cat = gcodetools.to_origin(gcodetools.scale_factor(cat, [0.2, 0.2, 0]))
+scaled_origin_cat = cat.scale_factor([0.2, 0.2, 0]).to_origin()
 
-for i in range(0, 200, 25):
-    for j in range(0, 200, 25):
-        x = 1 if j % 2 == 0 else 0
-        if i % 2 == x:
-            self.grbl.write(gcodetools.translate(scaled_origin_cat, [i, j, 0]))
+# the tile at the origin stays empty
+odd = lambda i, j: (i + j) % 2 == 1
+self.grbl.write(gcodetools.tile(scaled_origin_cat, 8, 8, 25, 25, pattern=odd, optimize_travel=True))
@@ -0,0 +1,17 @@
+# Transform every G-code file opened from now on while it is written into
+# the buffer, instead of rewriting self.grbl.buffer afterwards.
+# The timing of each stage is logged when the file is in the buffer.
+
+self.pipeline = gcodepipeline.Pipeline([
+    gcodepipeline.StripComments(),
+    gcodepipeline.ScaleFactor([0.5, 0.5, 1]),
+    gcodepipeline.Rotate2D([0, 0], 90),
+    gcodepipeline.Translate([100, 20, 0]),
+    gcodepipeline.FeedClamp(1500),
+    ])
+
+# with a probed surface, e.g. from self.probe_start():
+# self.pipeline.append(gcodepipeline.Bumpify(self.wpos, self.probe_surface, max_segment_length=2))
+
+# to open files unchanged again:
+# self.pipeline = None
@@ -3,4 +3,5 @@ self.grbl.preprocessor.do_fractionize_arcs = False
 
 self.grbl.write("S0")  # laser min
 self.grbl.write("M3")  # laser on
-self.grbl.write(pixel2laser.do("examples/patterntest.png", 10, 20, 0))
+# written into the buffer while the image is converted, the job can be started right away
+self.write_stream(pixel2laser.do_stream("examples/patterntest.png", 10, 20, 0))
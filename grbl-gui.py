@@ -21,19 +21,50 @@ along with pyglpainter. If not, see <https://www.gnu.org/licenses/>.
 """
 
 import argparse
+import glob
+import json
 import logging
+import os
 import sys
 import time
 
-from grbl_streamer import GrblStreamer
-
 from lib import pixel2laser as p2l
 from lib import gcodetools
+from lib import gcodeindex
 from lib import utility
+from lib import benchmark
+from lib import server
+from lib import streamjob
+
+
+def write_stream(lines, filename):
+    # The lines are only generated while writing, so an error may come up
+    # halfway through. Write next to the output and replace it only when
+    # done, which also leaves the input intact when it is the output.
+    directory, name = os.path.split(filename)
+    tmpname = os.path.join(directory, ".{}.tmp".format(name))
+    try:
+        utility.write_file_from_linearray(lines, tmpname)
+    except ValueError as e:
+        os.remove(tmpname)
+        print(e)
+        raise SystemExit(1)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+    os.replace(tmpname, filename)
+
+
+def power_levels(value):
+    levels = int(value)
+    if levels < 2:
+        raise argparse.ArgumentTypeError("needs at least 2 levels, got {}".format(levels))
+    return levels
 
-from PyQt6.QtWidgets import QApplication
 
-from classes.window import MainWindow
+def timestring(seconds):
+    return "{}:{:02d}:{:02d}".format(int(seconds // 3600), int(seconds % 3600 // 60), int(seconds % 60))
 
 
 def main():
@@ -67,9 +98,78 @@ def main():
         metavar='OUT_FILE',
         help='File to write the result to.'
         )
+    p2l_parser.add_argument(
+        '--jobs',
+        metavar='JOBS',
+        type=int,
+        default=1,
+        help='Number of processes encoding bands of the image in parallel'
+        )
+    p2l_parser.add_argument(
+        '--levels',
+        metavar='LEVELS',
+        type=power_levels,
+        help='Round the gray values to this many laser power levels'
+        )
+    p2l_parser.add_argument(
+        '--tolerance',
+        metavar='TOLERANCE',
+        type=int,
+        default=0,
+        help='Merge consecutive pixels whose gray values differ by at most this much. With --dither, keep the gray value as long as the accumulated error stays within this much'
+        )
+    p2l_parser.add_argument(
+        '--dither',
+        action='store_true',
+        help='Carry the rounding error on to the next pixels of the row (error diffusion). Needs a --tolerance of at least one level step to save lines'
+        )
+    p2l_parser.add_argument(
+        '--skip-gap',
+        metavar='MM',
+        type=float,
+        help='Cross white gaps within a row longer than this many mm with rapid moves'
+        )
+    p2l_parser.add_argument(
+        '--unidirectional',
+        action='store_true',
+        help='Laser all rows left to right instead of every other row right to left'
+        )
+    p2l_parser.add_argument(
+        '--xcorr',
+        metavar='MM',
+        type=float,
+        nargs='+',
+        default=[0],
+        help='X shift of the rows to compensate for laser lag. One value for both directions (ltr +, rtl -) or two values for ltr and rtl.'
+        )
+    p2l_parser.add_argument(
+        '--feed',
+        metavar='FEED',
+        type=float,
+        default=3000,
+        help='Feed rate in mm/min for the job time estimate'
+        )
+    p2l_parser.add_argument(
+        '--rapid',
+        metavar='RAPID',
+        type=float,
+        default=10000,
+        help='Rapid (G0) rate in mm/min for the job time estimate'
+        )
+    p2l_parser.add_argument(
+        '--lines-per-second',
+        metavar='RATE',
+        type=float,
+        default=300,
+        help='Rate at which the controller takes lines, for the job time estimate'
+        )
 
     # define arguments for the 'stream' subcommand
-    stream_parser = subparsers.add_parser("stream", help="Streams a gcode file to GRBL.")
+    stream_parser = subparsers.add_parser(
+        "stream",
+        help="Streams a gcode file to GRBL.",
+        epilog="Exits with 0 when the job completed, 1 on errors, 2 on an alarm, 3 when Grbl doesn't answer and 130 when interrupted."
+        )
     stream_parser.add_argument(
         'dev_node',
         metavar='DEV_NODE',
@@ -80,6 +180,36 @@ def main():
         metavar='GCODE_FILE',
         help='File to stream'
         )
+    stream_parser.add_argument(
+        '--baud',
+        metavar='BAUD',
+        type=int,
+        default=115200,
+        help='e.g. 9600'
+        )
+    stream_parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Send each line only after the last one was acknowledged, instead of keeping the receive buffer of Grbl full (character counting)'
+        )
+    stream_parser.add_argument(
+        '--rx-buffer',
+        metavar='BYTES',
+        type=int,
+        default=streamjob.RX_BUFFER_SIZE,
+        help='Size of the serial receive buffer of Grbl for character counting'
+        )
+    stream_parser.add_argument(
+        '--start-line',
+        metavar='LINE',
+        type=int,
+        help='Resume the job at this line of the file, counted from 1 like in the error messages. The modal state before it is restored, the spindle and the position are not'
+        )
+    stream_parser.add_argument(
+        '--fake',
+        action='store_true',
+        help='Stream to a fake Grbl on a pseudo terminal instead of DEV_NODE, for testing without a machine'
+        )
 
     # define arguments for the 'bbox' subcommand
     bbox_parser = subparsers.add_parser("bbox", help="Calculates the bounding box of a gcode file")
@@ -163,6 +293,59 @@ def main():
     # define arguments for the 'scale' subcommand
     to_origin_parser = subparsers.add_parser("2origin", help="Moves bottom left extremity of gcode to (0,0), z remains unaffected", parents=[parent_parser])
 
+    # define arguments for the 'benchmark' subcommand
+    benchmark_parser = subparsers.add_parser("benchmark", help="Measures the throughput of the G-code tools")
+    benchmark_parser.add_argument(
+        'target',
+        metavar='TARGET',
+        choices=['gcodetools', 'gcodeprogram', 'affine', 'pipeline', 'pixel2laser', 'stream'],
+        help='What to measure. One of: gcodetools, gcodeprogram, affine, pipeline, pixel2laser, stream'
+        )
+    benchmark_parser.add_argument(
+        '--file',
+        metavar='FILE',
+        help='G-code file, or image file for pixel2laser, to measure with. By default a raster laser job or image is synthesized.'
+        )
+    benchmark_parser.add_argument(
+        '--lines',
+        metavar='LINES',
+        type=int,
+        default=2000000,
+        help='Line count of the synthesized job'
+        )
+    benchmark_parser.add_argument(
+        '--size',
+        metavar='PIXELS',
+        type=int,
+        help='Width and height of the synthesized image for pixel2laser (default 5000), and of the image whose pixel2laser job is streamed for stream (default 300)'
+        )
+    benchmark_parser.add_argument(
+        '--repeat',
+        metavar='REPEAT',
+        type=int,
+        default=1,
+        help='Run each measurement this many times and report the best'
+        )
+    benchmark_parser.add_argument(
+        '--speed',
+        metavar='FACTOR',
+        type=float,
+        default=100,
+        help='For stream: the fake Grbl executes motions this many times faster than a machine'
+        )
+    benchmark_parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='For stream: send each line only after the last one was acknowledged'
+        )
+    benchmark_parser.add_argument(
+        '--grbl-version',
+        metavar='VERSION',
+        choices=['0.9', '1.1'],
+        default='1.1',
+        help='For stream: the protocol version of the fake Grbl, 0.9 or 1.1'
+        )
+
     # define arguments for the 'gui' subcommand
     gui_parser = subparsers.add_parser("gui", help="Start GUI")
     gui_parser.add_argument(
@@ -179,6 +362,87 @@ def main():
         default=115200
         )
 
+    # define arguments for the 'serve' subcommand
+    serve_parser = subparsers.add_parser("serve", help="Stream headless, controlled through a local socket")
+    serve_parser.add_argument(
+        '--path',
+        metavar='PATH',
+        default='/dev/ttyACM0',
+        help='e.g. /dev/ttyACM0'
+        )
+    serve_parser.add_argument(
+        '--baud',
+        metavar='BAUD',
+        type=int,
+        default=115200,
+        help='e.g. 9600'
+        )
+    serve_parser.add_argument(
+        '--socket',
+        metavar='SOCKET',
+        default=server.DEFAULT_SOCKET,
+        help='Path of the Unix socket to listen on'
+        )
+    serve_parser.add_argument(
+        '--fake',
+        action='store_true',
+        help='Connect to a fake Grbl on a pseudo terminal instead of PATH, for testing without a machine'
+        )
+
+    # define arguments for the 'fakegrbl' subcommand
+    fakegrbl_parser = subparsers.add_parser("fakegrbl", help="Simulate Grbl on a pseudo terminal, for testing without a machine")
+    fakegrbl_parser.add_argument(
+        '--timed',
+        action='store_true',
+        help='Model the serial line, receive buffer and planner of an Arduino instead of answering at once'
+        )
+    fakegrbl_parser.add_argument(
+        '--speed',
+        metavar='FACTOR',
+        type=float,
+        default=1,
+        help='With --timed, execute motions this many times faster than a machine'
+        )
+    fakegrbl_parser.add_argument(
+        '--baud',
+        metavar='BAUD',
+        type=int,
+        default=115200,
+        help='With --timed, the baud rate of the serial line'
+        )
+    fakegrbl_parser.add_argument(
+        '--grbl-version',
+        metavar='VERSION',
+        choices=['0.9', '1.1'],
+        default='1.1',
+        help='The protocol version, 0.9 or 1.1'
+        )
+
+    # define arguments for the 'ctl' subcommand
+    ctl_parser = subparsers.add_parser(
+        "ctl",
+        help="Send a command to a running 'serve'",
+        epilog="EXAMPLE: python ./grbl-gui.py ctl load $PWD/job.ngc; python ./grbl-gui.py ctl run"
+        )
+    ctl_parser.add_argument(
+        'command',
+        metavar='COMMAND',
+        choices=['status', 'load', 'run', 'halt', 'hold', 'resume', 'abort', 'killalarm', 'feed', 'send', 'events', 'shutdown'],
+        help='One of: status, load FILE, run [LINE], halt, hold, resume, abort, killalarm, feed [FEED], send GCODE, events, shutdown'
+        )
+    ctl_parser.add_argument(
+        'argument',
+        metavar='ARGUMENT',
+        nargs='?',
+        help='The file for load (a path on the server), the line number for run, the feed for feed (none stops overriding it), the G-code for send'
+        )
+    ctl_parser.add_argument(
+        '--socket',
+        metavar='SOCKET',
+        default=server.DEFAULT_SOCKET,
+        help='Path of the Unix socket of the server'
+        )
+
     args = parser.parse_args()
 
     if len(sys.argv) < 2:
@@ -188,38 +452,62 @@ def main():
     subcmd = sys.argv[1]
 
     if subcmd == "pixel2laser":
-        gcode = p2l.do(args.in_file)
-        f = open(args.out_file, 'w')
-        f.write(gcode)
-        f.close()
+        pixels = p2l.quantize(p2l.read(args.in_file), args.levels, args.tolerance, args.dither)
+        xcorr = args.xcorr[0] if len(args.xcorr) == 1 else tuple(args.xcorr[:2])
+
+        # the lines are written while the image is being converted
+        gcode = p2l.encode_stream(
+            pixels, xcorr=xcorr, workers=args.jobs,
+            skip_gap=args.skip_gap, bidirectional=not args.unidirectional)
+        stats = {}
+        write_stream((line + "\n" for line in p2l.count_stream(gcode, stats)), args.out_file)
+
+        seconds = p2l.job_time(stats, args.feed, args.rapid, args.lines_per_second)
+        print("{} lines, estimated job time {} at F{:g}".format(stats["lines"], timestring(seconds), args.feed))
+
+        if args.skip_gap is not None or args.unidirectional:
+            # compare with the plain serpentine raster
+            plain = {}
+            for line in p2l.count_stream(p2l.encode_stream(pixels, xcorr=xcorr, workers=args.jobs), plain):
+                pass
+            plain_seconds = p2l.job_time(plain, args.feed, args.rapid, args.lines_per_second)
+            saved = plain_seconds - seconds
+            print("{} {} ({:.0f}%) compared to {} of the plain raster".format(
+                "Saves" if saved >= 0 else "Takes longer by", timestring(abs(saved)),
+                100 * abs(saved) / plain_seconds, timestring(plain_seconds)))
 
     elif subcmd == "stream":
-        grbl = GrblStreamer("grbl1", args.dev_node)
-        grbl.cnect()
-        time.sleep(1)
-        src = "out.ngc"
-        grbl.send(src)
+        path = args.dev_node
+        if args.fake:
+            from lib.fakegrbl import FakeGrbl
+            fake = FakeGrbl()
+            path = fake.start()
+        job = streamjob.StreamJob(path, args.gcodefile, args.baud, args.incremental, args.rx_buffer, start_line=args.start_line - 1 if args.start_line else 0)
+        sys.exit(job.run())
 
     elif subcmd == "bbox":
-        lines = utility.read_file_to_linearray(args.gcodefile)
-
-        bbox = gcodetools.get_bbox(lines)
-        print("BBOX: {}".format(bbox))
+        # instant when the sidecar index of the file is still valid
+        index = gcodeindex.get(args.gcodefile)
+        print("BBOX: {}".format(index["bbox"]))
+        for cs, kinds in sorted(index["bboxes"].items()):
+            for kind, bbox in sorted(kinds.items()):
+                print("BBOX {} {}: {}".format(cs, kind, bbox))
 
     elif subcmd == "translate":
-        lines = utility.read_file_to_linearray(args.infile)
-        result = gcodetools.translate(
+        # streams file -> transform -> file with constant memory
+        lines = utility.iterate_file_lines(args.infile)
+        result = gcodetools.translate_stream(
                 lines,
                 [
                     float(args.offset_x),
                     float(args.offset_y),
                     float(args.offset_z)
                 ])
-        utility.write_file_from_linearray(result, args.outfile)
+        write_stream(result, args.outfile)
 
     elif subcmd == "scale_factor":
-        lines = utility.read_file_to_linearray(args.infile)
-        result = gcodetools.scale_factor(
+        lines = utility.iterate_file_lines(args.infile)
+        result = gcodetools.scale_factor_stream(
                 lines,
                 [
                     float(args.scale_x),
@@ -227,24 +515,116 @@ def main():
                     float(args.scale_z)
                 ],
                 False)
-        utility.write_file_from_linearray(result, args.outfile)
+        write_stream(result, args.outfile)
 
     elif subcmd == "scale_into":
-        lines = utility.read_file_to_linearray(args.infile)
-        result = gcodetools.scale_into(
+        # the bbox comes from the index, so the file is streamed only once
+        bb = gcodeindex.get(args.infile)["bbox"]
+        lines = utility.iterate_file_lines(args.infile)
+        result = gcodetools.scale_into_stream(
                 lines,
                 float(args.width),
                 float(args.height),
                 float(args.depth),
-                False)
-        utility.write_file_from_linearray(result, args.outfile)
+                False,
+                bb)
+        write_stream(result, args.outfile)
 
     elif subcmd == "2origin":
-        lines = utility.read_file_to_linearray(args.infile)
-        result = gcodetools.move_to_origin(lines)
-        utility.write_file_from_linearray(result, args.outfile)
+        bb = gcodeindex.get(args.infile)["bbox"]
+        lines = utility.iterate_file_lines(args.infile)
+        result = gcodetools.translate_stream(lines, [-(bb[0][0] or 0), -(bb[1][0] or 0), 0])
+        write_stream(result, args.outfile)
+
+    elif subcmd == "benchmark" and args.target == "pixel2laser":
+        if args.file:
+            pixels = p2l.read(args.file)
+        else:
+            pixels = benchmark.raster_image(args.size or 5000)
+        benchmark.pixel2laser_encode(pixels, args.repeat)
+
+    elif subcmd == "benchmark" and args.target == "stream":
+        if not benchmark.streaming_small_files(args.incremental):
+            raise SystemExit(1)
+        if args.file:
+            benchmark.streaming([args.file], args.speed, args.incremental, version=args.grbl_version)
+        else:
+            fnames = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples", "gcode", "*.ngc")))
+            p2l_fname = benchmark.pixel2laser_file(args.size or 300)
+            try:
+                benchmark.streaming(fnames + [p2l_fname], args.speed, args.incremental, version=args.grbl_version)
+            finally:
+                os.remove(p2l_fname)
+                if os.path.exists(gcodeindex.index_path(p2l_fname)):
+                    os.remove(gcodeindex.index_path(p2l_fname))
+
+    elif subcmd == "benchmark":
+        if args.file:
+            lines = gcodetools.read(args.file)
+        else:
+            lines = benchmark.laser_job(args.lines)
+        print("{} lines".format(len(lines)))
+
+        if args.target == "gcodetools":
+            benchmark.gcodetools_transforms(lines, args.repeat)
+        elif args.target == "gcodeprogram":
+            benchmark.gcodeprogram_transforms(lines, args.repeat)
+        elif args.target == "affine":
+            benchmark.affine_transforms(lines, args.repeat)
+        elif args.target == "pipeline":
+            benchmark.gcode_pipeline(lines, args.repeat)
+
+    elif subcmd == "serve":
+        # the libraries log every streamed line on INFO, too much for a small computer
+        logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(message)s')
+        logging.getLogger('grbl-gui').setLevel(logging.INFO)
+        path = args.path
+        if args.fake:
+            from lib.fakegrbl import FakeGrbl
+            fake = FakeGrbl()
+            path = fake.start()
+        server.StreamServer(path, args.baud, args.socket).run()
+
+    elif subcmd == "fakegrbl":
+        from lib.fakegrbl import FakeGrbl
+        if args.timed:
+            fake = FakeGrbl.timed(args.speed, args.grbl_version, args.baud)
+        else:
+            fake = FakeGrbl(version=args.grbl_version)
+        print("Grbl {} on {}, stop with Ctrl-C".format(args.grbl_version, fake.start()))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print(fake.report())
+            fake.stop()
+
+    elif subcmd == "ctl":
+        cmd_args = {}
+        if args.command == "load" and args.argument:
+            cmd_args["file"] = args.argument
+        elif args.command == "run" and args.argument:
+            cmd_args["line"] = int(args.argument)
+        elif args.command == "feed" and args.argument and args.argument != "none":
+            cmd_args["value"] = float(args.argument)
+        elif args.command == "send":
+            cmd_args["line"] = args.argument
+        try:
+            answer = server.request(args.command, args.socket, **cmd_args)
+        except OSError as e:
+            print("Cannot reach the server on {}: {}".format(args.socket, e))
+            raise SystemExit(1)
+        if "report" in answer:
+            print(answer.pop("report"))
+        print(json.dumps(answer, indent=2))
+        if not answer["ok"]:
+            raise SystemExit(1)
 
     elif subcmd == "gui":
+        # Qt is only needed for the GUI, serve runs without it
+        from PyQt6.QtWidgets import QApplication
+        from classes.window import MainWindow
+
         app = QApplication(sys.argv)
         window = MainWindow(args.path, int(args.baud))
         window.show()
@@ -0,0 +1,272 @@
+"""
+grbl-gui - Graphical User Interface for the "grbl" CNC controller
+Copyright (C) 2015 Michael Franzl
+
+This file is part of grbl-gui.
+
+grbl-gui is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+grbl-gui is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with pyglpainter. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# simple throughput measurements of the library functions
+
+import io
+import os
+import random
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from . import gcodetools
+from . import gcodepipeline
+from . import pixel2laser
+from . import streamjob
+from .fakegrbl import FakeGrbl
+
+
+def laser_job(line_count, width=300, dpmm=10, seed=1):
+    '''
+    Synthesizes a raster laser job in the style of pixel2laser output,
+    i.e. mostly short X moves with changing S words.
+    '''
+    rnd = random.Random(seed)
+    unit_length = 1 / dpmm
+    pixels_per_row = width * dpmm
+
+    lines = ["S0", "G0 X0 Y0", "G1"]
+    for i in range(line_count - len(lines)):
+        row, col = divmod(i, pixels_per_row)
+        if col == 0:
+            lines.append("Y{:g}".format(row * unit_length))
+        else:
+            lines.append("X{:g} S{:d}".format(col * unit_length, rnd.randint(0, 255)))
+    return lines
+
+
+def raster_image(size, levels=16, seed=1):
+    '''
+    Synthesizes a square grayscale bitmap in the style of a photo with
+    `levels` gray levels on a white background, as a 2D uint8 array.
+    '''
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    image = np.zeros((size, size))
+    for _ in range(4):
+        fx, fy, phase = rng.uniform(1, 8), rng.uniform(1, 8), rng.uniform(0, 2 * np.pi)
+        image += np.sin(2 * np.pi * (fx * x + fy * y) + phase)
+    image = (image - image.min()) / (image.max() - image.min())
+    image = np.round(image * (levels - 1)) * (255 // (levels - 1))
+    pixels = image.astype(np.uint8)
+
+    # white margins and a white band, like around and inside a motif
+    margin = size // 10
+    pixels[:margin] = 255
+    pixels[-margin:] = 255
+    pixels[:, :margin] = 255
+    pixels[:, -margin:] = 255
+    pixels[size // 2:size // 2 + margin] = 255
+    return pixels
+
+
+def measure(fn, line_count, repeat=1):
+    '''
+    Calls fn() `repeat` times and returns the best lines per second.
+    '''
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t
+        best = dt if best is None or dt < best else best
+    return line_count / best
+
+
+def report(name, lines_per_second):
+    print("{:24s} {:12.0f} lines/s".format(name, lines_per_second))
+
+
+def gcodetools_transforms(lines, repeat=1):
+    '''
+    Measures the throughput of the gcodetools transforms on `lines`
+    '''
+    count = len(lines)
+    probe_points = [[0, 0], [300, 0], [300, 300], [0, 300], [150, 150]]
+    probe_values = [0, 1, 2, 3, 1]
+
+    report("tokenize", measure(lambda: [gcodetools.tokenize(l) for l in lines], count, repeat))
+    report("translate", measure(lambda: gcodetools.translate(lines, [1, 2, 0]), count, repeat))
+    report("scale_factor", measure(lambda: gcodetools.scale_factor(lines, [2, 2, 2]), count, repeat))
+    report("rotate2D", measure(lambda: gcodetools.rotate2D(lines, [0, 0], 30), count, repeat))
+    report("bbox", measure(lambda: gcodetools.bbox(lines), count, repeat))
+    report("bumpify", measure(lambda: gcodetools.bumpify(list(lines), (0, 0, 0), probe_points, probe_values), count, repeat))
+    report("bumpify 1 mm segments", measure(lambda: gcodetools.bumpify(list(lines), (0, 0, 0), probe_points, probe_values, max_segment_length=1), count, repeat))
+
+
+def gcodeprogram_transforms(lines, repeat=1):
+    '''
+    Measures the throughput of GcodeProgram, chaining the transforms like
+    the checkerboard example script does
+    '''
+    count = len(lines)
+    program = gcodetools.GcodeProgram(lines)
+
+    report("GcodeProgram parse", measure(lambda: gcodetools.GcodeProgram(lines), count, repeat))
+    report("GcodeProgram transforms", measure(lambda: program.copy().scale_factor([0.2, 0.2, 0]).to_origin().translate([1, 2, 0]).rotate2D([0, 0], 30), count, repeat))
+    report("GcodeProgram lines", measure(lambda: program.copy().translate([1, 2, 0]).lines(), count, repeat))
+    report("tile 10 x 10", measure(lambda: gcodetools.tile(program, 10, 10, 25, 25), 100 * count, repeat))
+    report("tile 10 x 10 G92", measure(lambda: gcodetools.tile(program, 10, 10, 25, 25, preamble="G92"), 100 * count, repeat))
+
+
+def affine_transforms(lines, repeat=1):
+    '''
+    Measures scale, rotate and translate as one gcodetools.Affine against
+    the chained gcodetools functions
+    '''
+    count = len(lines)
+    affine = gcodetools.Affine().scale_factor([0.2, 0.2, 1]).rotate2D([0, 0], 30).translate([1, 2, 0])
+    program = gcodetools.GcodeProgram(lines)
+
+    report("chained functions", measure(lambda: gcodetools.translate(gcodetools.rotate2D(gcodetools.scale_factor(lines, [0.2, 0.2, 1]), [0, 0], 30), [1, 2, 0]), count, repeat))
+    report("Affine apply", measure(lambda: affine.apply(lines), count, repeat))
+    report("GcodeProgram transform", measure(lambda: program.copy().transform(affine).lines(), count, repeat))
+
+
+def gcode_pipeline(lines, repeat=1):
+    '''
+    Measures a pipeline of transforms against the same transforms as
+    chained gcodetools generators
+    '''
+    count = len(lines)
+    probe_points = [[0, 0], [300, 0], [300, 300], [0, 300], [150, 150]]
+    probe_values = [0, 1, 2, 3, 1]
+
+    def chained():
+        stream = gcodetools.translate_stream(lines, [1, 2, 0])
+        stream = gcodetools.scale_factor_stream(stream, [2, 2, 2])
+        stream = gcodetools.rotate2D_stream(stream, [0, 0], 30)
+        stream = gcodetools.bumpify_stream(stream, (0, 0, 0), probe_points, probe_values)
+        for line in stream:
+            pass
+
+    pipeline = gcodepipeline.Pipeline([
+        gcodepipeline.Translate([1, 2, 0]),
+        gcodepipeline.ScaleFactor([2, 2, 2]),
+        gcodepipeline.Rotate2D([0, 0], 30),
+        gcodepipeline.Bumpify((0, 0, 0), probe_points, probe_values),
+        ])
+
+    def piped():
+        for line in pipeline(lines):
+            pass
+
+    report("chained generators", measure(chained, count, repeat))
+    report("pipeline", measure(piped, count, repeat))
+    print(pipeline.report())
+
+
+def pixel2laser_encode(pixels, repeat=1):
+    '''
+    Measures the throughput of pixel2laser on the bitmap `pixels`
+    '''
+    count = pixels.size
+    lines = pixel2laser.encode(pixels, 10, 20, 0)
+    print("{} pixels, {} lines".format(count, len(lines)))
+
+    rate = measure(lambda: pixel2laser.encode(pixels, 10, 20, 0), count, repeat)
+    print("{:24s} {:12.0f} pixels/s".format("pixel2laser encode", rate))
+
+
+def pixel2laser_file(size, dpmm=10):
+    '''
+    Writes the pixel2laser job of a synthesized image of `size` x `size`
+    pixels into a temporary file and returns its path
+    '''
+    lines = pixel2laser.encode(raster_image(size), dpmm)
+    fd, fname = tempfile.mkstemp(prefix="pixel2laser-", suffix=".ngc")
+    with os.fdopen(fd, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return fname
+
+
+def streaming(fnames, speed=100, incremental=False, baud=115200, version="1.1"):
+    '''
+    Streams the G-code files `fnames` through GrblStreamer, the way the
+    stream subcommand does, to a FakeGrbl with the timing of an Arduino
+    whose motions run `speed` times faster than in reality. Reports per
+    file:
+
+    lines/s: end to end, from the first line sent to the last "ok"
+    RX: how full Grbl's receive buffer was on average
+    planner: the share of the time Grbl had motions to execute
+    dispatch: the longest handling of the events of one timer tick
+    latency: how long events waited to be handled, on average
+    lost: bytes lost because the receive buffer overflowed
+    '''
+    print("{:24s} {:>8s} {:>10s} {:>5s} {:>8s} {:>11s} {:>11s} {:>6s}".format(
+        "file", "lines", "lines/s", "RX", "planner", "dispatch", "latency", "lost"))
+    for fname in fnames:
+        fake = FakeGrbl.timed(speed=speed, baud=baud, version=version)
+        job = streamjob.StreamJob(fake.start(), fname, baud, incremental, out=io.StringIO(), timing=True)
+        try:
+            code = job.run()
+        finally:
+            fake.stop()
+
+        if code != streamjob.EXIT_OK:
+            print("{:24s} failed with exit code {}".format(os.path.basename(fname)[:24], code))
+            continue
+
+        motion = (fake.last_motion - fake.first_motion) if fake.first_motion is not None else 0
+        latency = job.eventbus.latency
+        print("{:24s} {:8d} {:10.0f} {:4.0f}% {:7.0f}% {:8.1f} ms {:8.2f} ms {:6d}".format(
+            os.path.basename(fname)[:24], job.processed, job.processed / job.seconds if job.seconds > 0 else 0,
+            job.rx_buffer_average, 100 * fake.busy_seconds / motion if motion > 0 else 0,
+            1000 * job.eventbus.dispatch_seconds[2], 1000 * latency[1] / latency[0] if latency[0] else 0,
+            fake.overflows))
+
+
+def streaming_small_files(incremental=False, timeout=20):
+    '''
+    Streams jobs of 0, 1 and 2 lines to an instant FakeGrbl and reports
+    whether each ended with exit code 0. Returns whether all did. These
+    end before character counting gets going, which is where the end
+    of a job used to be missed.
+    '''
+    passed = True
+    for count in (0, 1, 2):
+        fd, fname = tempfile.mkstemp(prefix="stream-{}-".format(count), suffix=".ngc")
+        with os.fdopen(fd, "w") as f:
+            f.write("".join("G1 X{} F100\n".format(i + 1) for i in range(count)))
+
+        fake = FakeGrbl()
+        job = streamjob.StreamJob(fake.start(), fname, incremental=incremental, out=io.StringIO())
+        result = []
+        # a daemon thread, so that a job which never ends is left behind
+        thread = threading.Thread(target=lambda: result.append(job.run()), daemon=True)
+        thread.start()
+        thread.join(timeout)
+        if result:
+            fake.stop()
+        for name in (fname, fname + ".idx"):
+            if os.path.exists(name):
+                os.remove(name)
+
+        if result:
+            outcome = "ok" if result[0] == streamjob.EXIT_OK else "exit code {}".format(result[0])
+        else:
+            outcome = "hangs" if thread.is_alive() else "fails"
+        passed = passed and outcome == "ok"
+        print("{:24s} {}".format("{} line job".format(count), outcome))
+    return passed
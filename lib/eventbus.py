@@ -0,0 +1,188 @@
+"""
+grbl-gui - Graphical User Interface for the "grbl" CNC controller
+Copyright (C) 2015 Michael Franzl
+
+This file is part of grbl-gui.
+
+grbl-gui is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+grbl-gui is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with pyglpainter. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# GrblStreamer calls its callback from its serial reader thread, once
+# per line it reads or writes. The EventBus takes these calls instead,
+# queues them, and hands them to the actual handler in batches when
+# `dispatch()` is called, e.g. from a GUI timer, so that the handler
+# always runs in the same thread and at a bounded rate. Events which must
+# not wait for the next batch, e.g. alarms, can wake up the dispatching
+# thread instead.
+
+import collections
+import logging
+import threading
+import time
+
+
+# events of which only the latest one matters, e.g. the machine
+# position. While one of these is queued, newer ones replace its data.
+COALESCED = frozenset((
+    "on_stateupdate",
+    "on_hash_stateupdate",
+    "on_gcode_parser_stateupdate",
+    "on_feed_change",
+    "on_bufsize_change",
+    "on_rx_buffer_percent",
+    "on_progress_percent",
+    "on_line_number_change",
+    "on_line_sent",
+    "on_movement",
+    ))
+
+# events which are dispatched as soon as possible, together with all
+# events queued before them, rather than with the next batch
+URGENT = frozenset((
+    "on_alarm",
+    "on_error",
+    "on_standstill",
+    ))
+
+
+class EventBus:
+    """
+    Pass `post` as the callback to GrblStreamer, and call `dispatch()`
+    periodically.
+
+    `counters` holds the number of posted events per event name,
+    `coalesced` the number of them which were replaced by a newer one
+    before they were dispatched, and `dispatched` the number passed to
+    the handler.
+
+    With `timing`, the seconds from posting an event to handling it are
+    added up in `latency`, and the seconds spent in `dispatch()` calls
+    in `dispatch_seconds`, see `report()`.
+    """
+
+    def __init__(self, handler, coalesce=COALESCED, max_batch=10000, timing=False, urgent=URGENT, wakeup=None):
+        """
+        @param handler
+        Called as handler(event, *data) for every dispatched event
+
+        @param coalesce
+        The names of the events of which only the latest is dispatched
+
+        @param max_batch
+        The most events to dispatch per `dispatch()` call. Others stay
+        queued for the next call.
+
+        @param timing
+        Measure the latency of events and the duration of dispatching
+
+        @param urgent
+        The names of the events for which `wakeup` is called
+
+        @param wakeup
+        Called without arguments in the posting thread when an urgent
+        event was queued. It should make the dispatching thread call
+        `dispatch()` right away, e.g. by emitting a queued Qt signal.
+        """
+        self.logger = logging.getLogger('grbl-gui')
+        self.handler = handler
+        self.coalesce = coalesce
+        self.max_batch = max_batch
+        self.urgent = urgent
+        self.wakeup = wakeup
+
+        self.counters = collections.Counter()
+        self.coalesced = collections.Counter()
+        self.dispatched = collections.Counter()
+
+        self.timing = timing
+        # [count, sum, max]
+        self.latency = [0, 0, 0]
+        self.dispatch_seconds = [0, 0, 0]
+
+        self._lock = threading.Lock()
+        # (event, data, time posted) in order, where data is None for
+        # coalesced events, whose latest data is in self._latest
+        self._queue = collections.deque()
+        self._latest = {}
+
+    def post(self, event, *data):
+        """
+        Queues an event. Can be called from any thread.
+        """
+        t = time.perf_counter() if self.timing else 0
+        with self._lock:
+            self.counters[event] += 1
+            if event in self.coalesce:
+                if event in self._latest:
+                    self.coalesced[event] += 1
+                else:
+                    # dispatched at the position of the oldest one
+                    self._queue.append((event, None, t))
+                self._latest[event] = data
+            else:
+                self._queue.append((event, data, t))
+        if self.wakeup is not None and event in self.urgent:
+            self.wakeup()
+
+    def pending(self):
+        return len(self._queue)
+
+    def dispatch(self):
+        """
+        Calls the handler for the queued events, in the thread calling
+        this. Returns the number of dispatched events.
+        """
+        start = time.perf_counter() if self.timing else 0
+        count = 0
+        while count < self.max_batch:
+            with self._lock:
+                if len(self._queue) == 0:
+                    break
+                event, data, posted = self._queue.popleft()
+                if data is None:
+                    data = self._latest.pop(event)
+
+            count += 1
+            self.dispatched[event] += 1
+            if self.timing:
+                _add(self.latency, time.perf_counter() - posted)
+            try:
+                self.handler(event, *data)
+            except Exception:
+                # one failing event must not keep the others from being dispatched
+                self.logger.exception("EventBus: Handling {} failed".format(event))
+
+        if self.timing:
+            _add(self.dispatch_seconds, time.perf_counter() - start)
+        return count
+
+    def report(self):
+        """
+        Returns the counters as text, one line per event name
+        """
+        rows = ["{:28s} {:>10s} {:>10s} {:>10s}".format("event", "posted", "coalesced", "dispatched")]
+        for event, count in sorted(self.counters.items()):
+            rows.append("{:28s} {:10d} {:10d} {:10d}".format(event, count, self.coalesced[event], self.dispatched[event]))
+        if self.timing:
+            for name, (count, total, longest) in (("latency", self.latency), ("dispatch", self.dispatch_seconds)):
+                if count:
+                    rows.append("{:28s} {:8.2f} ms mean {:8.2f} ms max".format(name, 1000 * total / count, 1000 * longest))
+        return "\n".join(rows)
+
+
+def _add(stats, value):
+    stats[0] += 1
+    stats[1] += value
+    if value > stats[2]:
+        stats[2] = value
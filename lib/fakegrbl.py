@@ -0,0 +1,486 @@
+"""
+grbl-gui - Graphical User Interface for the "grbl" CNC controller
+Copyright (C) 2015 Michael Franzl
+
+This file is part of grbl-gui.
+
+grbl-gui is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+grbl-gui is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with pyglpainter. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# A fake Grbl controller behind a pseudo terminal, so that everything
+# which talks to a serial port, e.g. GrblStreamer, can be run without a
+# machine:
+#
+#     fake = FakeGrbl()
+#     fake.start()
+#     grbl.cnect(fake.path)
+#
+# It answers like Grbl 1.1 or 0.9 to realtime commands, $ commands and
+# G-code, and keeps track of the position. By default everything happens
+# at once. With `timed()`, it models the serial line, the receive buffer
+# and the planner of an Arduino running Grbl, so that the throughput of
+# streaming can be measured:
+#
+#     fake = FakeGrbl.timed(speed=10)
+#
+# - bytes arrive at the rate of the baud rate, 10 bits per byte
+# - bytes which don't fit into the receive buffer are lost, like on the
+#   Arduino, and counted in `overflows`
+# - parsing a line takes `line_time` seconds, and a line is parsed only
+#   when the planner has a free block. "ok" is sent after parsing.
+# - a motion takes its length divided by its feed, or by the rapid rate
+#   ($110) for G0, divided by `speed`. Acceleration is ignored.
+#
+# Probe moves, G10 and $ commands take no time.
+
+import collections
+import logging
+import math
+import os
+import select
+import threading
+import time
+import tty
+
+from . import gcodetools
+
+
+# $$ settings, the last one is the one GrblStreamer waits for
+_settings = (
+    (0, "10", "step pulse, usec"),
+    (1, "25", "step idle delay, msec"),
+    (10, "1", "status report mask"),
+    (11, "0.010", "junction deviation, mm"),
+    (12, "0.002", "arc tolerance, mm"),
+    (13, "0", "report inches"),
+    (20, "0", "soft limits"),
+    (21, "0", "hard limits"),
+    (22, "0", "homing cycle"),
+    (30, "1000", "max spindle speed, RPM"),
+    (100, "250.000", "x step/mm"),
+    (101, "250.000", "y step/mm"),
+    (102, "250.000", "z step/mm"),
+    (110, "3000.000", "x max rate, mm/min"),
+    (111, "3000.000", "y max rate, mm/min"),
+    (112, "500.000", "z max rate, mm/min"),
+    (120, "100.000", "x accel, mm/sec^2"),
+    (121, "100.000", "y accel, mm/sec^2"),
+    (122, "100.000", "z accel, mm/sec^2"),
+    (130, "300.000", "x max travel, mm"),
+    (131, "300.000", "y max travel, mm"),
+    (132, "100.000", "z max travel, mm"),
+    )
+
+_coordinate_systems = ("G54", "G55", "G56", "G57", "G58", "G59")
+
+# the texts of the error codes of Grbl 0.9
+_errors_09 = {
+    2: "Bad number format",
+    3: "Invalid statement",
+    9: "Alarm lock",
+    }
+
+_realtime = "\x18?!~"
+
+
+class FakeGrbl:
+    """
+    The controller. `handle()` takes the characters written to the
+    serial port and returns the answer, `start()` serves it on a pseudo
+    terminal whose device node is `path`.
+
+    `probe_z` is a function (x, y) -> z of the surface which G38.2 probe
+    moves touch, flat at Z 0 by default.
+
+    `version` is "1.1" or "0.9", the format of the answers.
+
+    `baud`, `rx_buffer_size`, `planner_blocks`, `line_time` and `speed`
+    are the parameters of the timing model, see `timed()`. With None,
+    that part of the model is left out.
+    """
+
+    def __init__(self, probe_z=None, version="1.1", baud=None, rx_buffer_size=None,
+                 planner_blocks=None, line_time=0, speed=1):
+        self.logger = logging.getLogger('grbl-gui')
+        self.probe_z = probe_z or (lambda x, y: 0.0)
+        self.version = version
+        self.baud = baud
+        self.rx_buffer_size = rx_buffer_size
+        self.planner_blocks = planner_blocks
+        self.line_time = line_time
+        self.speed = speed
+        self.rapid_rate = float(dict((k, v) for k, v, _ in _settings)[110])
+
+        self.path = None
+        # the number of G-code lines answered with ok or error
+        self.lines = 0
+        # the number of bytes lost because the receive buffer was full
+        self.overflows = 0
+        # the most bytes which were in the receive buffer
+        self.rx_max = 0
+        # seconds the planner had blocks to execute, since the first one
+        self.busy_seconds = 0
+        self.first_motion = None
+        self.last_motion = None
+
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    @classmethod
+    def timed(cls, speed=1, version="1.1", baud=115200, **kwargs):
+        """
+        A FakeGrbl with the timing of Grbl on an Arduino Uno: 128 bytes
+        of receive buffer and 16 planner blocks, one of which always
+        stays empty, and about 2000 lines/s of parsing. Motions are
+        executed `speed` times faster than in reality.
+        """
+        kwargs.setdefault("rx_buffer_size", 128)
+        kwargs.setdefault("planner_blocks", 16)
+        kwargs.setdefault("line_time", 0.0005)
+        return cls(version=version, baud=baud, speed=speed, **kwargs)
+
+    def reset(self):
+        self.hold = False
+        self.mpos = [0.0, 0.0, 0.0]
+        self.feed = 0.0
+        self.spindle = 0.0
+        self.motion_mode = 0
+        self.relative = False
+        self.cs = "G54"
+        self.offsets = {cs: [0.0, 0.0, 0.0] for cs in _coordinate_systems}
+        self.probe = [0.0, 0.0, 0.0]
+        self.alarm = False
+
+        # the position at the end of the last parsed line
+        self._position = [0.0, 0.0, 0.0]
+        # the characters on their way over the serial line, and the time
+        # the first of them started
+        self._wire = ""
+        self._wire_start = 0
+        self._rx = ""
+        # planned motions as [seconds left, seconds, start, target]
+        self._blocks = collections.deque()
+        self._parser_free = 0
+        self._last_step = None
+
+    @property
+    def state(self):
+        if self.hold:
+            return "Hold"
+        if self._blocks:
+            return "Run"
+        return "Idle"
+
+    def start(self):
+        """
+        Opens the pseudo terminal and starts answering in a thread
+        """
+        self._master, self._slave = os.openpty()
+        # no echo and no line ending translation, like a serial port
+        tty.setraw(self._slave)
+        self.path = os.ttyname(self._slave)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self.path
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def _serve(self):
+        while self._running:
+            # while something is on its way, time has to be followed
+            # closely, otherwise only input matters
+            busy = self._wire or self._blocks or "\n" in self._rx
+            readable, _, _ = select.select([self._master], [], [], 0.0005 if busy else 0.1)
+            now = time.monotonic()
+            answer = ""
+            if readable:
+                try:
+                    data = os.read(self._master, 4096)
+                except OSError:
+                    break
+                answer = self.receive(data.decode("ascii", "replace"), now)
+            answer += self.step(now)
+            if answer:
+                os.write(self._master, answer.encode("ascii"))
+
+    def handle(self, data):
+        """
+        Returns the answer to `data`, the characters written to the
+        controller since the last call
+        """
+        now = time.monotonic()
+        return self.receive(data, now) + self.step(now)
+
+    def receive(self, data, now):
+        """
+        Takes characters from the serial line. Realtime commands are
+        answered at once, the others are put on the wire. Returns the
+        answer.
+        """
+        with self._lock:
+            answer = []
+            for char in data:
+                if char in _realtime:
+                    answer.append(self._realtime_command(char, now))
+                    # a reset also clears what was sent before it
+                    if char == "\x18":
+                        del answer[:-1]
+                else:
+                    if not self._wire:
+                        self._wire_start = now
+                    self._wire += char
+            return "".join(answer)
+
+    def step(self, now):
+        """
+        Advances the model to `now`. Returns the answer to the lines
+        which were parsed meanwhile.
+        """
+        with self._lock:
+            if self._last_step is None:
+                self._last_step = now
+            self._transmit(now)
+            self._execute_blocks(now)
+            answer = self._parse(now)
+            self._last_step = now
+            return answer
+
+    def _transmit(self, now):
+        # moves the characters which arrived meanwhile into the receive buffer
+        if not self._wire:
+            return
+        if self.baud is None:
+            arrived = len(self._wire)
+        else:
+            arrived = min(len(self._wire), int((now - self._wire_start) * self.baud / 10))
+            self._wire_start += arrived * 10 / self.baud
+        if arrived == 0:
+            return
+
+        chars, self._wire = self._wire[:arrived], self._wire[arrived:]
+        if self.rx_buffer_size is not None:
+            # one byte of the ring buffer always stays empty
+            free = max(0, self.rx_buffer_size - 1 - len(self._rx))
+            if len(chars) > free:
+                self.overflows += len(chars) - free
+                chars = chars[:free]
+        self._rx += chars
+        self.rx_max = max(self.rx_max, len(self._rx))
+
+    def _execute_blocks(self, now):
+        if not self._blocks or self.hold:
+            return
+        dt = now - self._last_step
+        while self._blocks and dt > 0:
+            block = self._blocks[0]
+            if block[0] > dt:
+                block[0] -= dt
+                self.busy_seconds += dt
+                dt = 0
+            else:
+                dt -= block[0]
+                self.busy_seconds += block[0]
+                self._blocks.popleft()
+                self.mpos = list(block[3])
+        self.last_motion = now - dt
+        if self._blocks:
+            left, seconds, start, target = self._blocks[0]
+            done = 1 - left / seconds
+            self.mpos = [s + (t - s) * done for s, t in zip(start, target)]
+
+    def _parse(self, now):
+        answer = []
+        while True:
+            end = self._rx.find("\n")
+            if end < 0:
+                break
+            # only as long as the planner has a free block
+            if self.planner_blocks is not None and len(self._blocks) >= self.planner_blocks - 1:
+                break
+            # one line after the other, each taking line_time
+            start = max(self._parser_free, self._last_step)
+            if start > now:
+                break
+            line, self._rx = self._rx[:end].strip(), self._rx[end + 1:]
+            self._parser_free = start + self.line_time
+            answer.extend(self.execute(line, now))
+        return "".join(answer)
+
+    def _realtime_command(self, char, now):
+        if char == "\x18":
+            self.reset()
+            self._last_step = now
+            return "\r\nGrbl {} ['$' for help]\r\n".format("1.1f" if self.version == "1.1" else "0.9j")
+        if char == "?":
+            return self.status() + "\r\n"
+        if char == "!":
+            if self.state == "Run":
+                self.hold = True
+        elif char == "~":
+            self.hold = False
+        return ""
+
+    def status(self):
+        wco = self.offsets[self.cs]
+        if self.version == "0.9":
+            wpos = [m - o for m, o in zip(self.mpos, wco)]
+            return "<{},MPos:{:.3f},{:.3f},{:.3f},WPos:{:.3f},{:.3f},{:.3f}>".format(self.state, *self.mpos, *wpos)
+        return "<{}|MPos:{:.3f},{:.3f},{:.3f}|FS:{:.0f},{:.0f}|WCO:{:.3f},{:.3f},{:.3f}>".format(
+            self.state, *self.mpos, self.feed, self.spindle, *wco)
+
+    def _error(self, code):
+        if self.version == "0.9":
+            return "error: {}\r\n".format(_errors_09[code])
+        return "error:{}\r\n".format(code)
+
+    def execute(self, line, now=None):
+        """
+        Returns the lines of the answer to one line
+        """
+        if line == "":
+            return ["ok\r\n"]
+
+        if line.startswith("$"):
+            return self._dollar(line)
+
+        if self.alarm:
+            return [self._error(9)]
+
+        self.lines += 1
+        words, comment = gcodetools.tokenize(line)
+        answer = []
+        axes = {}
+        codes = []
+        for letter, value in words:
+            number = gcodetools._to_float(value)
+            if number is None:
+                return [self._error(2)]
+            if letter == "G":
+                codes.append(number)
+            elif letter in "XYZ":
+                axes["XYZ".index(letter)] = number
+            elif letter == "F":
+                self.feed = number
+            elif letter == "S":
+                self.spindle = number
+
+        probing = False
+        g10 = False
+        for g in codes:
+            if g in (0, 1, 2, 3):
+                self.motion_mode = int(g)
+            elif g == 90 or g == 91:
+                self.relative = g == 91
+            elif 54 <= g <= 59:
+                self.cs = "G{:.0f}".format(g)
+            elif 38 <= g < 39:
+                probing = True
+            elif g == 10:
+                g10 = True
+
+        if g10:
+            # only G10 L2 Pn is supported, the origin in machine coordinates
+            p = dict(words).get("P", "1")
+            cs = _coordinate_systems[max(0, min(5, int(gcodetools._to_float(p, 1)) - 1))]
+            for axis, value in axes.items():
+                self.offsets[cs][axis] = value
+            return ["ok\r\n"]
+
+        start = list(self._position)
+        wco = self.offsets[self.cs]
+        for axis, value in axes.items():
+            if self.relative:
+                self._position[axis] += value
+            else:
+                self._position[axis] = value + wco[axis]
+
+        if probing:
+            # the probe stops at the surface, or fails when it's not reached
+            surface = self.probe_z(self._position[0] - wco[0], self._position[1] - wco[1]) + wco[2]
+            touched = self._position[2] <= surface
+            if touched:
+                self._position[2] = surface
+            self.probe = list(self._position)
+            self.mpos = list(self._position)
+            answer.append("[PRB:{:.3f},{:.3f},{:.3f}:{:d}]\r\n".format(*self.probe, int(touched)))
+
+        elif self.planner_blocks is None:
+            self.mpos = list(self._position)
+
+        elif axes:
+            rate = self.rapid_rate if self.motion_mode == 0 or self.feed <= 0 else self.feed
+            seconds = math.dist(start, self._position) / (rate / 60) / self.speed
+            if seconds > 0:
+                if self.first_motion is None:
+                    self.first_motion = now
+                self._blocks.append([seconds, seconds, start, list(self._position)])
+
+        answer.append("ok\r\n")
+        return answer
+
+    def _dollar(self, line):
+        if line == "$$":
+            return ["${}={} ({})\r\n".format(*s) for s in _settings] + ["ok\r\n"]
+
+        if line == "$#":
+            answer = ["[{}:{:.3f},{:.3f},{:.3f}]\r\n".format(cs, *self.offsets[cs]) for cs in _coordinate_systems]
+            answer.append("[G28:0.000,0.000,0.000]\r\n")
+            answer.append("[G30:0.000,0.000,0.000]\r\n")
+            answer.append("[G92:0.000,0.000,0.000]\r\n")
+            answer.append("[TLO:0.000]\r\n")
+            answer.append("[PRB:{:.3f},{:.3f},{:.3f}:0]\r\n".format(*self.probe))
+            answer.append("ok\r\n")
+            return answer
+
+        if line == "$G":
+            return ["[G{} {} G17 G21 G{} G94 M0 M{} M9 T0 F{:.0f} S{:.0f}]\r\n".format(
+                self.motion_mode, self.cs, 91 if self.relative else 90, 3 if self.spindle else 5, self.feed, self.spindle),
+                "ok\r\n"]
+
+        if line == "$X":
+            self.alarm = False
+            return ["[MSG:Caution: Unlocked]\r\n", "ok\r\n"]
+
+        if line == "$H":
+            self._position = [0.0, 0.0, 0.0]
+            self.mpos = [0.0, 0.0, 0.0]
+            return ["ok\r\n"]
+
+        if line.startswith("$") and "=" in line:
+            return ["ok\r\n"]
+
+        return [self._error(3)]
+
+    def report(self):
+        """
+        Returns the counters as text
+        """
+        rows = ["{} lines, {} bytes lost, receive buffer at most {} bytes full".format(self.lines, self.overflows, self.rx_max)]
+        if self.first_motion is not None and self.last_motion > self.first_motion:
+            rows.append("planner busy {:.0f}% of {:.1f} s".format(
+                100 * self.busy_seconds / (self.last_motion - self.first_motion), self.last_motion - self.first_motion))
+        return "\n".join(rows)
@@ -0,0 +1,242 @@
+"""
+grbl-gui - Graphical User Interface for the "grbl" CNC controller
+Copyright (C) 2015 Michael Franzl
+
+This file is part of grbl-gui.
+
+grbl-gui is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+grbl-gui is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with pyglpainter. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# A sidecar index for G-code files, so that the bounding box and line count
+# of huge files are known instantly after the first scan, and streaming
+# can be started at any line without re-reading the file from the top.
+
+import json
+import logging
+import os
+
+from . import gcodetools
+
+
+# bump this when the format of the index changes, old indexes are rebuilt
+VERSION = 2
+
+
+def index_path(fname):
+    return fname + ".idx"
+
+
+def get(fname, every=1000):
+    '''
+    Returns the index of the G-code file `fname`. The sidecar index file
+    is used if it is still valid for the path, mtime and size of
+    `fname`, otherwise the index is built and the sidecar is (re)written.
+    '''
+    index = load(fname)
+    if index is None:
+        index = build(fname, every)
+        save(fname, index)
+    return index
+
+
+def load(fname):
+    '''
+    Returns the index from the sidecar file, or None when there is no
+    sidecar file or when it is stale.
+    '''
+    logger = logging.getLogger('grbl-gui')
+
+    try:
+        with open(index_path(fname), 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if index.get("version") != VERSION or index.get("key") != _key(fname):
+        logger.info("gcodeindex: {} is stale".format(index_path(fname)))
+        return None
+
+    return index
+
+
+def save(fname, index):
+    logger = logging.getLogger('grbl-gui')
+
+    try:
+        with open(index_path(fname), 'w') as f:
+            json.dump(index, f)
+    except OSError as e:
+        # e.g. a read-only directory. The index is still usable in memory.
+        logger.warning("gcodeindex: Could not write {}: {}".format(index_path(fname), e))
+
+
+def build(fname, every=1000):
+    '''
+    Scans `fname` once and returns its index, a dict with these keys:
+
+    key: path, mtime and size of the file the index is valid for
+    line_count: the number of lines
+    bbox: the bounding box as returned by gcodetools.bbox()
+    bboxes: the boxes per coordinate system and motion as returned by
+        gcodetools.bbox_modal()
+    every: the distance in lines between two checkpoints
+    offsets: byte offsets of line 0, every, 2 * every, ...
+    checkpoints: the modal state before line 0, every, 2 * every, ...
+    '''
+    key = _key(fname)
+
+    offsets = []
+    checkpoints = []
+    state = initial_state()
+    line_count = 0
+
+    def lines():
+        nonlocal line_count
+        offset = 0
+        with open(fname, 'rb') as f:
+            for raw in f:
+                if line_count % every == 0:
+                    offsets.append(offset)
+                    checkpoints.append(dict(state, position=list(state["position"])))
+                offset += len(raw)
+                line_count += 1
+
+                line = raw.decode('utf-8', errors='replace')
+                update_state(state, gcodetools.tokenize(line)[0])
+                yield line
+
+    boxes = gcodetools.bbox_modal(lines())
+
+    return {
+        "version": VERSION,
+        "key": key,
+        "line_count": line_count,
+        "bbox": gcodetools.bbox_union(boxes),
+        "bboxes": boxes,
+        "every": every,
+        "offsets": offsets,
+        "checkpoints": checkpoints,
+        }
+
+
+def checkpoint(index, line_nr):
+    '''
+    Returns (checkpoint_line_nr, byte_offset, state) of the last
+    checkpoint at or before `line_nr`. Seek to byte_offset, then skip
+    line_nr - checkpoint_line_nr lines to arrive at `line_nr` with a known
+    modal state.
+    '''
+    if len(index["offsets"]) == 0:
+        # an empty file
+        return 0, 0, initial_state()
+    i = min(line_nr // index["every"], len(index["offsets"]) - 1)
+    return i * index["every"], index["offsets"][i], index["checkpoints"][i]
+
+
+def read_from(fname, line_nr, index=None):
+    '''
+    Returns (state, lines) to resume `fname` at `line_nr`: the modal
+    state before that line, and an iterator over the stripped lines from
+    there on, like gcodetools.read_stream(). Only the lines after the
+    last checkpoint before `line_nr` are read to get there.
+    '''
+    if index is None:
+        index = get(fname)
+    checkpoint_nr, offset, state = checkpoint(index, line_nr)
+    state = dict(state, position=list(state["position"]))
+
+    f = open(fname, 'rb')
+    f.seek(offset)
+    for i in range(line_nr - checkpoint_nr):
+        raw = f.readline()
+        if not raw:
+            break
+        update_state(state, gcodetools.tokenize(raw.decode('utf-8', errors='replace'))[0])
+    return state, _read_lines(f)
+
+
+def state_gcode(state):
+    '''
+    Returns a line of G-code which puts Grbl into the modal `state`, e.g.
+    before the first line of a job resumed in the middle. The position
+    is not restored.
+    '''
+    words = ["G{}".format(state[mode]) for mode in ("units", "plane", "distance_mode", "coordinate_system", "motion_mode")]
+    if state["feed"] is not None:
+        words.append("F" + gcodetools._format_number(state["feed"]))
+    if state["spindle"] is not None:
+        words.append("S" + gcodetools._format_number(state["spindle"]))
+    return " ".join(words)
+
+
+def initial_state():
+    '''
+    The modal state of Grbl after boot
+    '''
+    return {
+        "motion_mode": 0,
+        "distance_mode": 90,
+        "coordinate_system": 54,
+        "plane": 17,
+        "units": 21,
+        "feed": None,
+        "spindle": None,
+        "position": [0, 0, 0],
+        }
+
+
+def update_state(state, words):
+    '''
+    Updates the modal `state` dict by the words of one tokenized line
+    '''
+    target = list(state["position"])
+
+    for letter, value in words:
+        if letter == "G":
+            g = gcodetools._to_float(value)
+            if g in (0, 1, 2, 3):
+                state["motion_mode"] = int(g)
+            elif g in (90, 91):
+                state["distance_mode"] = int(g)
+            elif g in (54, 55, 56, 57, 58, 59):
+                state["coordinate_system"] = int(g)
+            elif g in (17, 18, 19):
+                state["plane"] = int(g)
+            elif g in (20, 21):
+                state["units"] = int(g)
+        elif letter == "F":
+            state["feed"] = gcodetools._to_float(value, state["feed"])
+        elif letter == "S":
+            state["spindle"] = gcodetools._to_float(value, state["spindle"])
+        elif letter in ("X", "Y", "Z"):
+            i = "XYZ".index(letter)
+            v = gcodetools._to_float(value)
+            if v is not None:
+                if state["distance_mode"] == 91:
+                    target[i] += v
+                else:
+                    target[i] = v
+
+    state["position"] = target
+
+
+def _read_lines(f):
+    with f:
+        for raw in f:
+            yield raw.decode('utf-8', errors='replace').strip()
+
+
+def _key(fname):
+    st = os.stat(fname)
+    return [os.path.abspath(fname), st.st_mtime, st.st_size]
@@ -0,0 +1,353 @@
+"""
+grbl-gui - Graphical User Interface for the "grbl" CNC controller
+Copyright (C) 2015 Michael Franzl
+
+This file is part of grbl-gui.
+
+grbl-gui is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+grbl-gui is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with pyglpainter. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# A pipeline of G-code transforms which is applied to lines while they
+# are read, e.g.
+#
+#     pipeline = Pipeline([Translate([10, 0, 0]), Rotate2D([0, 0], 90), FeedClamp(1000)])
+#     for line in pipeline(gcodetools.read_stream("job.ngc")):
+#         ...
+#     print(pipeline.report())
+#
+# Each line is tokenized once when it enters the pipeline and untokenized
+# once when it leaves it, and only if a stage changed it, instead of once
+# per transform like chained gcodetools.*_stream() generators do. In
+# between, stages pass on tuples (line, words, comment), where `line` is
+# None when the words or the comment were changed.
+#
+# Line stages transform one line at a time and are fused into one loop.
+# Stream stages like Bumpify, which need to look at many lines at once,
+# are generators in between.
+
+import math
+import time
+
+from . import gcodetools
+
+
+class Stage:
+    """
+    A line stage. Subclasses implement `apply()`, or `stream()` for a
+    stream stage.
+    """
+
+    name = "stage"
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Called before every run of the pipeline
+        """
+        self.seconds = 0
+        self.lines = 0
+
+    def apply(self, line, words, comment):
+        """
+        Transforms one tokenized line by changing `words` in place.
+        `line` is the text of the line, or None when an earlier stage
+        changed it. Returns the tuple (changed, comment).
+        """
+        return False, comment
+
+    # stream(tokens), a generator of (line, words, comment) tuples
+    stream = None
+
+
+class Translate(Stage):
+    """
+    See gcodetools.translate()
+    """
+
+    name = "translate"
+
+    def __init__(self, offsets):
+        super().__init__()
+        self._axes = {"X": offsets[0], "Y": offsets[1], "Z": offsets[2]}
+
+    def apply(self, line, words, comment):
+        return gcodetools._translate_words(words, self._axes, line), comment
+
+
+class ScaleFactor(Stage):
+    """
+    See gcodetools.scale_factor()
+    """
+
+    name = "scale_factor"
+
+    def __init__(self, facts, scale_zclear=False):
+        super().__init__()
+        self._factors = gcodetools._scale_factors(facts)
+        self._scale_zclear = scale_zclear
+
+    def apply(self, line, words, comment):
+        if not self._scale_zclear and "_zclear" in (comment if line is None else line):
+            return False, comment
+        return gcodetools._scale_words(words, self._factors), comment
+
+
+class Rotate2D(Stage):
+    """
+    See gcodetools.rotate2D()
+    """
+
+    name = "rotate2D"
+
+    def __init__(self, anchor, angle):
+        super().__init__()
+        self._anchor = anchor
+        angle = math.radians(angle)
+        self._rotation = (math.cos(angle), math.sin(angle))
+
+    def reset(self):
+        super().reset()
+        # the modal X and Y
+        self._position = [0, 0]
+
+    def apply(self, line, words, comment):
+        return gcodetools._rotate2D_words(words, self._anchor, self._rotation, self._position), comment
+
+
+class Transform(Stage):
+    """
+    See gcodetools.Affine. A stream stage, because arcs may be split
+    into many lines.
+    """
+
+    name = "transform"
+
+    def __init__(self, affine):
+        super().__init__()
+        self._affine = affine
+
+    def stream(self, tokens):
+        return self._affine._apply_tokens(tokens)
+
+
+class FeedClamp(Stage):
+    """
+    Limits all F words to `max_feed`
+    """
+
+    name = "feed_clamp"
+
+    def __init__(self, max_feed):
+        super().__init__()
+        self._max_feed = max_feed
+
+    def apply(self, line, words, comment):
+        changed = False
+        for i in range(len(words)):
+            letter, value = words[i]
+            if letter == "F":
+                feed = gcodetools._to_float(value)
+                if feed is not None and feed > self._max_feed:
+                    words[i] = ("F", gcodetools._format_number(self._max_feed))
+                    changed = True
+        return changed, comment
+
+
+class StripComments(Stage):
+    """
+    Removes all comments. Lines which were nothing but a comment become
+    empty. $ and % lines are passed on unchanged.
+    """
+
+    name = "strip_comments"
+
+    def apply(self, line, words, comment):
+        # tokenize() returns $ and % lines as a whole as the comment
+        if comment[:1] not in (";", "("):
+            return False, comment
+        # keep the line ending
+        return True, comment[len(comment.rstrip("\r\n")):]
+
+
+class Bumpify(Stage):
+    """
+    See gcodetools.bumpify_stream(). A stream stage, because the Z values
+    are interpolated for many lines at once.
+    """
+
+    name = "bumpify"
+
+    def __init__(self, cwpos, probe_points, probe_values=None, max_segment_length=None):
+        super().__init__()
+        self._args = (cwpos, probe_points, probe_values)
+        self._max_segment_length = max_segment_length
+
+    def stream(self, tokens):
+        return gcodetools._bumpify_tokens(tokens, *self._args, chunk_size=10000, max_segment_length=self._max_segment_length)
+
+
+class Pipeline:
+    """
+    An ordered list of stages. Calling the pipeline with an iterable of
+    lines returns a generator of the transformed lines.
+
+    With `timing`, the time spent in each stage is added up in
+    `stage.seconds`, and the time spent tokenizing and untokenizing in
+    `parse_seconds`, see `report()`.
+    """
+
+    def __init__(self, stages=None, timing=True):
+        self.stages = list(stages or [])
+        self.timing = timing
+        self.parse_seconds = 0
+
+    def __len__(self):
+        return len(self.stages)
+
+    def append(self, stage):
+        self.stages.append(stage)
+        return self
+
+    def __call__(self, lines):
+        for stage in self.stages:
+            stage.reset()
+        self.parse_seconds = 0
+
+        tokens = ((line,) + gcodetools.tokenize(line) for line in lines)
+        if self.timing:
+            tokens = parsed = _Clock(tokens)
+        else:
+            parsed = None
+
+        group = []
+        for stage in self.stages:
+            if stage.stream is None:
+                group.append(stage)
+                continue
+            if group:
+                tokens = self._apply(tokens, group)
+                group = []
+            tokens = self._stream(tokens, stage)
+
+        if group:
+            tokens = self._apply(tokens, group)
+
+        return self._untokenize(tokens, parsed)
+
+    def report(self):
+        """
+        Returns the timing of the last run as text
+        """
+        rows = ["{:16s} {:10.3f} s".format("parse", self.parse_seconds)]
+        for stage in self.stages:
+            rate = stage.lines / stage.seconds if stage.seconds > 0 else 0
+            rows.append("{:16s} {:10.3f} s {:12.0f} lines/s".format(stage.name, stage.seconds, rate))
+        return "\n".join(rows)
+
+    def _apply(self, tokens, stages):
+        # the line stages, fused into one loop
+        applies = [stage.apply for stage in stages]
+
+        if not self.timing:
+            for line, words, comment in tokens:
+                for apply in applies:
+                    changed, comment = apply(line, words, comment)
+                    if changed:
+                        line = None
+                yield line, words, comment
+            return
+
+        perf_counter = time.perf_counter
+        seconds = [0] * len(stages)
+        count = 0
+        try:
+            for line, words, comment in tokens:
+                t0 = perf_counter()
+                for n, apply in enumerate(applies):
+                    changed, comment = apply(line, words, comment)
+                    if changed:
+                        line = None
+                    t1 = perf_counter()
+                    seconds[n] += t1 - t0
+                    t0 = t1
+                count += 1
+                yield line, words, comment
+        finally:
+            for n, stage in enumerate(stages):
+                stage.seconds += seconds[n]
+                stage.lines += count
+
+    def _stream(self, tokens, stage):
+        if not self.timing:
+            yield from stage.stream(tokens)
+            return
+
+        # the time of the stream stage, without the time it waits for
+        # the stages before it
+        upstream = _Clock(tokens)
+        perf_counter = time.perf_counter
+        iterator = iter(stage.stream(upstream))
+        while True:
+            t = perf_counter()
+            waited = upstream.seconds
+            try:
+                token = next(iterator)
+            except StopIteration:
+                return
+            stage.seconds += perf_counter() - t - (upstream.seconds - waited)
+            stage.lines += 1
+            yield token
+
+    def _untokenize(self, tokens, parsed):
+        untokenize = gcodetools.untokenize
+
+        if not self.timing:
+            for line, words, comment in tokens:
+                yield untokenize(words, comment) if line is None else line
+            return
+
+        perf_counter = time.perf_counter
+        seconds = 0
+        try:
+            for line, words, comment in tokens:
+                if line is None:
+                    t = perf_counter()
+                    line = untokenize(words, comment)
+                    seconds += perf_counter() - t
+                yield line
+        finally:
+            # `parsed` is the clock of the tokenizing generator
+            self.parse_seconds = parsed.seconds + seconds
+
+
+class _Clock:
+    """
+    Wraps an iterator and adds up the time spent in it
+    """
+
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.seconds = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        t = time.perf_counter()
+        try:
+            return next(self._iterator)
+        finally:
+            self.seconds += time.perf_counter() - t
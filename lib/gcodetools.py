@@ -21,10 +21,91 @@ along with pyglpainter. If not, see <https://www.gnu.org/licenses/>.
 import logging
 import re
 import math
+import itertools
 
-from scipy.interpolate import griddata
+import numpy as np
 
 from . import hersheydata
+from .probesurface import ProbeSurface
+
+
+# matches a single G-code word like G1, X-1.5, S255 or Z#1 (a variable)
+_re_word = re.compile(r"([A-Za-z])\s*(#\d*|[-+]?[0-9.]*)")
+_re_comment_start = re.compile(r"[;(]")
+_re_comment_paren = re.compile(r"\([^)]*\)?")
+
+_coordinate_systems = (54, 55, 56, 57, 58, 59)
+
+
+def tokenize(line):
+    """
+    Splits a line of G-code in a single pass into its words and its comment.
+
+    Returns a tuple (words, comment). `words` is a list of (letter, value)
+    tuples in order of appearance, with the letter upper-cased and the
+    value left as an unparsed string. `comment` holds the ; comment and
+    any (...) comments of the line, plus the original line ending.
+
+    Lines starting with $ or % are not G-code and yield no words.
+    """
+    code = line.rstrip("\r\n")
+    ending = line[len(code):]
+    comment = ""
+
+    m = _re_comment_start.search(code)
+    if m:
+        if m.group() == "(":
+            # inline comments may be followed by more words
+            comment = " ".join(_re_comment_paren.findall(code))
+            code = _re_comment_paren.sub(" ", code)
+            m = _re_comment_start.search(code)
+
+        if m:
+            comment = (comment + " " + code[m.start():]).lstrip()
+            code = code[:m.start()]
+
+    if code.lstrip()[:1] in ("$", "%"):
+        return [], line
+
+    words = _re_word.findall(code.upper())
+    return words, comment + ending
+
+
+def untokenize(words, comment=""):
+    """
+    The inverse of `tokenize()`. Words are separated by single spaces.
+    """
+    line = " ".join([letter + value for letter, value in words])
+    if line and comment[:1] in (";", "("):
+        line += " "
+    return line + comment
+
+
+def _to_float(value, default=None):
+    try:
+        return float(value)
+    except ValueError:
+        # empty, a lone sign or dot, or a #variable
+        return default
+
+
+def _format_number(val):
+    return "{:0.3f}".format(val).rstrip("0").rstrip(".")
+
+
+def _format_numbers(values):
+    """
+    `_format_number()` of a list of values, much faster than one by one
+    """
+    text = ("{:0.3f} " * len(values)).format(*values)
+    return [t.rstrip("0").rstrip(".") for t in text.split()]
+
+
+def _has_word(words, letter, number):
+    for l, value in words:
+        if l == letter and _to_float(value) == number:
+            return True
+    return False
 
 
 def read(fname):
@@ -32,6 +113,15 @@ def read(fname):
         return [line.strip() for line in f.readlines()]
 
 
+def read_stream(fname):
+    """
+    Generator variant of `read()`, yielding one stripped line at a time.
+    """
+    with open(fname, 'r') as f:
+        for line in f:
+            yield line.strip()
+
+
 def write(fname, contents):
     with open(fname, 'w') as f:
         f.write(contents)
@@ -39,53 +129,117 @@ def write(fname, contents):
 
 def to_origin(gcode):
     bb = bbox(gcode)
-    xmin = bb[0][0]
-    ymin = bb[1][0]
+    xmin = bb[0][0] or 0
+    ymin = bb[1][0] or 0
     translated_gcode = translate(gcode, [-xmin, -ymin, 0])
     return translated_gcode
 
 
 def scale_into(gcode, width, height, depth, scale_zclear=False):
-    bb = bbox(gcode)
+    logger = logging.getLogger('grbl-gui')
+    try:
+        return list(scale_into_stream(gcode, width, height, depth, scale_zclear, bbox(gcode)))
+    except ValueError as e:
+        logger.error(str(e))
+
+
+def scale_into_stream(lines, width, height, depth, scale_zclear=False, bb=None):
+    """
+    Generator variant of `scale_into()`, see `translate_stream()`.
+
+    Translation and scaling are done in one single pass. Pass the
+    bounding box `bb`, e.g. from gcodeindex, to read `lines` only once.
+    Otherwise `lines` must be a list, as it is read twice.
+    """
+    if bb is None:
+        bb = bbox(lines)
+
     xmin = bb[0][0]
     xmax = bb[0][1]
     ymin = bb[1][0]
     ymax = bb[1][1]
     zmin = bb[2][0]
     zmax = bb[2][1]
-    translated_gcode = translate(gcode, [-xmin, -ymin, 0])
+
+    fac_x = fac_y = fac_z = 0
 
     if width > 0:
+        if xmin is None or xmax == xmin:
+            raise ValueError("gcodetools.scale_into: The G-code has no extent in X")
         w = xmax - xmin
         fac_x = width / w
         fac_y = fac_x
         fac_z = fac_x
 
     if height > 0:
+        if ymin is None or ymax == ymin:
+            raise ValueError("gcodetools.scale_into: The G-code has no extent in Y")
         h = ymax - ymin
         fac_y = height / h
 
     if depth > 0:
+        if zmin is None or zmax == zmin:
+            raise ValueError("gcodetools.scale_into: The G-code has no extent in Z")
         d = zmax - zmin
         fac_z = depth / d
 
-    scaled_gcode = scale_factor(
-            translated_gcode,
-            [fac_x, fac_y, fac_z],
-            scale_zclear)
+    # a factor of 0 means that the word is not scaled at all
+    facts = [fac_x or 1, fac_y or 1, fac_z or 1]
+    offsets = {"X": -(xmin or 0), "Y": -(ymin or 0), "Z": 0}
+    factors = {
+        "X": facts[0],
+        "Y": facts[1],
+        "Z": facts[2],
+        "I": facts[0],
+        "J": facts[1],
+        "K": facts[2],
+        "R": facts[0],
+        }
+
+    for line in lines:
+        words, comment = tokenize(line)
+
+        if _has_word(words, "G", 91):
+            raise ValueError("gcodetools.scale_into: It does not make sense to translate movements in G91 distance mode. Aborting at line {}".format(line))
+
+        do_scale = scale_zclear or "_zclear" not in line
 
-    return scaled_gcode
+        changed = False
+        for i in range(len(words)):
+            letter, value = words[i]
+            factor = factors.get(letter)
+            if factor is None:
+                continue
 
+            val = _to_float(value)
+            if val is None:
+                continue
 
-def bbox_draw(gcode):
+            val += offsets.get(letter, 0)
+            if do_scale:
+                val *= factor
+            words[i] = (letter, _format_number(val))
+            changed = True
+
+        yield untokenize(words, comment) if changed else line
+
+
+def bbox_draw(gcode, bb=None):
     result = ""
 
-    bb = bbox(gcode)
+    if bb is None:
+        bb = bbox(gcode)
+
     xmin = bb[0][0]
     xmax = bb[0][1]
     ymin = bb[1][0]
     ymax = bb[1][1]
 
+    if xmin is None or ymin is None:
+        logger = logging.getLogger('grbl-gui')
+        logger.error("gcodetools.bbox_draw: The G-code has no moves in X and Y")
+        return result
+
     result += "G0X{:0.1f}Y{:0.1f}\n".format(xmin, ymin)
     result += "M0\n"
 
@@ -106,230 +260,1459 @@ def bbox_draw(gcode):
 
 def translate(lines, offsets=[0, 0, 0]):
     logger = logging.getLogger('grbl-gui')
+    try:
+        return list(translate_stream(lines, offsets))
+    except ValueError as e:
+        logger.error(str(e))
 
-    result = []
 
-    axes = ["X", "Y", "Z"]
-    contains_regexps = []
-    replace_regexps = []
-    for i in range(0, 3):
-        axis = axes[i]
-        contains_regexps.append(re.compile(".*" + axis + r"([-.\d]+)"))
-        replace_regexps.append(re.compile(r"" + axis + r"[-.\d]+"))
+def translate_stream(lines, offsets=[0, 0, 0]):
+    """
+    Generator variant of `translate()`. Takes any iterable of lines and
+    yields the translated lines one by one, so that memory use stays
+    constant. Raises ValueError at the first G91 line.
+    """
+    axes = {"X": offsets[0], "Y": offsets[1], "Z": offsets[2]}
 
     for line in lines:
-        if "G91" in line:
-            logger.error("gcodetools.translate: It does not make sense to translate movements in G91 distance mode. Aborting at line {}".format(line))
-            return
+        words, comment = tokenize(line)
+        if _translate_words(words, axes, line):
+            yield untokenize(words, comment)
+        else:
+            yield line
 
-        for i in range(0, 3):
-            axis = axes[i]
-            cr = contains_regexps[i]
-            rr = replace_regexps[i]
-            ofst = offsets[i]
-
-            m = re.match(cr, line)
-            if m and offsets[i] != 0:
-                a = float(m.group(1))
-                a += ofst
-                rep = "{}{:0.3f}".format(axis, a)
-                rep = rep.rstrip("0").rstrip(".")
-                line = re.sub(rr, rep, line)
-
-        result.append(line)
-    return result
+
+def _translate_words(words, axes, line=None):
+    """
+    Translates the tokenized `line` in place by the `axes` offsets dict.
+    Returns whether any word was changed. `line` is only used for the
+    error message.
+    """
+    if _has_word(words, "G", 91):
+        if line is None:
+            line = untokenize(words)
+        raise ValueError("gcodetools.translate: It does not make sense to translate movements in G91 distance mode. Aborting at line {}".format(line))
+
+    changed = False
+    for i in range(len(words)):
+        letter, value = words[i]
+        ofst = axes.get(letter)
+        if not ofst:
+            continue
+
+        a = _to_float(value)
+        if a is not None:
+            words[i] = (letter, _format_number(a + ofst))
+            changed = True
+    return changed
 
 
 def rotate2D(lines, anchor, angle):
-    angle = math.radians(angle)
+    return list(rotate2D_stream(lines, anchor, angle))
 
-    result = []
-    re_allcomments_remove = re.compile(";.*")
 
-    words = ["X", "Y", "I", "J"]
-    contains_regexps = []
-    replace_regexps = []
-    for i in range(0, 3):
-        word = words[i]
-        contains_regexps.append(re.compile(".*" + word + r"([-.\d]+)"))
-        replace_regexps.append(re.compile(r"" + word + r"[-.\d]+"))
+def rotate2D_stream(lines, anchor, angle):
+    """
+    Generator variant of `rotate2D()`, see `translate_stream()`.
+    """
+    angle = math.radians(angle)
+    rotation = (math.cos(angle), math.sin(angle))
 
-    x = 0
-    y = 0
+    # the modal X and Y
+    position = [0, 0]
     for line in lines:
-        line = re.sub(re_allcomments_remove, "", line)  # replace comments
-
-        match_x = re.match(contains_regexps[0], line)
-        if match_x:
-            x = float(match_x.group(1))
+        words, comment = tokenize(line)
+        if _rotate2D_words(words, anchor, rotation, position):
+            yield untokenize(words, comment)
+        else:
+            yield line
 
-        match_y = re.match(contains_regexps[1], line)
-        if match_y:
-            y = float(match_y.group(1))
 
-        rot_x = math.cos(angle) * (x-anchor[0]) - math.sin(angle) * (y-anchor[1]) + anchor[0]
-        rot_y = math.sin(angle) * (x-anchor[0]) + math.cos(angle) * (y-anchor[1]) + anchor[1]
+def _rotate2D_words(words, anchor, rotation, position):
+    """
+    Rotates the tokenized line in place by `rotation`, the tuple (cos,
+    sin) of the angle, around `anchor`. `position` holds the modal X and
+    Y and is updated. Returns whether any word was changed.
+    """
+    cos, sin = rotation
+
+    idx_x = None
+    idx_y = None
+    idx_i = None
+    idx_j = None
+    for k in range(len(words)):
+        letter, value = words[k]
+        if letter == "X":
+            idx_x = k
+            position[0] = _to_float(value, position[0])
+        elif letter == "Y":
+            idx_y = k
+            position[1] = _to_float(value, position[1])
+        elif letter == "I":
+            idx_i = k
+        elif letter == "J":
+            idx_j = k
+
+    if idx_x is None and idx_y is None:
+        # not a move in the XY plane, nothing to rotate
+        return False
+
+    x, y = position
+    rot_x = cos * (x-anchor[0]) - sin * (y-anchor[1]) + anchor[0]
+    rot_y = sin * (x-anchor[0]) + cos * (y-anchor[1]) + anchor[1]
+
+    # rotation mixes both coordinates, so both must be written
+    rep_x = ("X", _format_number(rot_x))
+    rep_y = ("Y", _format_number(rot_y))
+
+    if idx_x is None:
+        words.append(rep_x)
+    else:
+        words[idx_x] = rep_x
+
+    if idx_y is None:
+        words.append(rep_y)
+    else:
+        words[idx_y] = rep_y
+
+    # arc center offsets are relative vectors, so they are rotated
+    # around their own origin instead of the anchor
+    if idx_i is not None or idx_j is not None:
+        i = _to_float(words[idx_i][1], 0) if idx_i is not None else 0
+        j = _to_float(words[idx_j][1], 0) if idx_j is not None else 0
+        rep_i = ("I", _format_number(cos * i - sin * j))
+        rep_j = ("J", _format_number(sin * i + cos * j))
+
+        if idx_i is None:
+            words.append(rep_i)
+        else:
+            words[idx_i] = rep_i
+
+        if idx_j is None:
+            words.append(rep_j)
+        else:
+            words[idx_j] = rep_j
+
+    return True
 
-        rep_x = "X{:0.3f}".format(rot_x)
-        rep_y = "Y{:0.3f}".format(rot_y)
 
-        rep_x = rep_x.rstrip("0").rstrip(".")
-        rep_y = rep_y.rstrip("0").rstrip(".")
+def scale_factor(lines, facts=[1, 1, 1], scale_zclear=False):
+    return list(scale_factor_stream(lines, facts, scale_zclear))
 
-        line = re.sub(replace_regexps[0], rep_x, line)
-        line = re.sub(replace_regexps[1], rep_y, line)
 
-        if not match_x:
-            line += rep_x
-        if not match_y:
-            line += rep_y
+def scale_factor_stream(lines, facts=[1, 1, 1], scale_zclear=False):
+    """
+    Generator variant of `scale_factor()`, see `translate_stream()`.
+    """
+    factors = _scale_factors(facts)
 
-        result.append(line)
-    return result
+    for line in lines:
+        if "_zclear" in line and not scale_zclear:
+            yield line
+            continue
 
+        words, comment = tokenize(line)
+        if _scale_words(words, factors):
+            yield untokenize(words, comment)
+        else:
+            yield line
 
-def scale_factor(lines, facts=[1, 1, 1], scale_zclear=False):
-    result = []
 
+def _scale_factors(facts):
+    """
+    Returns the factor per letter for `_scale_words()`
+    """
     logger = logging.getLogger('grbl-gui')
 
     if facts[0] != facts[1] or facts[0] != facts[2] or facts[1] != facts[2]:
         logger.warning("gcodetools.scale_factor: Circles will stay circles even with inhomogeous scale factor ".format(facts))
 
-    words = ["X", "Y", "Z", "I", "J", "K", "R"]
-    contains_regexps = []
-    replace_regexps = []
-    for i in range(0, 7):
-        word = words[i]
-        contains_regexps.append(re.compile(".*" + word + r"([-.\d]+)"))
-        replace_regexps.append(re.compile(r"" + word + r"[-.\d]+"))
+    # a factor of 0 means that the word is not scaled at all
+    return {
+        "X": facts[0],
+        "Y": facts[1],
+        "Z": facts[2],
+        "I": facts[0],
+        "J": facts[1],
+        "K": facts[2],
+        "R": facts[0],
+        }
 
-    for line in lines:
-        for i in range(0, 7):
-            word = words[i]
-            cr = contains_regexps[i]
-            rr = replace_regexps[i]
-            factor = facts[(i % 3)]
-
-            m = re.match(cr, line)
-            if m and facts[i % 3] != 0 and not ("_zclear" in line and not scale_zclear):
-                val = float(m.group(1))
-                val *= factor
-                rep = "{}{:0.3f}".format(word, val)
-                rep = rep.rstrip("0").rstrip(".")
-                line = re.sub(rr, rep, line)
 
-        result.append(line)
-    return result
+def _scale_words(words, factors):
+    """
+    Scales the tokenized line in place by the `factors` dict. Returns
+    whether any word was changed.
+    """
+    changed = False
+    for i in range(len(words)):
+        letter, value = words[i]
+        factor = factors.get(letter)
+        if not factor:
+            continue
+
+        val = _to_float(value)
+        if val is not None:
+            words[i] = (letter, _format_number(val * factor))
+            changed = True
+    return changed
+
+
+_bbox_axes = {"X": 0, "Y": 1, "Z": 2}
+
+# offset words of the arc center, by the axis they belong to
+_bbox_offsets = {"I": 0, "J": 1, "K": 2}
+
+# (axis_0, axis_1) of the arc planes G17, G18 and G19 like in Grbl
+_bbox_planes = {17: (0, 1), 18: (2, 0), 19: (1, 2)}
+
+# angles and directions where an arc reaches its extent in the arc plane
+_bbox_quadrants = ((0, 1, 0), (0.5 * math.pi, 0, 1), (math.pi, -1, 0), (1.5 * math.pi, 0, -1))
 
 
 def bbox(gcode):
-    bb = []
+    """
+    Returns the bounding box [[xmin, xmax], [ymin, ymax], [zmin, zmax]] of
+    all moves in `gcode`, i.e. the union of all boxes of `bbox_modal()`.
+    Axes without any move are [None, None].
+    """
+    return bbox_union(bbox_modal(gcode))
 
-    axes = ["X", "Y", "Z"]
-    contains_regexps = []
 
-    for i in range(0, 3):
-        axis = axes[i]
-        contains_regexps.append(re.compile(".*" + axis + r"([-.\d]+)"))
-        bb.append([9999, -9999])
+def bbox_modal(gcode, position=None):
+    """
+    Returns the bounding boxes of the moves in `gcode`, honoring the modal
+    state: distance mode (G90/G91), motion mode (G0-G3, G38.x, G80), arc
+    plane (G17-G19) and coordinate system (G54-G59, G53).
+
+    Arcs contribute their exact extent, computed analytically from their
+    center (I/J/K words, or the R word) without splitting them into
+    segments.
+
+    Returns a dict of the form {"G54": {"rapid": bb, "cut": bb}, ...}
+    with one entry per coordinate system that has moves. "rapid" are
+    G0, G28/G30 and probing moves, "cut" are G1, G2 and G3 moves. Moves
+    in machine coordinates are under "G53". `bb` is
+    [[xmin, xmax], [ymin, ymax], [zmin, zmax]] like from `bbox()`.
+
+    `position` is the start position of the tool, if known. Otherwise
+    the start point of the first move on each axis is not part of any
+    box, and G91 moves are relative to 0.
+    """
+    axes = _bbox_axes
+    offset_axes = _bbox_offsets
+    inf = math.inf
+
+    boxes = {}
+    pos = list(position) if position is not None else [None, None, None]
+    motion_mode = 0
+    relative = False
+    plane = _bbox_planes[17]
+    cs = "G54"
+    last_box = None
+    modal_box = None
 
     for line in gcode:
-        for i in range(0, 3):
-            axis = axes[i]
-            cr = contains_regexps[i]
-            m = re.match(cr, line)
-            if m:
-                a = float(m.group(1))
-                min = bb[i][0]
-                max = bb[i][1]
-                min = a if a < min else min
-                max = a if a > max else max
-                bb[i][0] = min
-                bb[i][1] = max
+        words, comment = tokenize(line)
+        if not words:
+            continue
+
+        target = None
+        offsets = None
+        radius = None
+        non_modal = None
+
+        for letter, value in words:
+            i = axes.get(letter)
+            if i is not None:
+                try:
+                    v = float(value)
+                except ValueError:
+                    continue
+                if target is None:
+                    target = list(pos)
+                if relative:
+                    target[i] = (target[i] or 0) + v
+                else:
+                    target[i] = v
+
+            elif letter == "G":
+                # the box of the modal moves may change
+                modal_box = None
+                g = _to_float(value)
+                if g in (0, 1, 2, 3):
+                    motion_mode = int(g)
+                elif g == 90:
+                    relative = False
+                elif g == 91:
+                    relative = True
+                elif g in _coordinate_systems:
+                    cs = "G{:d}".format(int(g))
+                elif g in _bbox_planes:
+                    plane = _bbox_planes[g]
+                elif g in (10, 28, 30, 53, 92):
+                    non_modal = int(g)
+                elif g == 80:
+                    motion_mode = None
+                elif g is not None and 38 < g < 39:
+                    motion_mode = 38
+
+            elif letter in offset_axes:
+                v = _to_float(value)
+                if v is not None:
+                    if offsets is None:
+                        offsets = [0, 0, 0]
+                    offsets[offset_axes[letter]] = v
+
+            elif letter == "R":
+                radius = _to_float(value)
+
+        if target is None or non_modal == 10:
+            # no move, or G10 which sets offsets instead of moving
+            continue
+
+        if non_modal == 92:
+            # the current position gets new coordinates
+            pos = target
+            last_box = None
+            continue
+
+        if motion_mode is None and non_modal is None:
+            continue
+
+        if non_modal == 53:
+            # machine coordinates of the axes without a word are unknown
+            target = [None, None, None]
+            for letter, value in words:
+                if letter in axes:
+                    target[axes[letter]] = _to_float(value)
+
+        b = modal_box if non_modal is None else None
+        if b is None:
+            if non_modal is None:
+                key = (cs, "cut" if motion_mode in (1, 2, 3) else "rapid")
+            else:
+                key = ("G53" if non_modal == 53 else cs, "rapid")
+            b = boxes.get(key)
+            if b is None:
+                b = boxes[key] = [inf, -inf, inf, -inf, inf, -inf]
+            if non_modal is None:
+                modal_box = b
+
+        # the start point is in the box already if the last move was
+        if b is not last_box and non_modal != 53:
+            _bbox_extend(b, pos)
+
+        x, y, z = target
+        if x is not None:
+            if x < b[0]:
+                b[0] = x
+            if x > b[1]:
+                b[1] = x
+        if y is not None:
+            if y < b[2]:
+                b[2] = y
+            if y > b[3]:
+                b[3] = y
+        if z is not None:
+            if z < b[4]:
+                b[4] = z
+            if z > b[5]:
+                b[5] = z
+
+        if motion_mode in (2, 3) and non_modal is None:
+            a0, a1 = plane
+            if None not in (pos[a0], pos[a1], target[a0], target[a1]):
+                for point in _arc_extrema(pos, target, plane, offsets, radius, motion_mode == 2):
+                    _bbox_extend(b, point)
+
+        if non_modal is None:
+            pos = target
+            last_box = b
+        else:
+            # G28/G30 end at a stored position, G53 at machine coordinates
+            pos = [None, None, None]
+            last_box = None
+
+    result = {}
+    for (key, kind), b in boxes.items():
+        result.setdefault(key, {})[kind] = [_bbox_pair(b[0], b[1]), _bbox_pair(b[2], b[3]), _bbox_pair(b[4], b[5])]
+    return result
+
+
+def bbox_union(boxes):
+    """
+    Returns the union of boxes as returned by `bbox_modal()`.
+    """
+    bb = [[None, None], [None, None], [None, None]]
+    for kinds in boxes.values():
+        for other in kinds.values():
+            for i in range(3):
+                lo, hi = other[i]
+                if lo is None:
+                    continue
+                if bb[i][0] is None or lo < bb[i][0]:
+                    bb[i][0] = lo
+                if bb[i][1] is None or hi > bb[i][1]:
+                    bb[i][1] = hi
     return bb
 
 
-def bumpify(gcode_list, cwpos, probe_points, probe_values):
+def _bbox_extend(b, point):
+    x, y, z = point
+    if x is not None:
+        if x < b[0]:
+            b[0] = x
+        if x > b[1]:
+            b[1] = x
+    if y is not None:
+        if y < b[2]:
+            b[2] = y
+        if y > b[3]:
+            b[3] = y
+    if z is not None:
+        if z < b[4]:
+            b[4] = z
+        if z > b[5]:
+            b[5] = z
+
+
+def _bbox_pair(lo, hi):
+    if lo > hi:
+        return [None, None]
+    return [lo, hi]
+
+
+def _arc_extrema(start, target, plane, offsets, radius, clockwise):
+    """
+    Returns the points where the arc from `start` to `target` crosses
+    the axes through its center, i.e. where it reaches its extent in
+    the arc plane.
+    """
+    arc = _arc_geometry(start, target, plane, offsets, radius, clockwise)
+    if arc is None:
+        return []
+    center0, center1, r, start_angle, travel = arc
+
+    a0, a1 = plane
+    points = []
+    for angle, cos, sin in _bbox_quadrants:
+        if clockwise:
+            delta = (start_angle - angle) % (2 * math.pi)
+        else:
+            delta = (angle - start_angle) % (2 * math.pi)
+        if delta <= abs(travel):
+            point = [None, None, None]
+            point[a0] = center0 + r * cos
+            point[a1] = center1 + r * sin
+            points.append(point)
+    return points
+
+
+def _arc_geometry(start, target, plane, offsets, radius, clockwise):
+    """
+    Returns (center0, center1, radius, start_angle, angular_travel) of the
+    arc from `start` to `target` in `plane`, or None when Grbl would
+    reject the arc. The center is computed like Grbl does, from the
+    `offsets` of the I/J/K words or from the R word.
+    """
+    a0, a1 = plane
+    x = target[a0] - start[a0]
+    y = target[a1] - start[a1]
+
+    if offsets is not None:
+        offset0 = offsets[a0]
+        offset1 = offsets[a1]
+    elif radius is not None:
+        h_x2_div_d = 4.0 * radius * radius - x * x - y * y
+        if h_x2_div_d < 0 or (x == 0 and y == 0):
+            # Grbl rejects this arc with an error
+            return None
+        h_x2_div_d = -math.sqrt(h_x2_div_d) / math.hypot(x, y)
+        if not clockwise:
+            h_x2_div_d = -h_x2_div_d
+        if radius < 0:
+            h_x2_div_d = -h_x2_div_d
+        offset0 = 0.5 * (x - y * h_x2_div_d)
+        offset1 = 0.5 * (y + x * h_x2_div_d)
+    else:
+        return None
+
+    center0 = start[a0] + offset0
+    center1 = start[a1] + offset1
+    r0 = -offset0
+    r1 = -offset1
+    rt0 = target[a0] - center0
+    rt1 = target[a1] - center1
+    r = math.hypot(r0, r1)
+
+    travel = math.atan2(r0 * rt1 - r1 * rt0, r0 * rt0 + r1 * rt1)
+    if clockwise:
+        if travel >= -5e-7:
+            travel -= 2 * math.pi
+    elif travel <= 5e-7:
+        travel += 2 * math.pi
+
+    return center0, center1, r, math.atan2(r1, r0), travel
+
+
+def bumpify(gcode_list, cwpos, probe_points, probe_values=None, max_segment_length=None):
+    """
+    Adds the Z of the probed surface to the Z of all moves. `probe_points`
+    may also be a ProbeSurface, then `probe_values` are not needed. See
+    `bumpify_stream()` for `max_segment_length`.
+    """
     print("bumpify start")
     logger = logging.getLogger('grbl-gui')
+    try:
+        gcode_list[:] = bumpify_stream(gcode_list, cwpos, probe_points, probe_values, max_segment_length=max_segment_length)
+    except ValueError as e:
+        logger.error(str(e))
+        return
+    return gcode_list
+
+
+def bumpify_stream(lines, cwpos, probe_points, probe_values=None, chunk_size=10000, max_segment_length=None):
+    """
+    Generator variant of `bumpify()`, see `translate_stream()`.
+
+    Lines are processed in chunks of `chunk_size`, and the Z values of
+    each chunk are interpolated at once. Raises ValueError at the first
+    G91 or G54..G59 line.
+
+    Without `max_segment_length`, only the endpoints of moves follow the
+    probed surface, and the machine moves in a straight line in between.
+    With it, G1 moves and G17 G2/G3 arcs longer than `max_segment_length`
+    in XY are split into as many segments as needed, each ending at the
+    Z of the surface below it.
+    """
+    tokens = ((line,) + tokenize(line) for line in lines)
+    for line, words, comment in _bumpify_tokens(tokens, cwpos, probe_points, probe_values, chunk_size, max_segment_length):
+        yield untokenize(words, comment) if line is None else line
+
+
+def _bumpify_tokens(tokens, cwpos, probe_points, probe_values, chunk_size, max_segment_length):
+    """
+    `bumpify_stream()` on tokenized lines. `tokens` and the result are
+    tuples (line, words, comment), where `line` is None when the words
+    or comment were changed and the line has to be untokenized again.
+    """
+    if isinstance(probe_points, ProbeSurface):
+        surface = probe_points
+    else:
+        surface = ProbeSurface(probe_points, probe_values)
+    z_at_xy_origin = surface.z(0, 0)
 
     position = list(cwpos)
+    motion_mode = None
+    plane = 17
+
+    # per output line either the tokens to pass through, or
+    # (words, comment, uncompensated Z, index of its XY in coords_xy)
+    chunk = []
+    coords_xy = []
+    for token in itertools.chain(tokens, [None]):
+        if token is not None:
+            line, words, comment = token
+
+            if _has_word(words, "G", 91):
+                raise ValueError("gcodetools.bumpify: G91 distance mode is not supported. Aborting at line {}".format(_line_of(token)))
+
+            if any(letter == "G" and _to_float(value) in _coordinate_systems for letter, value in words):
+                raise ValueError("gcodetools.bumpify: Switching coordinate systems is not supported. Aborting at line {}".format(_line_of(token)))
+
+            start = list(position)
+            has_xy = False
+            has_z = False
+            non_modal = False
+            offsets = None
+            radius = None
+            for letter, value in words:
+                if letter == "X":
+                    position[0] = _to_float(value, position[0])
+                    has_xy = True
+                elif letter == "Y":
+                    position[1] = _to_float(value, position[1])
+                    has_xy = True
+                elif letter == "Z":
+                    v = _to_float(value)
+                    if v is not None:
+                        position[2] = v
+                        has_z = True
+                elif letter == "G":
+                    g = _to_float(value)
+                    if g in (0, 1, 2, 3):
+                        motion_mode = int(g)
+                    elif g in (17, 18, 19):
+                        plane = int(g)
+                    elif g in (4, 10, 28, 30, 53, 92):
+                        non_modal = True
+                    elif g is not None and (g == 80 or 38 <= g < 39):
+                        motion_mode = None
+                elif letter in ("I", "J", "K"):
+                    if offsets is None:
+                        offsets = [0, 0, 0]
+                    offsets["IJK".index(letter)] = _to_float(value, 0)
+                elif letter == "R":
+                    radius = _to_float(value)
+
+            segments = None
+            if max_segment_length and has_xy and not non_modal:
+                if motion_mode == 1:
+                    segments = _split_linear(start, position, max_segment_length)
+                elif motion_mode in (2, 3) and plane == 17:
+                    segments = _split_arc(start, position, offsets, radius, motion_mode == 2, max_segment_length)
+
+            if segments is not None:
+                # the other words, e.g. G1 and F, go into the first segment
+                segment_words = [(l, v) for l, v in words if l not in "XYZIJKR"]
+                for x, y, z, extra_words in segments:
+                    segment_words += [("X", _format_number(x)), ("Y", _format_number(y))] + extra_words
+                    chunk.append((segment_words, comment, z, len(coords_xy)))
+                    coords_xy.append([x, y])
+                    segment_words = []
+                    comment = ""
+            elif has_z or has_xy:
+                chunk.append((words, comment, position[2], len(coords_xy)))
+                coords_xy.append([position[0], position[1]])
+            else:
+                chunk.append(token)
+
+            if len(chunk) < chunk_size:
+                continue
+
+        if len(chunk) == 0:
+            break
+
+        if len(coords_xy) > 0:
+            interpolated_z = surface(coords_xy)
+
+        # add/substitute Z values
+        for item in chunk:
+            if len(item) == 3:
+                yield item
+                continue
+
+            words, comment, z, i = item
+            new_z = ("Z", _format_number(z + interpolated_z[i] - z_at_xy_origin))
+            for n in range(len(words)):
+                if words[n][0] == "Z" and _to_float(words[n][1]) is not None:
+                    # contains Z, replace
+                    words[n] = new_z
+                    break
+            else:
+                # add Z
+                words.append(new_z)
 
-    axes = ["X", "Y", "Z"]
-    re_allcomments_remove = re.compile(";.*")
-    re_axis_values = []
-    re_axis_replace = []
-
-    # precompile regular expressions for speed increase
-    for i in range(0, 3):
-        axis = axes[i]
-        re_axis_values.append(re.compile(".*" + axis + r"([-.\d]+)"))
-        re_axis_replace.append(re.compile(r"" + axis + r"[-.\d]+"))
-
-    # first, collect xy coords per line, because all of them will be
-    # interpolated at once
-    coords_xy = [None]*len(gcode_list)
-    for nr in range(0, len(gcode_list)):
-        line = gcode_list[nr]
-        line = re.sub(re_allcomments_remove, "", line)  # replace comments
-
-        if "G91" in line:
-            logger.error("gcodetools.bumpify: G91 distance mode is not supported. Aborting at line {}".format(line))
-            return
+            yield None, words, comment
+
+        chunk = []
+        coords_xy = []
+
+
+def _line_of(token):
+    line, words, comment = token
+    return untokenize(words, comment) if line is None else line
 
-        if re.match("G(5[4-9]).*", line):
-            logger.error("gcodetools.bumpify: Switching coordinate systems is not supported. Aborting at line {}".format(line))
+
+def _split_linear(start, target, max_length):
+    """
+    Returns the endpoints (x, y, z, []) of the segments of the straight
+    move from `start` to `target`, or None when it is short enough.
+    """
+    count = math.ceil(math.hypot(target[0] - start[0], target[1] - start[1]) / max_length)
+    if count <= 1:
+        return None
+
+    segments = []
+    for n in range(1, count):
+        t = n / count
+        segments.append((
+            start[0] + t * (target[0] - start[0]),
+            start[1] + t * (target[1] - start[1]),
+            start[2] + t * (target[2] - start[2]),
+            []))
+    segments.append((target[0], target[1], target[2], []))
+    return segments
+
+
+def _split_arc(start, target, offsets, radius, clockwise, max_length):
+    """
+    Returns the endpoints (x, y, z, [I, J words]) of the segments of the
+    G17 arc (or helix) from `start` to `target`, or None when it is short
+    enough or invalid. The segments are arcs on the original circle.
+    """
+    arc = _arc_geometry(start, target, (0, 1), offsets, radius, clockwise)
+    if arc is None:
+        return None
+    center_x, center_y, r, start_angle, travel = arc
+
+    count = math.ceil(abs(travel) * r / max_length)
+    if count <= 1:
+        return None
+
+    segments = []
+    x, y = start[0], start[1]
+    for n in range(1, count + 1):
+        # the center relative to the start as Grbl will read it
+        ij = [("I", _format_number(center_x - x)), ("J", _format_number(center_y - y))]
+        if n == count:
+            x, y = target[0], target[1]
+        else:
+            angle = start_angle + travel * n / count
+            x = float(_format_number(center_x + r * math.cos(angle)))
+            y = float(_format_number(center_y + r * math.sin(angle)))
+        segments.append((x, y, start[2] + n / count * (target[2] - start[2]), ij))
+    return segments
+
+
+class Affine:
+    """
+    An affine transform of X, Y and Z, which accumulates any number of
+    translations, scalings and rotations into one 4x4 matrix, so that
+    G-code is transformed in one pass instead of one pass per transform.
+    The transforms apply in the order in which they are added, like
+    chained calls of the functions of the same name, and the methods
+    return the transform itself for chaining, e.g.
+
+    affine = gcodetools.Affine().scale_factor([0.2, 0.2, 1]).rotate2D([0, 0], 30)
+    for i in range(0, 200, 20):
+        self.grbl.write(affine.copy().translate([i, 0, 0]).apply(cat))
+
+    The I, J and K arc center offsets are relative vectors, so only the
+    linear part of the matrix applies to them, and R is scaled. In G91
+    distance mode X, Y and Z are relative vectors too. A mirroring
+    transform swaps G2 and G3. Arcs in a plane whose circles would not
+    stay circles, e.g. under an inhomogeneous scale factor, are replaced
+    by G1 segments no longer than `max_segment_length`.
+
+    Lines with the non-modal G4, G10, G28, G30, G53 or G92 are passed
+    through unchanged.
+    """
+
+    def __init__(self, matrix=None, max_segment_length=0.5):
+        if matrix is None:
+            matrix = np.identity(4)
+        self.matrix = np.array(matrix, dtype=np.float64)
+        self.max_segment_length = max_segment_length
+
+    def copy(self):
+        return Affine(self.matrix, self.max_segment_length)
+
+    def then(self, other):
+        """
+        Returns a new transform which applies `self`, then `other`
+        """
+        return Affine(np.dot(other.matrix, self.matrix), self.max_segment_length)
+
+    def _append(self, matrix):
+        self.matrix = np.dot(matrix, self.matrix)
+        return self
+
+    def translate(self, offsets=[0, 0, 0]):
+        matrix = np.identity(4)
+        matrix[0:3, 3] = offsets[0:3]
+        return self._append(matrix)
+
+    def scale_factor(self, facts=[1, 1, 1]):
+        """
+        Like `scale_factor()`, a factor of 0 means that the axis is not
+        scaled at all. Other than there, _zclear lines are scaled too.
+        """
+        factors = [f if f != 0 else 1 for f in facts[0:3]]
+        return self._append(np.diag(factors + [1]))
+
+    def rotate2D(self, anchor, angle):
+        angle = math.radians(angle)
+        cos = math.cos(angle)
+        sin = math.sin(angle)
+        matrix = np.identity(4)
+        matrix[0:2, 0:2] = [[cos, -sin], [sin, cos]]
+        # rotate around the anchor
+        matrix[0:2, 3] = [
+            anchor[0] - cos * anchor[0] + sin * anchor[1],
+            anchor[1] - sin * anchor[0] - cos * anchor[1],
+            ]
+        return self._append(matrix)
+
+    def is_identity(self):
+        return np.array_equal(self.matrix, np.identity(4))
+
+    def arc_scale(self, plane=17):
+        """
+        Returns the tuple (scale, mirrored) by which arcs in the G17, G18
+        or G19 `plane` are transformed, or None when their circles would
+        not stay circles.
+        """
+        a0, a1 = _bbox_planes[plane]
+        normal = 3 - a0 - a1
+        m = self.matrix
+        if m[normal, a0] != 0 or m[normal, a1] != 0 or m[a0, normal] != 0 or m[a1, normal] != 0:
+            # the plane is not mapped onto itself
+            return None
+
+        block = m[np.ix_((a0, a1), (a0, a1))]
+        gram = np.dot(block.T, block)
+        if not (math.isclose(gram[0, 0], gram[1, 1], rel_tol=1e-9) and abs(gram[0, 1]) <= 1e-9 * gram[0, 0]):
+            return None
+        return math.sqrt(gram[0, 0]), np.linalg.det(block) < 0
+
+    def apply(self, lines):
+        logger = logging.getLogger('grbl-gui')
+        try:
+            return list(self.apply_stream(lines))
+        except ValueError as e:
+            logger.error(str(e))
+
+    def apply_stream(self, lines):
+        """
+        Generator variant of `apply()`, see `translate_stream()`. Raises
+        ValueError at the first arc which has to be split but is invalid.
+        """
+        tokens = ((line,) + tokenize(line) for line in lines)
+        for line, words, comment in self._apply_tokens(tokens):
+            yield untokenize(words, comment) if line is None else line
+
+    def _apply_tokens(self, tokens):
+        """
+        `apply_stream()` on tuples (line, words, comment), see
+        `_bumpify_tokens()`
+        """
+        rows = self.matrix[0:3, 0:3].tolist()
+        translation = self.matrix[0:3, 3].tolist()
+        # per bit mask of the input axes of a line, the output axes which
+        # depend on them
+        outputs = [[k for k in range(3) if any(rows[k][j] != 0 for j in range(3) if mask & (1 << j))] for mask in range(8)]
+        arc_scales = {plane: self.arc_scale(plane) for plane in _bbox_planes}
+        # the segment length in input units
+        stretch = float(np.linalg.norm(self.matrix[0:3, 0:3], 2))
+        max_length = self.max_segment_length / stretch if stretch > 0 else self.max_segment_length
+
+        # the modal position before the transform
+        position = [0, 0, 0]
+        motion_mode = None
+        # the modal motion mode of the output, which differs from
+        # motion_mode after mirrored or split arcs
+        output_motion = None
+        plane = 17
+        relative = False
+
+        for token in tokens:
+            line, words, comment = token
+
+            present = []
+            offsets = []
+            radius_index = None
+            motion_index = None
+            non_modal = False
+            for n, (letter, value) in enumerate(words):
+                a = _bbox_axes.get(letter)
+                if a is not None:
+                    v = _to_float(value)
+                    if v is not None:
+                        present.append((a, n, v))
+                elif letter == "G":
+                    g = _to_float(value)
+                    if g in (0, 1, 2, 3):
+                        motion_mode = int(g)
+                        motion_index = n
+                    elif g in (17, 18, 19):
+                        plane = int(g)
+                    elif g == 90 or g == 91:
+                        relative = g == 91
+                    elif g in (4, 10, 28, 30, 53, 92):
+                        non_modal = True
+                    elif g is not None and (g == 80 or 38 <= g < 39):
+                        motion_mode = None
+                        motion_index = n
+                elif letter in ("I", "J", "K"):
+                    v = _to_float(value)
+                    if v is not None:
+                        offsets.append((_bbox_offsets[letter], n, v))
+                elif letter == "R":
+                    radius_index = n
+
+            if non_modal or (not present and motion_index is None):
+                yield token
+                continue
+
+            start = position
+            position = list(position)
+            vector = [0, 0, 0]
+            index = [None, None, None]
+            mask = 0
+            for a, n, v in present:
+                index[a] = n
+                mask |= 1 << a
+                if relative:
+                    vector[a] = v
+                    position[a] += v
+                else:
+                    position[a] = v
+            if not relative:
+                vector = position
+
+            arc = None
+            if present and motion_mode in (2, 3):
+                arc = arc_scales[plane]
+                if arc is None:
+                    a0, a1 = _bbox_planes[plane]
+                    moving = outputs[mask | (1 << a0) | (1 << a1)]
+                    yield from self._split(token, start, position, plane, offsets, radius_index, motion_mode == 2, max_length, relative, moving, output_motion != 1)
+                    output_motion = 1
+                    continue
+
+            changed = False
+
+            for k in outputs[mask]:
+                row = rows[k]
+                value = row[0] * vector[0] + row[1] * vector[1] + row[2] * vector[2]
+                if not relative:
+                    value += translation[k]
+                changed |= _set_word(words, index, k, "XYZ"[k], value)
+
+            if arc is not None:
+                scale, mirrored = arc
+                if offsets:
+                    ijk = [0, 0, 0]
+                    offset_index = [None, None, None]
+                    for a, n, v in offsets:
+                        ijk[a] = v
+                        offset_index[a] = n
+                    # the offsets in the arc plane must be written, the others only when there
+                    axes = set(_bbox_planes[plane]) | {a for a, n, v in offsets}
+                    for k in sorted(axes):
+                        row = rows[k]
+                        value = row[0] * ijk[0] + row[1] * ijk[1] + row[2] * ijk[2]
+                        changed |= _set_word(words, offset_index, k, "IJK"[k], value)
+
+                if radius_index is not None and scale != 1:
+                    radius = _to_float(words[radius_index][1])
+                    if radius is not None:
+                        words[radius_index] = ("R", _format_number(radius * scale))
+                        changed = True
+
+                desired_motion = 5 - motion_mode if mirrored else motion_mode
+            else:
+                desired_motion = motion_mode
+
+            if motion_index is not None:
+                if desired_motion is not None and desired_motion != motion_mode:
+                    words[motion_index] = ("G", str(desired_motion))
+                    changed = True
+                output_motion = desired_motion
+            elif desired_motion is not None and desired_motion != output_motion:
+                words.insert(0, ("G", str(desired_motion)))
+                output_motion = desired_motion
+                changed = True
+
+            if changed:
+                yield None, words, comment
+            else:
+                yield token
+
+    def _split(self, token, start, target, plane, offsets, radius_index, clockwise, max_length, relative, moving, with_g1):
+        """
+        Yields the tokens of the G1 segments which replace an arc.
+        `moving` are the output axes to write.
+        """
+        line, words, comment = token
+
+        ijk = None
+        if offsets:
+            ijk = [0, 0, 0]
+            for a, n, v in offsets:
+                ijk[a] = v
+        radius = _to_float(words[radius_index][1]) if radius_index is not None else None
+
+        points = _arc_points(start, target, _bbox_planes[plane], ijk, radius, clockwise, max_length)
+        if points is None:
+            raise ValueError("gcodetools.Affine: Invalid arc. Aborting at line {}".format(_line_of(token)))
+
+        linear = self.matrix[0:3, 0:3]
+        if relative:
+            # the relative vectors between the rounded absolute points, so
+            # that rounding errors don't add up
+            points = np.round(np.dot(np.vstack(([start], points)), linear.T), 3)
+            points = np.diff(points, axis=0)
+        else:
+            points = np.dot(points, linear.T) + self.matrix[0:3, 3]
+
+        # the other words, e.g. F, go into the first segment
+        segment_words = [(l, v) for l, v in words if l not in "XYZIJKR" and not (l == "G" and _to_float(v) in (0, 1, 2, 3))]
+        if with_g1:
+            segment_words.insert(0, ("G", "1"))
+        for point in points.tolist():
+            segment_words += [("XYZ"[k], _format_number(point[k])) for k in moving]
+            yield None, segment_words, comment
+            segment_words = []
+            comment = ""
+
+
+def _set_word(words, index, k, letter, value):
+    """
+    Sets the word `letter` to `value`, at `index[k]` in `words` or
+    appended. Returns whether the words were changed.
+    """
+    word = (letter, _format_number(value))
+    n = index[k]
+    if n is None:
+        index[k] = len(words)
+        words.append(word)
+        return True
+    if words[n] == word:
+        return False
+    words[n] = word
+    return True
+
+
+def _arc_points(start, target, plane, offsets, radius, clockwise, max_length):
+    """
+    Returns the points [x, y, z] along the arc (or helix) from `start` to
+    `target` in `plane`, no more than `max_length` apart, up to and
+    including `target`, or None when the arc is invalid.
+    """
+    arc = _arc_geometry(start, target, plane, offsets, radius, clockwise)
+    if arc is None:
+        return None
+    center0, center1, r, start_angle, travel = arc
+
+    a0, a1 = plane
+    normal = 3 - a0 - a1
+    count = max(1, math.ceil(abs(travel) * r / max_length))
+
+    points = []
+    for n in range(1, count):
+        angle = start_angle + travel * n / count
+        point = [0, 0, 0]
+        point[a0] = center0 + r * math.cos(angle)
+        point[a1] = center1 + r * math.sin(angle)
+        point[normal] = start[normal] + n / count * (target[normal] - start[normal])
+        points.append(point)
+    points.append(list(target))
+    return points
+
+
+class GcodeProgram:
+    """
+    A G-code program which is parsed only once into NumPy arrays, so
+    that whole-file transforms are vectorized array operations and text
+    is only formatted again when `lines()` is called.
+
+    `values` holds one row per line and one column per word in
+    `GcodeProgram.columns` (see `GcodeProgram.col`), NaN where the line
+    doesn't contain the word. `motion_mode` and `distance_mode` hold the
+    modal G0..G3 (-1 when not yet set) and G90/G91 state of each line.
+
+    The transforming methods work in place and return the program itself
+    for chaining, e.g.
+
+    cat = GcodeProgram(gcodetools.read("examples/gcode/cat.ngc"))
+    cat.scale_factor([0.2, 0.2, 0]).to_origin()
+    self.grbl.write(cat.copy().translate([10, 10, 0]).lines())
+    """
+
+    columns = ("X", "Y", "Z", "I", "J", "K", "R", "F", "S")
+    col = {letter: i for i, letter in enumerate(columns)}
+
+    def __init__(self, lines=None):
+        self.logger = logging.getLogger('grbl-gui')
+
+        self.line_index = np.zeros(0, dtype=np.int64)
+        self.motion_mode = np.zeros(0, dtype=np.int8)
+        self.distance_mode = np.zeros(0, dtype=np.int8)
+        self.zclear = np.zeros(0, dtype=bool)
+        self.values = np.zeros((0, len(self.columns)))
+
+        # the original text and tokens, for serialization of untouched words
+        self._lines = []
+        self._tokens = []
+        self._original_values = self.values
+
+        if lines is not None:
+            self._parse(lines)
+
+    @classmethod
+    def read(cls, fname):
+        return cls(read(fname))
+
+    def __len__(self):
+        return len(self._lines)
+
+    def _parse(self, lines):
+        nan = float("nan")
+        col = self.col
+        ncols = len(self.columns)
+
+        motion_mode = -1
+        distance_mode = 90
+
+        texts = []
+        tokens = []
+        flat = []
+        motion_modes = []
+        distance_modes = []
+        zclear = []
+        for line in lines:
+            words, comment = tokenize(line)
+
+            row = [nan] * ncols
+            for letter, value in words:
+                i = col.get(letter)
+                if i is not None:
+                    row[i] = _to_float(value, nan)
+                elif letter == "G":
+                    g = _to_float(value)
+                    if g in (0, 1, 2, 3):
+                        motion_mode = int(g)
+                    elif g == 90 or g == 91:
+                        distance_mode = int(g)
+
+            texts.append(line)
+            tokens.append((words, comment))
+            flat.extend(row)
+            motion_modes.append(motion_mode)
+            distance_modes.append(distance_mode)
+            zclear.append("_zclear" in line)
+
+        self._lines = texts
+        self._tokens = tokens
+        self.line_index = np.arange(len(tokens))
+        self.motion_mode = np.array(motion_modes, dtype=np.int8)
+        self.distance_mode = np.array(distance_modes, dtype=np.int8)
+        self.zclear = np.array(zclear, dtype=bool)
+        self.values = np.array(flat, dtype=np.float64).reshape(len(tokens), ncols)
+        self._original_values = self.values.copy()
+
+    def copy(self):
+        """
+        Returns an independent copy. Only the arrays are copied, the
+        original text and tokens are shared, so copies are cheap.
+        """
+        other = GcodeProgram()
+        other._lines = self._lines
+        other._tokens = self._tokens
+        other._original_values = self._original_values
+        other.line_index = self.line_index
+        other.motion_mode = self.motion_mode
+        other.distance_mode = self.distance_mode
+        other.zclear = self.zclear
+        other.values = self.values.copy()
+        return other
+
+    def lines(self):
+        """
+        Serializes the program back to a list of G-code lines. Lines whose
+        values were not changed are returned verbatim.
+        """
+        values = self.values
+        original = self._original_values
+        changed = ~((values == original) | (np.isnan(values) & np.isnan(original)))
+        changed_rows = np.flatnonzero(changed.any(axis=1))
+
+        result = list(self._lines)
+        columns = self.columns
+        col = self.col
+
+        # all numbers are formatted at once, None where NaN
+        rows = values[changed_rows]
+        present = ~np.isnan(rows)
+        texts = np.full(rows.shape, None, dtype=object)
+        texts[present] = _format_numbers(rows[present].tolist())
+
+        rows = texts.tolist()
+        rows_changed = changed[changed_rows].tolist()
+        for nr, row, row_changed in zip(changed_rows.tolist(), rows, rows_changed):
+            words, comment = self._tokens[nr]
+
+            new_words = []
+            seen = set()
+            for letter, value in words:
+                i = col.get(letter)
+                if i is not None and row[i] is not None:
+                    value = row[i]
+                    seen.add(i)
+                new_words.append((letter, value))
+
+            # words which were not in the line before, e.g. after rotate2D
+            for i in range(len(columns)):
+                if row_changed[i] and i not in seen and row[i] is not None:
+                    new_words.append((columns[i], row[i]))
+
+            result[nr] = untokenize(new_words, comment)
+        return result
+
+    def translate(self, offsets=[0, 0, 0]):
+        if (self.distance_mode == 91).any():
+            nr = int(np.argmax(self.distance_mode == 91))
+            self.logger.error("GcodeProgram.translate: It does not make sense to translate movements in G91 distance mode. Aborting at line {}".format(self._lines[nr]))
             return
 
-        for i in range(0, 2):  # only loop over x and y
-            axis = axes[i]
-            rv = re_axis_values[i]
-            m = re.match(rv, line)
-            if m:
-                a = float(m.group(1))
-                position[i] = a
-
-        coords_xy[nr] = [position[0], position[1]]
-
-    # see http://docs.scipy.org/doc/scipy/reference/generated/scipy.interpolate.griddata.html
-    interpolated_z = griddata(
-        probe_points,
-        probe_values,
-        coords_xy,
-        method='cubic')
-
-    z_at_xy_origin = griddata(
-        probe_points,
-        probe_values,
-        [0, 0],
-        method='cubic')[0]
-
-    # next add/substitute Z values
-    current_z = cwpos[2]
-    for nr in range(0, len(gcode_list)):
-        line = gcode_list[nr]
-        line = re.sub(re_allcomments_remove, "", line)  # remove comments
-
-        axis = axes[2]
-        rv = re_axis_values[2]
-        rr = re_axis_replace[2]
-        m = re.match(rv, line)
-        if m:
-            # contains Z, replace
-            current_z = float(m.group(1))
-            new_z = current_z + interpolated_z[nr] - z_at_xy_origin
-            rep = "{}{:0.3f}".format(axis, new_z)
-            rep = rep.rstrip("0").rstrip(".")
-            line = re.sub(rr, rep, line)
-        elif "X" in line or "Y" in line:
-            # add Z
-            new_z = current_z + interpolated_z[nr] - z_at_xy_origin
-            line += "{}{:0.3f}".format(axis, new_z)
-
-        gcode_list[nr] = line
+        for i in range(0, 3):
+            if offsets[i] != 0:
+                # NaN stays NaN, so absent words stay absent
+                self.values[:, i] += offsets[i]
+        return self
+
+    def scale_factor(self, facts=[1, 1, 1], scale_zclear=False):
+        if facts[0] != facts[1] or facts[0] != facts[2] or facts[1] != facts[2]:
+            self.logger.warning("GcodeProgram.scale_factor: Circles will stay circles even with inhomogeous scale factor ".format(facts))
+
+        # a factor of 0 means that the word is not scaled at all
+        factors = np.array([facts[0], facts[1], facts[2], facts[0], facts[1], facts[2], facts[0]], dtype=np.float64)
+        factors[factors == 0] = 1
+
+        if scale_zclear:
+            self.values[:, 0:7] *= factors
+        else:
+            self.values[~self.zclear, 0:7] *= factors
+        return self
+
+    def rotate2D(self, anchor, angle):
+        angle = math.radians(angle)
+        cos = math.cos(angle)
+        sin = math.sin(angle)
+
+        x = self.values[:, 0]
+        y = self.values[:, 1]
+        moves = ~(np.isnan(x) & np.isnan(y))
+
+        # rotation mixes both coordinates, so the modal value of the
+        # absent one is needed
+        x = _fill_forward(x, 0) - anchor[0]
+        y = _fill_forward(y, 0) - anchor[1]
+        self.values[moves, 0] = (cos * x - sin * y + anchor[0])[moves]
+        self.values[moves, 1] = (sin * x + cos * y + anchor[1])[moves]
+
+        # arc center offsets are relative vectors, so they are rotated
+        # around their own origin instead of the anchor
+        i = self.values[:, 3]
+        j = self.values[:, 4]
+        arcs = moves & ~(np.isnan(i) & np.isnan(j))
+        i = np.nan_to_num(i[arcs])
+        j = np.nan_to_num(j[arcs])
+        self.values[arcs, 3] = cos * i - sin * j
+        self.values[arcs, 4] = sin * i + cos * j
+        return self
+
+    def transform(self, affine):
+        """
+        Applies the gcodetools.Affine `affine` in one pass. Other than
+        `Affine.apply()`, arcs can't be split into segments or mirrored
+        here, because that changes the lines and not just their values.
+        """
+        matrix = affine.matrix
+        linear = matrix[0:3, 0:3]
+        depends = (linear != 0).T
+
+        arcs = (self.motion_mode == 2) | (self.motion_mode == 3)
+        arc_scale = affine.arc_scale(17)
+        if arcs.any() and (arc_scale is None or arc_scale[1]):
+            self.logger.warning("GcodeProgram.transform: Arcs will stay unmirrored circles, use gcodetools.Affine.apply() instead")
+
+        # the output axes which depend on an axis of the line are written
+        xyz = self.values[:, 0:3]
+        present = ~np.isnan(xyz)
+        write = np.dot(present, depends)
+
+        # rotation mixes the coordinates, so the modal values of the
+        # absent ones are needed, while relative moves are vectors
+        relative = (self.distance_mode == 91)[:, np.newaxis]
+        modal = np.column_stack([_fill_forward(xyz[:, i], 0) for i in range(3)])
+        vectors = np.where(relative, np.nan_to_num(xyz), modal)
+        moved = np.dot(vectors, linear.T) + np.where(relative, 0, matrix[0:3, 3])
+        self.values[:, 0:3] = np.where(write, moved, xyz)
+
+        # arc center offsets are relative vectors
+        ijk = self.values[:, 3:6]
+        present = ~np.isnan(ijk)
+        write = np.dot(present, depends) & arcs[:, np.newaxis]
+        moved = np.dot(np.nan_to_num(ijk), linear.T)
+        self.values[:, 3:6] = np.where(write, moved, ijk)
+
+        if arc_scale is None:
+            scale = math.sqrt(abs(np.linalg.det(linear[0:2, 0:2])))
+        else:
+            scale = arc_scale[0]
+        self.values[:, 6] *= scale
+        return self
+
+    def bbox(self):
+        bb = []
+        for i in range(0, 3):
+            column = self.values[:, i]
+            column = column[~np.isnan(column)]
+            if len(column) == 0:
+                bb.append([None, None])
+            else:
+                bb.append([float(column.min()), float(column.max())])
+        return bb
 
-    return gcode_list
+    def to_origin(self):
+        bb = self.bbox()
+        return self.translate([-(bb[0][0] or 0), -(bb[1][0] or 0), 0])
+
+
+def _fill_forward(column, initial):
+    """
+    Replaces each NaN in `column` by the last preceding non-NaN value, or
+    by `initial` if there is none.
+    """
+    column = np.concatenate(([initial], column))
+    idx = np.where(np.isnan(column), 0, np.arange(len(column)))
+    np.maximum.accumulate(idx, out=idx)
+    return column[idx][1:]
+
+
+def tile(program, nx, ny, dx, dy, pattern="grid", optimize_travel=False, preamble=None, origin=None, cs=1):
+    """
+    Returns copies of `program`, a GcodeProgram or a list of lines, on a
+    grid of `nx` x `ny` tiles which are `dx` and `dy` apart. The program
+    is parsed only once.
+
+    `pattern` selects the tiles: "grid" for all of them, "checkerboard"
+    for every other one, or a function (i, j) -> bool.
+
+    With `optimize_travel`, the tiles are not emitted row by row, but
+    each next one is the one whose start is nearest to where the last
+    one ended, which shortens the rapid travel between tiles.
+
+    `preamble` chooses how the copies are moved:
+
+    None: the X and Y words of each copy are offset
+    "G92": a G92 line before each copy shifts the coordinates to the
+    next tile, and the copy itself is the unchanged text. The first copy
+    is offset like with None, and G92.1 clears the shift at the end.
+    "G10": a G10 L2 line before each copy moves the origin of the
+    coordinate system `cs` (1 for G54 etc.) to `origin` plus the tile
+    offset, and it is moved back to `origin` at the end. `origin` is the
+    origin of `cs` in machine coordinates, e.g. from Grbl's $# report.
+    Note that Grbl writes the offset into its EEPROM each time.
+    """
+    logger = logging.getLogger('grbl-gui')
+    try:
+        return list(tile_stream(program, nx, ny, dx, dy, pattern, optimize_travel, preamble, origin, cs))
+    except ValueError as e:
+        logger.error(str(e))
+
+
+def tile_stream(program, nx, ny, dx, dy, pattern="grid", optimize_travel=False, preamble=None, origin=None, cs=1):
+    """
+    Generator variant of `tile()`, see `translate_stream()`. Raises
+    ValueError for programs which can't be tiled.
+    """
+    if not isinstance(program, GcodeProgram):
+        program = GcodeProgram(program)
+
+    if (program.distance_mode == 91).any():
+        raise ValueError("gcodetools.tile: It does not make sense to tile movements in G91 distance mode")
+
+    if preamble not in (None, "G92", "G10"):
+        raise ValueError("gcodetools.tile: Unknown preamble {}".format(preamble))
+
+    if preamble == "G10" and origin is None:
+        raise ValueError("gcodetools.tile: The G10 preamble needs the origin of the coordinate system")
+
+    if preamble is not None:
+        for words, comment in program._tokens:
+            for letter, value in words:
+                if letter == "G" and _to_float(value) in _tile_offset_codes:
+                    raise ValueError("gcodetools.tile: The program must not change offsets or coordinate systems itself when tiling with the {} preamble. Aborting at line {}".format(preamble, untokenize(words, comment)))
+
+    if pattern == "grid":
+        selected = lambda i, j: True
+    elif pattern == "checkerboard":
+        selected = lambda i, j: (i + j) % 2 == 0
+    else:
+        selected = pattern
+    offsets = [(i * dx, j * dy) for j in range(ny) for i in range(nx) if selected(i, j)]
+    if len(offsets) == 0:
+        return
+
+    x = program.values[:, 0]
+    y = program.values[:, 1]
+    moves = np.flatnonzero(~(np.isnan(x) & np.isnan(y)))
+
+    # where the program starts and ends in XY, for the travel between tiles
+    if len(moves) > 0:
+        start = _fill_forward(x[moves], 0)[0], _fill_forward(y[moves], 0)[0]
+        end = _fill_forward(x[moves], 0)[-1], _fill_forward(y[moves], 0)[-1]
+    else:
+        start = end = (0, 0)
+
+    if optimize_travel:
+        offsets = _tile_order(offsets, start, end)
+
+    if preamble == "G10":
+        for ox, oy in offsets:
+            yield "G10 L2 P{:d} X{} Y{}".format(cs, _format_number(origin[0] + ox), _format_number(origin[1] + oy))
+            yield from program._lines
+        yield "G10 L2 P{:d} X{} Y{}".format(cs, _format_number(origin[0]), _format_number(origin[1]))
+        return
+
+    # the moves as format strings, so that a copy is only formatting
+    # the offset numbers into them
+    templates = []
+    for nr in moves.tolist():
+        words, comment = program._tokens[nr]
+        parts = []
+        for letter, value in words:
+            if letter == "X" and _to_float(value) is not None:
+                parts.append(("X", "{0}"))
+            elif letter == "Y" and _to_float(value) is not None:
+                parts.append(("Y", "{1}"))
+            else:
+                parts.append((letter, value.replace("{", "{{").replace("}", "}}")))
+        templates.append(untokenize(parts, comment.replace("{", "{{").replace("}", "}}")))
+    x = np.nan_to_num(x[moves])
+    y = np.nan_to_num(y[moves])
+    moves = moves.tolist()
+
+    for n, (ox, oy) in enumerate(offsets):
+        if preamble == "G92" and n > 0:
+            # the current position is `end` of the last tile in the
+            # coordinates of the last tile. Each G92 is relative to the
+            # last one, so more decimals than usual keep rounding errors
+            # from adding up.
+            last_ox, last_oy = offsets[n - 1]
+            shift = (end[0] + last_ox - ox, end[1] + last_oy - oy)
+            yield "G92 X{} Y{}".format(*["{:0.6f}".format(v).rstrip("0").rstrip(".") for v in shift])
+            yield from program._lines
+            continue
+
+        lines = list(program._lines)
+        xs = _format_numbers((x + ox).tolist())
+        ys = _format_numbers((y + oy).tolist())
+        for nr, template, x_text, y_text in zip(moves, templates, xs, ys):
+            lines[nr] = template.format(x_text, y_text)
+        yield from lines
+
+    if preamble == "G92":
+        yield "G92.1"
+
+
+# G10, G92 and the coordinate systems G54..G59
+_tile_offset_codes = (10, 92, 92.1) + _coordinate_systems
+
+
+def _tile_order(offsets, start, end):
+    """
+    Orders the tile `offsets` greedily, beginning with the first one, so
+    that each next tile starts nearest to where the last one ended.
+    """
+    points = np.array(offsets, dtype=np.float64)
+    remaining = np.ones(len(points), dtype=bool)
+
+    order = [0]
+    remaining[0] = False
+    for _ in range(len(points) - 1):
+        current = points[order[-1]] + end
+        distance = np.hypot(*(points + start - current).T)
+        distance[~remaining] = np.inf
+        nearest = int(np.argmin(distance))
+        order.append(nearest)
+        remaining[nearest] = False
+    return [offsets[i] for i in order]
 
 
 def hersheyToGcode(string, font='standard', z_depth=0, z_safe=3):
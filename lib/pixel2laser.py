@@ -19,19 +19,33 @@ along with pyglpainter. If not, see <https://www.gnu.org/licenses/>.
 """
 
 from PIL import Image
+import concurrent.futures
 import logging
+import math
+import re
 
+import numpy as np
 
-def find_row_ranges(pix, width, height):
-    '''
-    Scans each pixel row and finds the index of the first and last
-    non-white pixel as counted from the left and the right edge.
-    It returns those indices and row direction in a list
+
+def find_row_ranges(pixels, bidirectional=True):
+    """
+    Finds the index of the first and last non-white pixel of each pixel
+    row of the grayscale bitmap `pixels` (a 2D uint8 array, rows top to
+    bottom). It returns those indices and row direction in a list
 
     [[x_start1, x_end1, 1], [x_start2, x_end2, -1], ...]
 
-    direction=1 means ltr, and -1 means rtl
-    '''
+    direction=1 means ltr, and -1 means rtl. The list starts with the
+    bottom row of the bitmap, because the CNC origin is bottom left.
+    Without `bidirectional` all rows are ltr.
+    """
+    height, width = pixels.shape
+
+    # bitmap origin is top left, but CNC origin is bottom left
+    nonwhite = pixels[::-1] != 255
+    has_pixels = nonwhite.any(axis=1)
+    first = np.argmax(nonwhite, axis=1)
+    last = width - 1 - np.argmax(nonwhite[:, ::-1], axis=1)
 
     result = []
 
@@ -40,170 +54,356 @@ def find_row_ranges(pix, width, height):
     direction = 1
 
     for cy in range(height):
-        # bitmap origin is top left, but CNC origin is bottom left
-        # so we scan the bitmap beginning with the last row
-        y = height - cy - 1
-
-        # by default we assume the row to be empty
-        start_x = None
-        end_x = None
-
-        if direction == 1:
-            # we are going ltr
-            rng_start = range(0, width, 1)
-            rng_end = range(width - 1, -1, -1)
+        if not has_pixels[cy]:
+            result.append([None, None, direction])
+        elif direction == 1:
+            # one pixel before and after the non-white pixels, within the bitmap
+            result.append([max(int(first[cy]) - 1, 0), min(int(last[cy]) + 1, width), direction])
         else:
-            # we are going rtl
-            rng_start = range(width - 1, -1, -1)
-            rng_end = range(0, width, 1)
-
-        # look for the first non-white start pixel
-        for i in rng_start:
-            if pix[i, y] != 255:
-                start_x = i
-                break
-
-        # look for the first non-white end pixel
-        for i in rng_end:
-            if pix[i, y] != 255:
-                end_x = i
-                break
-
-        if start_x is not None and end_x is not None:
-            # increment/decrement start and end points by one
-            start_x += -direction
-            end_x += direction
-
-            # limit start_x and end_x to the maximal extents of the bitmap
-            if direction == 1:
-                start_x = 0 if start_x < 0 else start_x
-                end_x = width if end_x > width else end_x
-            else:
-                start_x = (width-1) if start_x > (width-1) else start_x
-                end_x = -1 if end_x < -1 else end_x
+            result.append([min(int(last[cy]) + 1, width - 1), max(int(first[cy]) - 1, -1), direction])
 
-        # alternate direction for next row
-        direction *= -1
-
-        result.append([start_x, end_x, -direction])
+        if bidirectional:
+            direction *= -1
 
     return result
 
-def do(filename_in, dpmm=1, x_bleed=10, xcorr=0):
+
+def do(filename_in, dpmm=1, x_bleed=10, xcorr=0, workers=1, levels=None, tolerance=0, dither=False, skip_gap=None, bidirectional=True):
     # 300 dpi = 11.8 dpmm
     # 254 dpi = 10 dpmm (100µm pixels)
     # 127 dpi = 5 dpmm (200µm pixels)
     # 76.2 dpi = 3 dpmm (333µm pixels)
-    logging.info("Opening image %s", filename_in)
+    # for levels, tolerance and dither see quantize(), for the rest encode()
+    pixels = quantize(read(filename_in), levels, tolerance, dither)
+    return encode(pixels, dpmm, x_bleed, xcorr, workers, skip_gap, bidirectional)
 
-    unit_length = 1 / dpmm
 
-    # read bitmap and convert into grayscale ('L')
-    im = Image.open(filename_in).convert('L')
+def do_stream(filename_in, dpmm=1, x_bleed=10, xcorr=0, workers=1, levels=None, tolerance=0, dither=False, skip_gap=None, bidirectional=True):
+    """
+    Generator variant of `do()`, yielding the G-code lines row by row
+    while the image is being converted.
+    """
+    pixels = quantize(read(filename_in), levels, tolerance, dither)
+    return encode_stream(pixels, dpmm, x_bleed, xcorr, workers, skip_gap, bidirectional)
 
-    # contains grayscale values depending on pixel coordinates, lazy-loaded
-    pix = im.load()
 
-    width = im.size[0]
-    height = im.size[1]
-    logging.info("Image is %ix%i", width, height)
+def read(filename_in):
+    """
+    Returns the image `filename_in` as grayscale bitmap, a 2D uint8 array
+    with rows from top to bottom.
+    """
+    logging.info("Opening image %s", filename_in)
 
-    row_ranges = find_row_ranges(pix, width, height)
+    # read bitmap and convert into grayscale ('L')
+    pixels = np.asarray(Image.open(filename_in).convert('L'))
+
+    logging.info("Image is %ix%i", pixels.shape[1], pixels.shape[0])
+    return pixels
+
+
+def quantize(pixels, levels=None, tolerance=0, dither=False):
+    """
+    Reduces the gray values of the bitmap `pixels`, so that consecutive
+    pixels more often have the same intensity and are lasered with one
+    single line. White pixels stay white.
+
+    levels: the number of gray values (laser power levels) to round to,
+        evenly spaced from black to white, at least 2. None keeps all
+        256.
+    tolerance: a pixel gets the gray value of the pixels before it in
+        the row as long as it differs from it by at most this much.
+    dither: carry the rounding error on to the next pixels of the row
+        (error diffusion), which preserves the mean gray value of areas
+        even with very few levels. Without `levels` 2 levels are used.
+        Then a pixel gets the gray value of the pixels before it as long
+        as the error accumulated in the row stays within `tolerance`.
+        Dithering alternates between levels, so without a `tolerance` of
+        at least one level step it needs more lines than not quantizing
+        at all. The larger the tolerance, the longer the runs, but the
+        coarser the pattern.
+
+    Returns a new bitmap, or `pixels` itself when nothing is to be done.
+    """
+    if levels is not None and levels < 2:
+        raise ValueError("pixel2laser.quantize: Needs at least 2 levels, got {}".format(levels))
+    if dither and not levels:
+        levels = 2
+
+    white = pixels == 255
+
+    if levels:
+        palette = np.round(np.linspace(0, 255, levels))
+        step = 255 / (levels - 1)
+
+        def nearest(values):
+            return palette[np.clip(np.round(values / step), 0, levels - 1).astype(np.intp)]
+
+        if dither:
+            pixels = _diffuse_error(pixels.astype(np.float64), white, nearest, max(step / 2, tolerance))
+            # the tolerance was already used for the error
+            tolerance = 0
+        else:
+            pixels = nearest(pixels.astype(np.float64))
+        pixels = np.where(white, 255, pixels).astype(np.uint8)
+
+    if tolerance > 0:
+        # the rows are processed all at once, column by column
+        pixels = pixels.copy()
+        white = pixels == 255
+        run_value = pixels[:, 0].astype(np.int16)
+        for x in range(1, pixels.shape[1]):
+            column = pixels[:, x].astype(np.int16)
+            merge = (np.abs(column - run_value) <= tolerance) & ~white[:, x] & (run_value != 255)
+            run_value = np.where(merge, run_value, column)
+            pixels[:, x] = run_value
+
+    return pixels
+
+
+def _diffuse_error(image, white, nearest, hold):
+    """
+    Error diffusion of the float bitmap `image` onto the gray values
+    returned by `nearest`, along the rows only, which are processed all
+    at once, column by column. A pixel keeps the gray value of the pixel
+    before it as long as the accumulated error stays within `hold`.
+    """
+    height, width = image.shape
+    out = np.empty_like(image)
+
+    # Different errors to start with shift the patterns of the rows
+    # against each other, which would otherwise line up to stripes
+    # across the rows in areas of even gray.
+    carry = ((np.arange(height) * 0.618034) % 1 - 0.5) * hold
+    level = np.full(height, np.nan)
+
+    for x in range(width):
+        value = image[:, x] + carry
+        new = np.where(np.abs(value - level) <= hold, level, nearest(value))
+        # white pixels neither receive nor pass on any error
+        new = np.where(white[:, x], 255, new)
+        carry = np.where(white[:, x], 0, value - new)
+        level = np.where(white[:, x], np.nan, new)
+        out[:, x] = new
+
+    return out
+
+
+def encode(pixels, dpmm=1, x_bleed=10, xcorr=0, workers=1, skip_gap=None, bidirectional=True):
+    """
+    Returns the G-code lines for lasering the grayscale bitmap `pixels`,
+    a 2D uint8 array with rows from top to bottom, see `do()`.
+
+    Consecutive pixels of the same intensity are run-length-encoded into
+    one single line, because gcode coordinates remain in the state machine
+    of the CNC controller. Each row is encoded with array operations, only
+    the text of the lines is assembled per line.
+
+    xcorr: shifts X of ltr rows by xcorr and of rtl rows by -xcorr, to
+        compensate for the lag of the laser. A pair (ltr, rtl) gives the
+        shift of each direction separately.
+    workers: with more than 1, the bitmap is split into horizontal bands
+        which are encoded in that many processes. The result is the same.
+    skip_gap: white gaps within a row longer than this many mm, and longer
+        than `x_bleed`, are crossed with a G0 rapid move instead of at
+        feed rate. The last `x_bleed` mm before the next pixels are still
+        moved at feed rate, to accelerate.
+    bidirectional: laser every other row rtl. Otherwise all rows are
+        lasered ltr, with a rapid move back to the start of the next row.
+    """
+    return list(encode_stream(pixels, dpmm, x_bleed, xcorr, workers, skip_gap, bidirectional))
+
+
+def encode_stream(pixels, dpmm=1, x_bleed=10, xcorr=0, workers=1, skip_gap=None, bidirectional=True):
+    """
+    Generator variant of `encode()`. In a single process, the lines are
+    yielded row by row, with `workers` > 1 band by band.
+    """
+    unit_length = 1 / dpmm
 
-    result = ""
+    # the X shift of each direction
+    if isinstance(xcorr, (tuple, list)):
+        xcorrs = {1: xcorr[0], -1: xcorr[1]}
+    else:
+        xcorrs = {1: xcorr, -1: -1 * xcorr}
+
+    height, width = pixels.shape
+    row_ranges = find_row_ranges(pixels, bidirectional)
+
+    # only rows which contain non-white pixels are lasered
+    rows = [cy for cy in range(height) if row_ranges[cy][0] is not None]
+    if not rows:
+        logging.error("pixel2laser: The image is completely white, nothing to do")
+        return
+
+    first_y = rows[0]
+    first_x, _, first_direction = row_ranges[first_y]
+
+    yield "S0"
+    yield "G0 X{:f} Y{:f}".format(first_x * unit_length - first_direction * x_bleed, first_y * unit_length)
+    yield "G0"
+    yield "X{:f}".format(first_x * unit_length + xcorrs[first_direction])
+
+    # bitmap origin is top left, but CNC origin is bottom left
+    pixels = pixels[::-1]
+
+    settings = {
+        "row_ranges": row_ranges,
+        "first_x": first_x,
+        "first_y": first_y,
+        "unit_length": unit_length,
+        "x_bleed": x_bleed,
+        "xcorrs": xcorrs,
+        "skip_gap": skip_gap,
+        "bidirectional": bidirectional,
+        }
+
+    if workers > 1:
+        # Rows are independent of each other, except for the bleed moves
+        # which need the x_start of the next row. A band is given the
+        # rows it encodes plus the next row after it.
+        bands = [band.tolist() for band in np.array_split(rows, workers * 4) if len(band)]
+        tasks = []
+        for i, band in enumerate(bands):
+            next_row = bands[i + 1][0] if i + 1 < len(bands) else None
+            tasks.append((pixels[band[0]:band[-1] + 1], band, next_row, settings))
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for lines, last_x in executor.map(_encode_band, tasks):
+                yield from lines
+    else:
+        for lines, last_x in _encode_rows(pixels, rows, None, settings):
+            yield from lines
 
-    first_x = None
-    first_y = None
-    first_direction = None
-    # find first x and y
-    for j in range(len(row_ranges)):
-        first_x = row_ranges[j][0]
-        first_y = j
-        first_direction = row_ranges[j][2]
-        if first_x != None: break
+    # gcode postamble
+    direction = row_ranges[-1][2]
+    out_x = float(unit_length * last_x + direction * x_bleed)
+    yield "G0 X{:f} S0".format(out_x)  # last easing out movement
 
-    result += "S0\n"
-    result += "G0 X{:f} Y{:f}\n".format(first_x * unit_length - first_direction * x_bleed, first_y * unit_length)
-    result += "G0\n"
-    result += "X{:f}\n".format(first_x * unit_length + xcorr * first_direction)
 
-    last_x = first_x
-    last_y = first_y
-    last_z = 0
-    last_s = 0
+def _encode_band(task):
+    """
+    Encodes the rows of one band of the bitmap in a worker process.
+    Returns the lines and the last X (in pixels) of the band.
+    """
+    pixels, rows, next_row, settings = task
 
-    for cy in range(height):
+    result = []
+    for lines, last_x in _encode_rows(pixels, rows, next_row, settings, rows[0]):
+        result.extend(lines)
+    return result, last_x
+
+
+def _encode_rows(pixels, rows, next_row, settings, pixels_y=0):
+    """
+    Yields the lines of each of `rows` together with its bleed moves into
+    the following row, and the last X (in pixels) of the row. `next_row`
+    is the row following the last of `rows`, if any. `pixels` holds the
+    rows starting at row `pixels_y`, bottom to top. `settings` are those
+    of `encode_stream()`.
+    """
+    row_ranges = settings["row_ranges"]
+    first_x = settings["first_x"]
+    first_y = settings["first_y"]
+    unit_length = settings["unit_length"]
+    x_bleed = settings["x_bleed"]
+    xcorrs = settings["xcorrs"]
+    skip_gap = settings["skip_gap"]
+
+    width = pixels.shape[1]
+
+    # the text of all possible X and S words. When going rtl we have to
+    # shift pixels by one.
+    x_words = {}
+    for direction, x_shift in ((1, 1), (-1, 0)):
+        x_words[direction] = np.array(
+            ["X{:g} ".format((cx + x_shift) * unit_length + xcorrs[direction]) for cx in range(width)],
+            dtype=object)
+    s_words = np.array(["S{:g} ".format(s) for s in range(256)] + [""], dtype=object)
+    no_s_word = 256
+
+    for i, cy in enumerate(rows):
         start_x, end_x, direction = row_ranges[cy]
-
-        # bitmap origin is top left, but CNC origin is bottom left
-        # so we scan the bitmap beginning with the last row
-        y = height - cy - 1
-
-        # when going rtl we have to shift pixels by one
         x_shift = 1 if direction == 1 else 0
 
-        if start_x is None and end_x is None:
-            # this row only contains white pixels, nothing to do for this row
-            continue
+        # invert, black pixels (0) are highest intensity (255) for laser
+        row = 255 - pixels[cy - pixels_y].astype(np.int16)
 
-        for cx in range(start_x, end_x, direction):
-            s = pix[cx, y]  # get intensity from pixel
-            s = 255 - s  # invert, black pixels (0) are highest intensity (255) for laser
-
-            if cx > 0 and cx < (width - 1) and pix[cx, y] == pix[cx + direction, y]:
-                # This is gcode optimzation for consecutive pixels of the
-                # same intensity. This reduces gcode lines, because gcode coordinates
-                # remain in the state machine of the CNC controller.
-                continue
-
-            x = cx + x_shift
-
-            new_x = x
-            new_y = cy
-            new_z = 0
-            new_s = s
-
-            gcodeline = ""
-            # Only write changes to coords
-            x2 = new_x * unit_length + direction * xcorr
-            y2 = new_y * unit_length
-            z2 = new_z * unit_length
-            if last_x != new_x:
-                gcodeline += "X{:g} ".format(x2)
-            if last_y != new_y:
-                gcodeline += "Y{:g} ".format(y2)
-            if last_z != new_z:
-                gcodeline += "Z{:g} ".format(z2)
-            if last_s != new_s:
-                gcodeline += "S{:g} ".format(new_s)
-            gcodeline += "\n"
-            result += gcodeline
-
-            last_x = new_x
-            last_y = new_y
-            last_z = new_z
-            last_s = new_s
+        if cy == first_y:
+            # where the preamble has left the laser
+            last_x = first_x
+            last_s = 0
+        else:
+            last_x = None
+            last_s = None
+
+        # the pixels of this row in the order they are lasered
+        cxs = np.arange(start_x, end_x, direction)
+        s = row[cxs]
+
+        # a pixel is skipped when the next pixel has the same intensity,
+        # except at the bitmap borders
+        inner = (cxs > 0) & (cxs < width - 1)
+        same_as_next = np.zeros(len(cxs), dtype=bool)
+        same_as_next[inner] = row[cxs[inner]] == row[cxs[inner] + direction]
+        keep = ~same_as_next
+        cxs = cxs[keep]
+        s = s[keep]
+
+        # S words only where the intensity changes
+        s_index = s.astype(np.int64)
+        s_index[1:][s[1:] == s[:-1]] = no_s_word
+        if last_s is not None and s[0] == last_s:
+            s_index[0] = no_s_word
+
+        lines = (x_words[direction][cxs] + s_words[s_index]).tolist()
+
+        # the first line of a row also changes Y, or may not change X
+        x = int(cxs[0]) + x_shift
+        line = ""
+        if last_x != x:
+            line += x_words[direction][cxs[0]]
+        if cy != first_y:
+            line += "Y{:g} ".format(cy * unit_length)
+        lines[0] = line + s_words[s_index[0]]
+
+        if skip_gap is not None:
+            # each line moves over the pixels after the previous line
+            gap_lengths = np.abs(np.diff(cxs)) * unit_length
+            gaps = np.nonzero((s[1:] == 0) & (gap_lengths > max(skip_gap, x_bleed)))[0] + 1
+            for k in gaps[::-1]:
+                gap_end = (int(cxs[k]) + x_shift) * unit_length + xcorrs[direction]
+                lines[k:k + 1] = [
+                    "G0 X{:g} S0".format(gap_end - direction * x_bleed),
+                    "G1 X{:g}".format(gap_end),
+                    ]
+
+        last_x = int(cxs[-1]) + x_shift
+
+        ny = rows[i + 1] if i + 1 < len(rows) else next_row
+        if ny is None:
+            # no non-empty lines were found, so nothing more to do
+            yield lines, last_x
+            break
 
         # After lasering the last pixel, continue going into the same direction
         # for the distance of x_bleed, so that GRBL's inertia control doesn't
         # slow down the movement. Lasering should be done at constant speed
         # for constant burning (non-distorted grayscale) of material.
-        # For this, we have to look ahead at the x_start and x_end of the next
-        # row.
-        nxs = None  # next x_start
-        nxe = None  # next x_end
-        ny = None  # next y
-
-        for j in range(cy + 1, height):
-            # find the next non-empty row
-            nxs, nxe, dctn = row_ranges[j]
-            if nxs is not None and nxe is not None:
-                # found next y!
-                ny = j
-                break
-
-        if nxs is None and nxe is None:
-            # no non-empty lines were found, so nothing more to do
+        # For this, we have to look ahead at the x_start of the next row.
+        nxs = row_ranges[ny][0]
+
+        if not settings["bidirectional"]:
+            # ease out, then rapid back to before the start of the next row
+            # and accelerate into it
+            next_start = (nxs + 1) * unit_length + xcorrs[1]
+            lines.append(";bleed begin")
+            lines.append("G0 X{:g} Y{:g} S0".format(
+                    unit_length * last_x + x_bleed, (cy + (ny - cy) / 2) * unit_length))
+            lines.append("G0 X{:g} Y{:g} S0".format(next_start - x_bleed, ny * unit_length))
+            lines.append("G1 X{:g} S0".format(next_start))
+            lines.append(";bleed end")
+            lines.append("G1")
+            yield lines, last_x
             continue
 
         # which line has the furthest x coordinate? current row or the next row?
@@ -212,41 +412,76 @@ def do(filename_in, dpmm=1, x_bleed=10, xcorr=0):
         else:
             furthest_x = nxs if nxs < last_x else last_x
 
-        middle_y = last_y + (ny - last_y) / 2
+        middle_y = cy + (ny - cy) / 2
 
         x_clear = unit_length * furthest_x + (direction * x_bleed)
 
-        # # below we are going to draw approximately tangential circles
-        # # to ease out the current X movement without any significant
-        # # y movement at the beginning of the circle.
-        # arcmode = 3 if direction == 1 else 2
-
-        # # The following code is based on trial-and-error which leads to good results
-        # # in the GRBL simulator. Circles could be made exactly tangential to the
-        # # pixel rows, but I require more arc gcode studying.
-        # radius_factor = 7
-        # if direction == 1:
-        #     arc_radius_out = radius_factor * (x_clear - last_x) * unit_length
-        #     arc_radius_in = radius_factor * (x_clear - nxs) * unit_length
-        # else:
-        #     arc_radius_out = radius_factor * (last_x - x_clear) * unit_length
-        #     arc_radius_in = radius_factor * (nxs - x_clear) * unit_length
-
-        result += ";bleed begin\n"
-        result += "G0 X{:g} Y{:g} S0\n".format(x_clear, middle_y * unit_length)
+        lines.append(";bleed begin")
+        lines.append("G0 X{:g} Y{:g} S0".format(x_clear, middle_y * unit_length))
         offset = 1 if direction == 1 else 0
-        result += "G0 X{:g} Y{:g} S0\n".format(
-                direction * xcorr + (nxs + offset) * unit_length,
-                ny * unit_length)
-        result += ";bleed end\n"
-
-        last_s = None  # invalidate last S for next row processing
-        last_x = None  # invalidate last X for next row processing
-
-        result += "G1\n"
-
-    # gcode postamble
-    out_x = float(unit_length * last_x + direction * x_bleed)
-    result += "G0 X{:f} S0\n".format(out_x)  # last easing out movement
-
-    return result.split('\n')
+        lines.append("G0 X{:g} Y{:g} S0".format(
+                xcorrs[direction] + (nxs + offset) * unit_length,
+                ny * unit_length))
+        lines.append(";bleed end")
+
+        lines.append("G1")
+
+        yield lines, last_x
+
+
+# a G0/G1 word or a coordinate of a line as generated above
+_re_move_word = re.compile(r"([GXY])([-+]?[0-9.]+)")
+
+
+def count_stream(lines, stats):
+    """
+    Passes `lines` through unchanged and counts into the dict `stats`:
+    lines, and the distance in mm moved at feed rate (feed_distance)
+    and at rapid rate (rapid_distance). See `job_time()`.
+    """
+    stats.setdefault("lines", 0)
+    stats.setdefault("feed_distance", 0)
+    stats.setdefault("rapid_distance", 0)
+
+    x = y = 0
+    rapid = True
+    feed_distance = rapid_distance = 0
+
+    for n, line in enumerate(lines, stats["lines"] + 1):
+        words = _re_move_word.findall(line)
+        if words:
+            new_x, new_y = x, y
+            for letter, value in words:
+                if letter == "X":
+                    new_x = float(value)
+                elif letter == "Y":
+                    new_y = float(value)
+                elif value in ("0", "1"):
+                    rapid = value == "0"
+            distance = math.hypot(new_x - x, new_y - y) if new_y != y else abs(new_x - x)
+            if rapid:
+                rapid_distance += distance
+            else:
+                feed_distance += distance
+            x, y = new_x, new_y
+
+        stats["lines"] = n
+        yield line
+
+    stats["feed_distance"] += feed_distance
+    stats["rapid_distance"] += rapid_distance
+
+
+def job_time(stats, feed, rapid=None, lines_per_second=None):
+    """
+    Returns the estimated time in seconds of a job counted by
+    `count_stream()`, at `feed` and `rapid` rate in mm/min. Acceleration
+    is not taken into account. With `lines_per_second`, the rate at which
+    the controller can receive and plan lines, the job takes at least
+    as long as sending all of its lines.
+    """
+    rapid = rapid or feed
+    seconds = 60 * (stats["feed_distance"] / feed + stats["rapid_distance"] / rapid)
+    if lines_per_second:
+        seconds = max(seconds, stats["lines"] / lines_per_second)
+    return seconds
@@ -0,0 +1,147 @@
+"""
+grbl-gui - Graphical User Interface for the "grbl" CNC controller
+Copyright (C) 2015 Michael Franzl
+
+This file is part of grbl-gui.
+
+grbl-gui is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+grbl-gui is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with pyglpainter. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Named sets of probe data, one NumPy .npz file per set in DIRECTORY, so
+# that e.g. the surface map of a fixture can be probed once and reused
+# for a whole batch of parts.
+
+import logging
+import os
+import time
+
+import numpy as np
+
+
+DIRECTORY = "probedata"
+
+# bump this when the format of the files changes
+VERSION = 1
+
+
+def path(name, directory=DIRECTORY):
+    return os.path.join(directory, name + ".npz")
+
+
+def names(directory=DIRECTORY):
+    '''
+    Returns the names of all saved probe sets
+    '''
+    try:
+        files = os.listdir(directory)
+    except OSError:
+        return []
+    return sorted(f[:-4] for f in files if f.endswith(".npz"))
+
+
+def save(name, points, values, cs, probe_z_first, directory=DIRECTORY):
+    '''
+    Saves a probe set and returns its path
+
+    @param points
+    [x, y] of the probe points in the coordinate system `cs`
+
+    @param values
+    The probed Z values
+
+    @param cs
+    The name of the coordinate system, e.g. "G54"
+
+    @param probe_z_first
+    The Z of the first probe point, the reference for drawing, or None
+    when nothing was probed
+    '''
+    os.makedirs(directory, exist_ok=True)
+    fname = path(name, directory)
+    np.savez(
+        fname,
+        version=VERSION,
+        points=np.asarray(points, dtype=float).reshape(-1, 2),
+        values=np.asarray(values, dtype=float),
+        cs=cs,
+        # NaN for None, which would need pickle to be loaded
+        probe_z_first=np.nan if probe_z_first is None else probe_z_first,
+        timestamp=time.time())
+    return fname
+
+
+def load(name, directory=DIRECTORY):
+    '''
+    Returns the probe set `name` as a dict with the keys points (n x 2
+    array), values (array), cs, probe_z_first (None when nothing was
+    probed) and timestamp, or None when it can't be read.
+
+    `name` may also be the path of a probedata.txt as written by earlier
+    versions. It has no metadata, so cs and timestamp are None then.
+    '''
+    logger = logging.getLogger('grbl-gui')
+
+    if name.endswith(".txt"):
+        return _load_text(name)
+
+    fname = path(name, directory)
+    try:
+        with np.load(fname) as f:
+            if int(f["version"]) != VERSION:
+                logger.error("probedata: {} has an unknown version".format(fname))
+                return None
+            return {
+                "points": f["points"],
+                "values": f["values"],
+                "cs": str(f["cs"]),
+                "probe_z_first": _z_first(f),
+                "timestamp": float(f["timestamp"]),
+                }
+    except (OSError, ValueError, KeyError) as e:
+        logger.error("probedata: Could not read {}: {}".format(fname, e))
+        return None
+
+
+def _z_first(f):
+    try:
+        z = float(f["probe_z_first"])
+    except ValueError:
+        # None, saved as a pickled object by earlier versions
+        z = np.nan
+    if np.isnan(z):
+        # it is the Z of the first point anyway
+        return float(f["values"][0]) if len(f["values"]) else None
+    return z
+
+
+def _load_text(fname):
+    logger = logging.getLogger('grbl-gui')
+
+    try:
+        data = np.loadtxt(fname, ndmin=2)
+    except (OSError, ValueError) as e:
+        logger.error("probedata: Could not read {}: {}".format(fname, e))
+        return None
+
+    if data.shape[0] == 0:
+        logger.error("probedata: {} is empty".format(fname))
+        return None
+
+    return {
+        "points": data[:, 0:2],
+        "values": data[:, 2],
+        "cs": None,
+        "probe_z_first": float(data[0, 2]),
+        "timestamp": None,
+        }
@@ -0,0 +1,145 @@
+"""
+grbl-gui - Graphical User Interface for the "grbl" CNC controller
+Copyright (C) 2015 Michael Franzl
+
+This file is part of grbl-gui.
+
+grbl-gui is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+grbl-gui is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with pyglpainter. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Where to probe next when measuring a surface. Every probe costs seconds
+# of machine time, so the points are either planned on a grid in an order
+# with short travel, or chosen one by one where they are needed most.
+
+import math
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def serpentine_grid(dimx, dimy, spacing):
+    """
+    Returns the points of a grid over the area from (0, 0) to
+    (dimx, dimy), no more than `spacing` apart, row by row and in
+    alternating direction, so that the travel between two probes is
+    always one grid step. The first point is (0, 0).
+    """
+    xs = np.linspace(0, dimx, max(2, math.ceil(dimx / spacing) + 1))
+    ys = np.linspace(0, dimy, max(2, math.ceil(dimy / spacing) + 1))
+
+    points = []
+    for row, y in enumerate(ys):
+        for x in (xs if row % 2 == 0 else xs[::-1]):
+            points.append((round(float(x), 3), round(float(y), 3)))
+    return points
+
+
+class AdaptivePlanner:
+    """
+    Chooses the next probe point where the interpolated surface is least
+    certain, until it is certain enough everywhere.
+
+    The uncertainty at a point is estimated as the larger of two
+    residuals: the difference between the smooth (cubic) and the linear
+    interpolation of the probe points there, which is large where the
+    surface bends between the probe points, and the distance to the
+    nearest probe point over `max_spacing`, times `tolerance`, so that no
+    point is further than `max_spacing` from a probe point, even where
+    the surface looks flat. Where a probe measured a Z further off the
+    interpolation than `tolerance`, the residual of that probe is used
+    instead of `tolerance`, which makes the probe points denser there.
+    """
+
+    def __init__(self, dimx, dimy, tolerance, max_spacing, resolution=1, max_points=None):
+        """
+        @param dimx
+        @param dimy
+        The probed area from (0, 0) to (dimx, dimy)
+
+        @param tolerance
+        Stop when the estimated residual is below this everywhere, in mm
+
+        @param max_spacing
+        The largest distance between a point and the nearest probe point
+
+        @param resolution
+        The distance between the candidates for the next probe point
+
+        @param max_points
+        Stop after this many probe points in any case
+        """
+        self.tolerance = tolerance
+        self.max_spacing = max_spacing
+        self.max_points = max_points
+
+        # the largest estimated residual when next_point() was last called
+        self.max_residual = None
+
+        # per probe point of the surface, the residual measured there
+        self._measured = []
+        # the last planned point and the Z interpolated there before probing
+        self._planned = None
+
+        xs = np.linspace(0, dimx, max(2, math.ceil(dimx / resolution) + 1))
+        ys = np.linspace(0, dimy, max(2, math.ceil(dimy / resolution) + 1))
+        grid = np.meshgrid(xs, ys, indexing="ij")
+        self._candidates = np.column_stack((grid[0].ravel(), grid[1].ravel()))
+
+    def residuals(self, surface):
+        """
+        Returns the estimated residual of `surface` at every candidate
+        """
+        candidates = self._candidates
+
+        deviation = np.abs(surface(candidates) - surface.linear(candidates))
+        # outside of the probed area there is nothing to compare
+        deviation[np.isnan(deviation)] = 0
+
+        self._update_measured(surface)
+        distance, nearest = cKDTree(surface.points).query(candidates)
+        measured = np.maximum(np.array(self._measured), self.tolerance)
+        return np.maximum(deviation, measured[nearest] * distance / self.max_spacing)
+
+    def next_point(self, surface):
+        """
+        Returns the next (x, y) to probe, or None when the ProbeSurface
+        `surface` is certain enough.
+        """
+        if self.max_points is not None and len(surface) >= self.max_points:
+            return None
+
+        residuals = self.residuals(surface)
+        self.max_residual = float(residuals.max())
+
+        if self.max_residual < self.tolerance:
+            return None
+
+        # not necessarily the worst candidate, but the nearest of those
+        # which are almost as bad, which saves a lot of travel
+        worst = np.flatnonzero(residuals >= max(self.tolerance, 0.5 * self.max_residual))
+        last = surface.points[-1]
+        distance = np.hypot(*(self._candidates[worst] - last).T)
+        x, y = self._candidates[worst[np.argmin(distance)]]
+        self._planned = (len(surface), surface.z(x, y))
+        return (round(float(x), 3), round(float(y), 3))
+
+    def _update_measured(self, surface):
+        values = surface.values
+        while len(self._measured) < len(surface):
+            i = len(self._measured)
+            if self._planned is not None and self._planned[0] == i and not np.isnan(self._planned[1]):
+                self._measured.append(abs(values[i] - self._planned[1]))
+            else:
+                # e.g. a pre-planned corner
+                self._measured.append(0)
@@ -0,0 +1,168 @@
+"""
+grbl-gui - Graphical User Interface for the "grbl" CNC controller
+Copyright (C) 2015 Michael Franzl
+
+This file is part of grbl-gui.
+
+grbl-gui is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+grbl-gui is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with pyglpainter. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+from scipy.interpolate import CloughTocher2DInterpolator, LinearNDInterpolator
+from scipy.spatial import Delaunay, QhullError
+
+
+class ProbeSurface:
+    """
+    The surface of a workpiece as measured by probing, i.e. Z values at
+    XY probe points, interpolated in between.
+
+    The interpolation is the same as
+    griddata(probe_points, probe_values, xi, method='cubic'), but the
+    Delaunay triangulation is built once and then extended point by point
+    as new probe points are added, instead of being rebuilt for every
+    lookup. Lookups are vectorized.
+    """
+
+    def __init__(self, points=None, values=None, fill_value=np.nan):
+        """
+        @param points
+        List of [x, y] probe points
+
+        @param values
+        List of the probed Z values, one per point
+
+        @param fill_value
+        Z outside of the convex hull of the probe points
+        """
+        self.fill_value = fill_value
+
+        self._points = []
+        self._values = []
+
+        # the incremental triangulation and the number of points in it
+        self._tri = None
+        self._tri_count = 0
+
+        self._interpolator = None
+        self._linear_interpolator = None
+
+        if points is not None:
+            self.extend(points, values)
+
+    def __len__(self):
+        return len(self._points)
+
+    @property
+    def points(self):
+        return np.array(self._points, dtype=float).reshape(-1, 2)
+
+    @property
+    def values(self):
+        return np.array(self._values, dtype=float)
+
+    def add(self, point, value):
+        self.extend([point], [value])
+
+    def extend(self, points, values):
+        if len(points) != len(values):
+            raise ValueError("ProbeSurface: {} points but {} values".format(len(points), len(values)))
+
+        for point, value in zip(points, values):
+            self._points.append([float(point[0]), float(point[1])])
+            self._values.append(float(value))
+
+        self._interpolator = None
+        self._linear_interpolator = None
+
+    def __call__(self, xy, fill_value=None):
+        """
+        Returns the interpolated Z values at `xy`, which is anything that
+        CloughTocher2DInterpolator takes: a list of [x, y], an (n, 2) array
+        or a tuple of X and Y arrays like from np.mgrid.
+
+        Outside of the probed area, and while there are not enough probe
+        points for a triangulation, Z is `fill_value`, by default the one
+        given to the constructor.
+        """
+        if fill_value is None:
+            fill_value = self.fill_value
+
+        interpolator = self._update()
+        if interpolator is None:
+            if isinstance(xy, tuple):
+                shape = np.broadcast(*xy).shape
+            else:
+                shape = np.asarray(xy).shape[:-1]
+            return np.full(shape, fill_value, dtype=float)
+
+        z = interpolator(xy)
+        if not np.isnan(fill_value):
+            z[np.isnan(z)] = fill_value
+        return z
+
+    def linear(self, xy, fill_value=None):
+        """
+        Like calling the surface, but interpolates linearly within the
+        triangles between the probe points. Where this differs much from
+        the smooth surface, the probe points are too far apart for the
+        shape of the surface.
+        """
+        if fill_value is None:
+            fill_value = self.fill_value
+
+        if self._update() is None:
+            return self(xy, fill_value)
+
+        if self._linear_interpolator is None:
+            self._linear_interpolator = LinearNDInterpolator(self._interpolator.tri, self.values)
+
+        z = self._linear_interpolator(xy)
+        if not np.isnan(fill_value):
+            z[np.isnan(z)] = fill_value
+        return z
+
+    def z(self, x, y, fill_value=None):
+        """
+        Returns the interpolated Z value at one single point
+        """
+        return float(self([[x, y]], fill_value)[0])
+
+    def _update(self):
+        if self._interpolator is not None:
+            return self._interpolator
+
+        points = self.points
+
+        if self._tri is None:
+            try:
+                self._tri = Delaunay(points, incremental=True)
+            except (QhullError, ValueError):
+                # less than 4 points, or all on one line
+                self._tri = None
+        elif self._tri_count < len(points):
+            self._tri.add_points(points[self._tri_count:])
+
+        if self._tri is not None:
+            self._tri_count = len(points)
+            tri = self._tri
+        else:
+            try:
+                # the non-incremental triangulation works with 3 points
+                tri = Delaunay(points)
+            except (QhullError, ValueError):
+                return None
+
+        self._interpolator = CloughTocher2DInterpolator(tri, self.values)
+        return self._interpolator
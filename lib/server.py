@@ -0,0 +1,291 @@
+"""
+grbl-gui - Graphical User Interface for the "grbl" CNC controller
+Copyright (C) 2015 Michael Franzl
+
+This file is part of grbl-gui.
+
+grbl-gui is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+grbl-gui is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with pyglpainter. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# The headless streaming server. It owns the connection to the machine
+# and is controlled through a Unix socket, so that streaming doesn't
+# depend on a GUI and can run on a small computer next to the machine:
+#
+#     server = StreamServer("/dev/ttyACM0", socket_path="/tmp/grbl-gui.sock")
+#     server.run()
+#
+# Clients send one JSON object per line and get one back, e.g.
+#
+#     {"cmd": "load", "file": "/home/pi/job.ngc"}  ->  {"ok": true, "lines": 35211}
+#     {"cmd": "run"}                                 ->  {"ok": true}
+#     {"cmd": "status"}                              ->  {"ok": true, "state": "Run", ...}
+#
+# see `request()` and the `ctl` subcommand of grbl-gui.py.
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+
+from grbl_streamer import GrblStreamer
+
+from .eventbus import EventBus
+from .streamjob import stream_lock
+
+
+DEFAULT_SOCKET = "/tmp/grbl-gui.sock"
+
+
+class StreamServer:
+    """
+    Connects to Grbl on `path` and serves the control socket at
+    `socket_path` until a client sends "shutdown" or `shutdown()` is
+    called. Events of GrblStreamer are handled every `interval` seconds.
+    """
+
+    def __init__(self, path, baud=115200, socket_path=DEFAULT_SOCKET, interval=0.2):
+        self.logger = logging.getLogger('grbl-gui')
+        self.path = path
+        self.baud = baud
+        self.socket_path = socket_path
+        self.interval = interval
+
+        self.eventbus = EventBus(self.on_grbl_event)
+        self.grbl = GrblStreamer(self.eventbus.post)
+        self.grbl.poll_interval = interval
+        self._stream_lock = stream_lock(self.grbl)
+
+        # the state as of the last dispatched events
+        self.state = "Unknown"
+        self.mpos = (0, 0, 0)
+        self.wpos = (0, 0, 0)
+        self.progress = 0
+        self.rx_buffer_percent = 0
+        self.job = None
+        self.running = False
+        self.alarm = None
+        self.errors = []
+        self.requested_feed = None
+
+        self._lock = threading.Lock()
+        self._shutdown = threading.Event()
+        self._server = None
+
+        self._commands = {
+            "status": self.status,
+            "load": self.load,
+            "run": self.run_job,
+            "halt": self.halt,
+            "hold": self.grbl.hold,
+            "resume": self.grbl.resume,
+            "abort": self.abort,
+            "killalarm": self.killalarm,
+            "feed": self.feed,
+            "send": self.send,
+            "events": self.events,
+            "shutdown": self.shutdown,
+            }
+
+    def run(self):
+        """
+        Blocks until shutdown
+        """
+        if os.path.exists(self.socket_path):
+            # left behind by a server which didn't shut down
+            os.remove(self.socket_path)
+        # whoever can write to the socket can move the machine, so it is
+        # created accessible to the owner only
+        umask = os.umask(0o177)
+        try:
+            self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, _Handler)
+        finally:
+            os.umask(umask)
+        self._server.daemon_threads = True
+        self._server.stream_server = self
+        thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        thread.start()
+        self.logger.info("Serving {} on {}".format(self.path, self.socket_path))
+
+        self.grbl.cnect(self.path, self.baud)
+        try:
+            while not self._shutdown.wait(self.interval):
+                self.eventbus.dispatch()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.grbl.disconnect()
+            self._server.shutdown()
+            self._server.server_close()
+            os.remove(self.socket_path)
+            self.logger.info("Stopped serving {}".format(self.path))
+
+    def shutdown(self):
+        self._shutdown.set()
+
+    def on_grbl_event(self, event, *data):
+        if event == "on_boot":
+            self.state = "Idle"
+            self.alarm = None
+            self.grbl.poll_start()
+        elif event == "on_stateupdate":
+            self.state, self.mpos, self.wpos = data
+        elif event == "on_progress_percent":
+            self.progress = data[0]
+        elif event == "on_rx_buffer_percent":
+            self.rx_buffer_percent = data[0]
+        elif event == "on_alarm":
+            self.alarm = data[0]
+            self.logger.error("Grbl: {}".format(data[0]))
+        elif event == "on_error":
+            line, command, line_number = data
+            self.errors.append({"error": line, "command": command, "line": line_number})
+            del self.errors[:-100]
+            self.logger.error("Grbl: {} in line {}: {}".format(line, line_number, command))
+        elif event == "on_job_completed":
+            # also posted on boot, e.g. after an abort
+            if self.running:
+                self.running = False
+                self.logger.info("Job {} completed".format(self.job))
+        elif event == "on_disconnected":
+            self.state = "Disconnected"
+
+    def command(self, request):
+        """
+        Executes one request of a client and returns the answer
+        """
+        if not isinstance(request, dict) or request.get("cmd") not in self._commands:
+            return {"ok": False, "error": "Unknown command, one of: {}".format(", ".join(sorted(self._commands)))}
+
+        args = {k: v for k, v in request.items() if k != "cmd"}
+        with self._lock:
+            try:
+                result = self._commands[request["cmd"]](**args)
+            except (TypeError, ValueError, OSError) as e:
+                return {"ok": False, "error": str(e)}
+
+        answer = {"ok": True}
+        if isinstance(result, dict):
+            answer.update(result)
+        return answer
+
+    def status(self):
+        grbl = self.grbl
+        return {
+            "connected": grbl.is_connected(),
+            "state": self.state,
+            "mpos": list(self.mpos),
+            "wpos": list(self.wpos),
+            "job": self.job,
+            "running": self.running,
+            "lines": grbl.buffer_size,
+            "line": grbl.current_line_number,
+            "progress": self.progress,
+            "rx_buffer_percent": self.rx_buffer_percent,
+            "job_finished": grbl.job_finished,
+            "feed": self.requested_feed,
+            "alarm": self.alarm,
+            "errors": len(self.errors),
+            "last_error": self.errors[-1] if self.errors else None,
+            }
+
+    def load(self, file=None, lines=None):
+        """
+        Replaces the job by the lines of `file`, a path on the server,
+        or by `lines`, a list of lines
+        """
+        if (file is None) == (lines is None):
+            raise ValueError("load needs either file or lines")
+        if not self.grbl.job_finished:
+            raise ValueError("A job is running")
+
+        self.grbl.job_new()
+        self.errors = []
+        if file is not None:
+            self.grbl.load_file(file)
+            self.job = file
+        else:
+            self.grbl.write("\n".join(lines))
+            self.job = "<{} lines>".format(len(lines))
+        return {"lines": self.grbl.buffer_size}
+
+    def run_job(self, line=None):
+        if self.grbl.buffer_size == 0:
+            raise ValueError("No job loaded")
+        self.running = True
+        with self._stream_lock:
+            self.grbl.job_run(line)
+
+    def halt(self):
+        self.grbl.job_halt()
+
+    def abort(self):
+        self.running = False
+        self.grbl.job_halt()
+        self.grbl.abort()
+
+    def killalarm(self):
+        self.grbl.killalarm()
+        self.alarm = None
+
+    def feed(self, value=None):
+        """
+        Overrides the feed of the job with `value` in mm/min, or stops
+        overriding it when `value` is None
+        """
+        if value is None:
+            self.grbl.set_feed_override(False)
+        else:
+            self.grbl.request_feed(float(value))
+            self.grbl.set_feed_override(True)
+        self.requested_feed = value
+
+    def send(self, line):
+        self.grbl.send_immediately(line)
+
+    def events(self):
+        return {"report": self.eventbus.report()}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # one JSON request per line, answered with one JSON line
+
+    def handle(self):
+        server = self.server.stream_server
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                answer = {"ok": False, "error": "Invalid JSON"}
+            else:
+                answer = server.command(request)
+            self.wfile.write(json.dumps(answer).encode() + b"\n")
+
+
+def request(cmd, socket_path=DEFAULT_SOCKET, **args):
+    """
+    Sends one command to a StreamServer and returns its answer, e.g.
+    request("feed", value=800)
+    """
+    args["cmd"] = cmd
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        with s.makefile("rwb") as f:
+            f.write(json.dumps(args).encode() + b"\n")
+            f.flush()
+            return json.loads(f.readline())
@@ -0,0 +1,321 @@
+"""
+grbl-gui - Graphical User Interface for the "grbl" CNC controller
+Copyright (C) 2015 Michael Franzl
+
+This file is part of grbl-gui.
+
+grbl-gui is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+grbl-gui is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with pyglpainter. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Streams one G-code file to Grbl from the command line and reports the
+# progress, see the `stream` subcommand of grbl-gui.py:
+#
+#     job = StreamJob("/dev/ttyACM0", "job.ngc")
+#     raise SystemExit(job.run())
+#
+# The file is read into the buffer of GrblStreamer in chunks while the
+# job runs, so that huge files start streaming at once and don't need
+# to fit into memory.
+
+import itertools
+import logging
+import sys
+import threading
+import time
+
+from grbl_streamer import GrblStreamer
+
+from . import eventbus
+from . import gcodeindex
+from . import gcodetools
+
+
+# exit codes of run()
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_ALARM = 2
+EXIT_NO_CONNECTION = 3
+EXIT_INTERRUPTED = 130
+
+# Grbl's serial receive buffer has 128 bytes, but one of them always
+# stays empty
+RX_BUFFER_SIZE = 127
+
+
+class StreamJob:
+    """
+    Streams `fname` to Grbl on `path`.
+
+    By default lines are sent as long as they fit into Grbl's receive
+    buffer of `rx_buffer_size` bytes, counting the characters sent and
+    acknowledged ("character counting"). This keeps the buffer full, so
+    that short segments don't wait for the round trip of each "ok". With
+    `incremental`, each line is sent only after the last one was
+    acknowledged, which is needed e.g. for writing $ settings.
+
+    With `start_line`, counted from 0, the job is resumed at this line
+    of the file. The modal state before it (units, plane, distance mode,
+    coordinate system, motion mode, feed and spindle speed) is sent
+    first, but the spindle and the position are left as they are.
+    """
+
+    def __init__(self, path, fname, baud=115200, incremental=False, rx_buffer_size=RX_BUFFER_SIZE,
+                 chunk_size=1000, interval=0.1, report_interval=1, out=sys.stdout, timing=False, start_line=0):
+        self.logger = logging.getLogger('grbl-gui')
+        self.path = path
+        self.fname = fname
+        self.baud = baud
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.report_interval = report_interval
+        self.out = out
+        self.start_line = start_line
+
+        # one event per line is sent, only the latest of them matter here
+        coalesce = eventbus.COALESCED | {"on_processed_command", "on_write", "on_read"}
+        self.eventbus = eventbus.EventBus(self.on_grbl_event, coalesce, timing=timing)
+        self.grbl = GrblStreamer(self._callback)
+        self.grbl.incremental_streaming = incremental
+        self.grbl._rx_buffer_size = rx_buffer_size
+
+        self._stream_lock = stream_lock(self.grbl)
+
+        self.total = 0
+        self.processed = 0
+        # the duration of the job, and how full Grbl's receive buffer was
+        self.seconds = 0
+        self.rx_buffer_average = 0
+        self.errors = []
+        self.alarm = None
+        self.load_error = None
+
+        self._lines = None
+        # the number of lines more in the buffer than in the file so far
+        self._extra = 0
+        # the line of the file minus the line of the buffer
+        self._line_offset = 0
+        self._booted = False
+        self._completed = False
+        # lines written to Grbl since it booted, and "ok"s received
+        self._written = 0
+        self._acknowledged = 0
+
+        # the RX buffer fill sampled every interval while streaming
+        self._rx_samples = 0
+        self._rx_sum = 0
+
+    def run(self):
+        """
+        Connects, streams the file and disconnects. Returns one of the
+        EXIT_* codes.
+        """
+        try:
+            index = gcodeindex.get(self.fname)
+            self.total = index["line_count"]
+            if self.start_line > 0:
+                if self.start_line >= self.total:
+                    self.logger.error("{} has only {} lines".format(self.fname, self.total))
+                    return EXIT_ERROR
+                state, self._lines = gcodeindex.read_from(self.fname, self.start_line, index)
+                # written before connecting, because the lines of the file
+                # are loaded into the buffer as soon as Grbl booted
+                self.grbl.write(gcodeindex.state_gcode(state))
+                # it becomes one line per G word in the buffer
+                self.total += self.grbl.buffer_size - self.start_line
+                self._line_offset = self.start_line - self.grbl.buffer_size
+            else:
+                self._lines = gcodetools.read_stream(self.fname)
+        except OSError as e:
+            self.logger.error("Cannot read {}: {}".format(self.fname, e))
+            return EXIT_ERROR
+
+        try:
+            self.grbl.cnect(self.path, self.baud)
+        except OSError as e:
+            self.logger.error("Cannot connect to {}: {}".format(self.path, e))
+            return EXIT_NO_CONNECTION
+
+        try:
+            return self._run()
+        except KeyboardInterrupt:
+            # stop the machine, not only the stream
+            self.grbl.job_halt()
+            self.grbl.abort()
+            self._print_line("Interrupted in line {}".format(self.processed), True)
+            return EXIT_INTERRUPTED
+        finally:
+            self.grbl.disconnect()
+
+    def _run(self):
+        # GrblStreamer sends $$, $# and $G after Grbl booted and again
+        # $G when Grbl first reports Idle. The "ok" to any of them would
+        # be taken for the acknowledgement of a line of the job, so the
+        # job starts only once all of them were answered.
+        deadline = time.time() + 10
+        quiet = 0
+        while quiet < 2:
+            if time.time() > deadline:
+                self.logger.error("No answer from Grbl on {}".format(self.path))
+                return EXIT_NO_CONNECTION
+            time.sleep(self.interval)
+            self.eventbus.dispatch()
+            if self.grbl.cmode == "Alarm":
+                self.alarm = self.alarm or "Grbl is in alarm state"
+                self._print_line("Alarm: {}".format(self.alarm), True)
+                return EXIT_ALARM
+            if (self._booted and self.grbl.cmode == "Idle" and self._written == self._acknowledged
+                    and not self.grbl.hash_state_requested and not self.grbl.gcode_parser_state_requested):
+                quiet += 1
+            else:
+                quiet = 0
+
+        self._load_chunk()
+        if self._lines is None and not any(gcodetools.tokenize(line)[0] for line in self.grbl.buffer):
+            # e.g. an empty file or only comments
+            self._print_line("Nothing to stream in {}".format(self.fname), True)
+            return EXIT_OK
+
+        start = time.time()
+        last_report = start
+        last_processed = 0
+        with self._stream_lock:
+            self.grbl.job_run()
+
+        while True:
+            time.sleep(self.interval)
+            self.eventbus.dispatch()
+            self._rx_samples += 1
+            self._rx_sum += self.grbl._rx_buffer_fill_percent
+
+            now = time.time()
+            if now - last_report >= self.report_interval:
+                rate = (self.processed - last_processed) / (now - last_report)
+                self._report(rate, now - start)
+                last_report = now
+                last_processed = self.processed
+
+            if self.alarm is not None or self.errors or self._completed or self._done():
+                break
+
+        self.seconds = seconds = time.time() - start
+        self.rx_buffer_average = self._rx_sum / self._rx_samples if self._rx_samples else 0
+        self._print_line("{} lines in {}, {:.0f} lines/s, RX buffer {:.0f}% full on average".format(
+            self.processed, _timestring(seconds), self.processed / seconds if seconds > 0 else 0,
+            self.rx_buffer_average), True)
+
+        if self.alarm is not None:
+            self._print_line("Alarm: {}".format(self.alarm), True)
+            return EXIT_ALARM
+        if self.errors or self.load_error is not None:
+            for line, command, line_number in self.errors:
+                self._print_line("{} in line {}: {}".format(line, line_number + self._line_offset, command), True)
+            if self.load_error is not None:
+                self._print_line("Cannot read {}: {}".format(self.fname, self.load_error), True)
+            return EXIT_ERROR
+        return EXIT_OK
+
+    def _done(self):
+        # the whole file was sent and acknowledged
+        grbl = self.grbl
+        return self._lines is None and grbl.current_line_number >= grbl.buffer_size and not grbl._rx_buffer_fill
+
+    def _callback(self, event, *data):
+        # The reader thread of GrblStreamer calls this with
+        # on_progress_percent right before it takes the next line from
+        # the buffer. Loading lines at any other time could interleave
+        # with the preprocessing of the line being sent.
+        if event == "on_progress_percent" and self._lines is not None:
+            if self.grbl.buffer_size - self.grbl.current_line_number < self.chunk_size // 2:
+                self._load_chunk()
+        elif event == "on_write":
+            self._written += 1
+        elif event == "on_rx_buffer_percent":
+            # posted for every "ok"
+            self._acknowledged += 1
+        elif event == "on_boot":
+            # on_rx_buffer_percent is also posted while booting
+            self._written = self._acknowledged = 0
+        self.eventbus.post(event, *data)
+
+    def _load_chunk(self):
+        # the whole file may already be loaded, e.g. while booting
+        if self._lines is None:
+            return
+        try:
+            chunk = list(itertools.islice(self._lines, self.chunk_size))
+        except (OSError, ValueError) as e:
+            self.load_error = e
+            chunk = []
+        if chunk:
+            size = self.grbl.buffer_size
+            self.grbl.write(chunk)
+            self._extra += self.grbl.buffer_size - size - len(chunk)
+        else:
+            self._lines = None
+
+    def on_grbl_event(self, event, *data):
+        if event == "on_boot":
+            self._booted = True
+            self.grbl.poll_start()
+        elif event == "on_processed_command":
+            self.processed = data[0] + 1
+        elif event == "on_alarm":
+            self.alarm = data[0]
+        elif event == "on_error":
+            self.errors.append(data)
+        elif event == "on_job_completed":
+            # also posted on boot
+            if self._lines is None and self.grbl.buffer_size > 0:
+                self._completed = True
+
+    def _report(self, rate, seconds):
+        # lines of the file may become several lines in the buffer, e.g. arcs
+        total = self.total + self._extra
+        remaining = max(0, total - self.processed)
+        eta = _timestring(remaining / rate) if rate > 0 else "--:--:--"
+        self._print_line("{}/{} {:5.1f}% {:7.0f} lines/s RX {:3d}% {} ETA {}".format(
+            self.processed, total, 100 * self.processed / total if total else 0, rate,
+            self.grbl._rx_buffer_fill_percent, _timestring(seconds), eta))
+
+    def _print_line(self, text, last=False):
+        if self.out.isatty():
+            # overwrite the progress line in a terminal
+            self.out.write("\r\x1b[K" + text + ("\n" if last else ""))
+        else:
+            self.out.write(text + "\n")
+        self.out.flush()
+
+
+def stream_lock(grbl):
+    """
+    Returns a lock which the reader thread of the GrblStreamer `grbl`
+    holds while it handles an "ok". Hold it while calling job_run().
+
+    job_run() sends lines from the calling thread while the reader
+    thread sends lines on each "ok", which could send a line twice or
+    lose track of the end of the job. With the lock they take turns.
+    """
+    lock = threading.Lock()
+    handle_ok = grbl._handle_ok
+
+    def locked_handle_ok():
+        with lock:
+            handle_ok()
+
+    grbl._handle_ok = locked_handle_ok
+    return lock
+
+
+def _timestring(seconds):
+    return "{}:{:02d}:{:02d}".format(int(seconds // 3600), int(seconds % 3600 // 60), int(seconds % 60))
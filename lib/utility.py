@@ -27,6 +27,12 @@ def read_file_to_linearray(filename):
             lines.append(line)
     return lines
 
+def iterate_file_lines(filename):
+    # like read_file_to_linearray, but yields lines one by one
+    with open(filename, "r") as f:
+        for line in f:
+            yield line
+
 def write_file_from_linearray(array, filename):
     with open(filename, "w") as f:
         for line in array: